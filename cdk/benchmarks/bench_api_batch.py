@@ -0,0 +1,50 @@
+"""Compare sequential and concurrent batch submission in the API lambda.
+
+Run from the cdk directory:
+
+    $ python benchmarks/bench_api_batch.py --jobs 300 --latency-ms 40
+"""
+import argparse
+import json
+import time
+
+from common import load_lambda, measure
+
+
+class FakeStepFunctions:
+    def __init__(self, latency):
+        self.latency = latency
+
+    def start_execution(self, stateMachineArn, input, **kwargs):
+        time.sleep(self.latency)
+        job_name = json.loads(input)["transcribe_job_name"]
+        return {"executionArn": f"{stateMachineArn}:{job_name}"}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--jobs", type=int, default=300)
+    parser.add_argument("--latency-ms", type=float, default=40.0)
+    parser.add_argument("--runs", type=int, default=3)
+    args = parser.parse_args()
+
+    api = load_lambda("api", STATE_MACHINE_ARN="arn:aws:states:us-east-1:123456789012:stateMachine:StateMachine",
+                          IDEMPOTENCY_ENABLED="false")
+    client = FakeStepFunctions(args.latency_ms / 1000)
+    api.boto3.client = lambda *a, **k: client
+    event = {"resource": "/api/batch", "body": json.dumps({
+        "output_location": "bucket", "output_prefix": "audio_transcripts", "language": "English",
+        "jobs": [{"job_name": f"visit-{i}", "job_uri": f"s3://bucket/visit-{i}.mp3"} for i in range(args.jobs)]
+    })}
+
+    print(f"{'workers':>8} {'batch ms':>10} {'per job ms':>11} {'speedup':>8}")
+    baseline = None
+    for workers in (1, 4, 10, 25):
+        api.batch_max_workers = workers
+        median, _ = measure(lambda: api.lambda_handler(event, None), args.runs)
+        baseline = baseline or median
+        print(f"{workers:>8} {median:>10.1f} {median / args.jobs:>11.2f} {baseline / median:>7.1f}x")
+
+
+if __name__ == "__main__":
+    main()
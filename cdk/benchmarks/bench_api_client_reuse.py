@@ -0,0 +1,54 @@
+"""Per-invocation latency of the API lambda with a cold or a warm step functions client.
+
+A cold invocation drops the cached client first, which is what every request paid
+when the client was built inside the handler. Requests go to a local stand-in
+endpoint, so the numbers are client construction and connection setup only.
+
+    $ python benchmarks/bench_api_client_reuse.py --invocations 200
+"""
+import argparse
+import json
+import os
+
+from common import StandInEndpoint, load_lambda, measure
+
+
+def respond(operation, request):
+    if operation == "StartExecution":
+        name = json.loads(request["input"])["transcribe_job_name"]
+        return {"executionArn": f"{request['stateMachineArn']}:{name}", "startDate": 0}
+    return {}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--invocations", type=int, default=200)
+    parser.add_argument("--latency-ms", type=float, default=2.0)
+    args = parser.parse_args()
+
+    with StandInEndpoint(respond, latency=args.latency_ms / 1000) as endpoint:
+        os.environ["AWS_ENDPOINT_URL_SFN"] = endpoint.url
+        api = load_lambda("api", STATE_MACHINE_ARN="arn:aws:states:us-east-1:123456789012:stateMachine:StateMachine",
+                          IDEMPOTENCY_ENABLED="false")
+        event = {"body": json.dumps({
+            "job_name": "visit-0001", "job_uri": "s3://bucket/visit-0001.mp3",
+            "output_location": "bucket", "output_prefix": "audio_transcripts", "language": "English"
+        })}
+
+        def cold():
+            api.reset_client('stepfunctions')
+            api.lambda_handler(event, None)
+
+        def warm():
+            api.lambda_handler(event, None)
+
+        warm()
+        for label, fn in (("cold client", cold), ("warm client", warm)):
+            connections = endpoint.connections
+            median, p90 = measure(fn, args.invocations)
+            print(f"{label}: p50 {median:.2f} ms  p90 {p90:.2f} ms  "
+                  f"new connections {endpoint.connections - connections}")
+
+
+if __name__ == "__main__":
+    main()
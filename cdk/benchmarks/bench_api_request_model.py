@@ -0,0 +1,55 @@
+"""Parse and serialize cost of a submission: JobRequest against the json.loads/dict approach.
+
+    $ python benchmarks/bench_api_request_model.py --iterations 200000
+"""
+import argparse
+import json
+import timeit
+
+from common import load_lambda
+
+BODY = json.dumps({
+    "job_name": "testing-audio-hfduyrienb567",
+    "job_uri": "s3://chartautomationcdkstack-s3bucket07682993-10nyd5de7j6xe/speech_20230717144101316.mp3",
+    "output_location": "chartautomationcdkstack-s3bucket07682993-10nyd5de7j6xe",
+    "output_prefix": "audio_transcripts",
+    "language": "English"
+})
+
+
+# The handler before JobRequest: fields copied into a dict, then json.dumps
+def dict_parse_serialize():
+    body = json.loads(BODY)
+    execution_input = {}
+    execution_input['transcribe_job_name'] = body['job_name']
+    execution_input['transcribe_job_uri'] = body['job_uri']
+    execution_input['transcribe_job_bucket'] = body['output_location']
+    execution_input['transcribe_job_output_prefix'] = body['output_prefix']
+    execution_input['transcribe_job_language'] = body['language']
+    return json.dumps(execution_input)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--iterations", type=int, default=200000)
+    args = parser.parse_args()
+
+    api = load_lambda("api", STATE_MACHINE_ARN="arn:aws:states:us-east-1:123456789012:stateMachine:StateMachine")
+    job = api.JobRequest.from_body(BODY)
+    execution_input = dict_parse_serialize()
+    execution_input_dict = json.loads(execution_input)
+    assert job.to_execution_input() == execution_input
+
+    cases = (
+        ("dict parse+serialize", dict_parse_serialize),
+        ("JobRequest parse+validate+serialize", lambda: api.JobRequest.from_body(BODY).to_execution_input()),
+        ("json.dumps serialize only", lambda: json.dumps(execution_input_dict)),
+        ("JobRequest serialize only", job.to_execution_input),
+    )
+    for label, fn in cases:
+        seconds = min(timeit.repeat(fn, number=args.iterations, repeat=3))
+        print(f"{label:<38} {seconds / args.iterations * 1e6:8.2f} us/op")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,66 @@
+"""Single-prompt against map-reduce summarization of long transcripts, with a fake model
+whose latency grows with the tokens it reads and writes.
+
+    $ python benchmarks/bench_bedrock_map_reduce.py --minutes 15,60,120,240 --ms-per-input-token 0.2
+"""
+import argparse
+import io
+import json
+import time
+
+from common import load_lambda, synthetic_transcript
+
+
+class FakeBedrock:
+    def __init__(self, ms_per_input_token, ms_per_output_token):
+        self.ms_per_input_token = ms_per_input_token
+        self.ms_per_output_token = ms_per_output_token
+
+    def invoke_model(self, body, **kwargs):
+        request = json.loads(body)
+        input_tokens = len(request["prompt"]) // 4
+        # the model writes about a tenth of what it reads, up to the token limit
+        output_tokens = min(request["max_tokens_to_sample"], max(50, input_tokens // 10))
+        time.sleep((input_tokens * self.ms_per_input_token + output_tokens * self.ms_per_output_token) / 1000)
+        completion = "summary " * output_tokens
+        return {"body": io.BytesIO(json.dumps({"completion": completion}).encode("utf-8"))}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--minutes", default="15,60,120,240")
+    parser.add_argument("--ms-per-input-token", type=float, default=0.2)
+    parser.add_argument("--ms-per-output-token", type=float, default=10)
+    parser.add_argument("--chunk-chars", type=int, default=24000)
+    parser.add_argument("--workers", type=int, default=8)
+    args = parser.parse_args()
+
+    bedrock = load_lambda("bedrock")
+    bedrock.bedrock = FakeBedrock(args.ms_per_input_token, args.ms_per_output_token)
+    bedrock.summary_max_workers = args.workers
+    bedrock.summary_chunk_chars = args.chunk_chars
+    command = "summarize this conversation in english."
+
+    print(f"{'minutes':>7} {'chars':>9} {'chunks':>6} {'single s':>9} {'map-reduce s':>13}")
+    for minutes in (int(value) for value in args.minutes.split(",")):
+        # about 150 spoken words per minute in turns of 40 words
+        results = synthetic_transcript(turns=minutes * 150 // 40)["results"]
+        transcript = results["transcripts"][0]["transcript"]
+
+        started = time.perf_counter()
+        bedrock.call_bedrock_model(transcript + ". " + command)
+        single = time.perf_counter() - started
+
+        if len(transcript) <= args.chunk_chars:
+            print(f"{minutes:>7} {len(transcript):>9} {1:>6} {single:>9.2f} {'(not chunked)':>13}")
+            continue
+        started = time.perf_counter()
+        chunks = bedrock.chunk_turns(bedrock.speaker_turns(results), args.chunk_chars)
+        summaries = bedrock.summarize_chunks(chunks, "English")
+        bedrock.call_bedrock_model(bedrock.reduce_prompt(summaries, command))
+        map_reduce = time.perf_counter() - started
+        print(f"{minutes:>7} {len(transcript):>9} {len(chunks):>6} {single:>9.2f} {map_reduce:>13.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,65 @@
+"""Reading the transcript out of a transcribe medical output document: the whole object
+read, decoded and parsed, against the ranged and streamed read of TranscriptObject.
+Reports latency, peak Python memory and the bytes served by a local S3 stand-in.
+
+    $ python benchmarks/bench_bedrock_transcript_read.py --minutes 15,60,180,360 --runs 10
+"""
+import argparse
+import json
+import tracemalloc
+
+import boto3
+from botocore.config import Config
+
+from common import StandInBucket, load_lambda, measure, synthetic_transcript
+
+
+def whole_document_read(s3, key):
+    s3_file_content = s3.get_object(Bucket="bucket", Key=key)['Body'].read().decode('utf-8')
+    return json.loads(s3_file_content)['results']['transcripts'][0]['transcript']
+
+
+def peak_memory(fn):
+    tracemalloc.start()
+    fn()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return peak / 2**20
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--minutes", default="15,60,180,360")
+    parser.add_argument("--runs", type=int, default=10)
+    parser.add_argument("--latency", type=float, default=0.005, help="seconds per request")
+    args = parser.parse_args()
+
+    bedrock = load_lambda("bedrock")
+    objects = {}
+    for minutes in (int(value) for value in args.minutes.split(",")):
+        # about 150 spoken words per minute in turns of 40 words
+        objects[("bucket", f"{minutes}.json")] = json.dumps(synthetic_transcript(turns=minutes * 150 // 40)).encode("utf-8")
+
+    with StandInBucket(objects, args.latency) as endpoint:
+        bedrock.s3 = boto3.client("s3", endpoint_url=endpoint.url, config=Config(s3={"addressing_style": "path"}))
+
+        print(f"{'minutes':>7} {'object MB':>9} {'read':>10} {'median ms':>9} {'p90 ms':>7} {'peak MB':>8} {'served MB':>9}")
+        for (_, key), data in objects.items():
+            minutes = key.split(".")[0]
+            transcript = whole_document_read(bedrock.s3, key)
+
+            def streamed():
+                transcript_object = bedrock.TranscriptObject("bucket", key)
+                transcript_object.close()
+                assert transcript_object.transcript == transcript
+
+            for name, fn in (("whole", lambda: whole_document_read(bedrock.s3, key)), ("streamed", streamed)):
+                fn()
+                median, p90 = measure(fn, args.runs)
+                endpoint.bytes_sent = 0
+                peak = peak_memory(fn)
+                print(f"{minutes:>7} {len(data) / 2**20:>9.1f} {name:>10} {median:>9.1f} {p90:>7.1f} {peak:>8.1f} {endpoint.bytes_sent / 2**20:>9.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,50 @@
+"""Per-invocation latency of entity detection with a client built for every call, which is
+what detect_entities did before, against the module-level client kept by warm containers.
+Requests go to a local stand-in endpoint, so the numbers are client construction and
+connection setup only. The long document is split into chunks analyzed concurrently.
+
+    $ python benchmarks/bench_comprehend_client_reuse.py --invocations 100
+"""
+import argparse
+import os
+
+from common import StandInEndpoint, load_lambda, measure
+
+
+def respond(operation, request):
+    return {"Entities": [], "UnmappedAttributes": [], "ModelVersion": "2.0.0"}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--invocations", type=int, default=100)
+    parser.add_argument("--latency-ms", type=float, default=2.0)
+    args = parser.parse_args()
+
+    with StandInEndpoint(respond, latency=args.latency_ms / 1000) as endpoint:
+        os.environ["AWS_ENDPOINT_URL_COMPREHENDMEDICAL"] = endpoint.url
+        comprehend = load_lambda("comprehend-health")
+        comprehend.print = lambda *values: None
+        documents = {
+            "short": "Patient reports a fever since Monday and takes ibuprofen twice daily.",
+            "long": "Patient reports a fever since Monday and takes ibuprofen twice daily. " * 1200,
+        }
+
+        for name, document in documents.items():
+            def cold():
+                comprehend.comprehend_client = None
+                comprehend.detect_entities(document)
+
+            def warm():
+                comprehend.detect_entities(document)
+
+            warm()
+            for label, fn in (("cold client", cold), ("warm client", warm)):
+                connections = endpoint.connections
+                median, p90 = measure(fn, args.invocations)
+                print(f"{name} document, {label}: p50 {median:.2f} ms  p90 {p90:.2f} ms  "
+                      f"new connections {endpoint.connections - connections}")
+
+
+if __name__ == "__main__":
+    main()
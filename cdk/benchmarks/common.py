@@ -0,0 +1,174 @@
+import http.server
+import importlib.util
+import json
+import os
+import pathlib
+import socket
+import statistics
+import threading
+import time
+
+LAMBDA_ROOT = pathlib.Path(__file__).resolve().parents[1] / "lambda"
+
+
+# Load a lambda handler module from lambda/<name>/main.py
+def load_lambda(name, **env):
+    os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+    os.environ.setdefault("AWS_ACCESS_KEY_ID", "testing")
+    os.environ.setdefault("AWS_SECRET_ACCESS_KEY", "testing")
+    os.environ.update(env)
+    module_name = name.replace("-", "_") + "_main"
+    spec = importlib.util.spec_from_file_location(module_name, LAMBDA_ROOT / name / "main.py")
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+# Time fn over a number of runs and return (median, p90) in milliseconds
+def measure(fn, runs):
+    samples = []
+    for _ in range(runs):
+        started = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - started) * 1000)
+    samples.sort()
+    return statistics.median(samples), samples[min(len(samples) - 1, int(len(samples) * 0.9))]
+
+
+# Local stand-in for an AWS JSON protocol endpoint. handler receives the
+# X-Amz-Target operation and the decoded request and returns the response dict.
+class StandInEndpoint:
+    def __init__(self, handler, latency=0.0):
+        self.handler = handler
+        self.latency = latency
+        self.connections = 0
+
+    def __enter__(self):
+        endpoint = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def setup(self):
+                super().setup()
+                self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                endpoint.connections += 1
+
+            def do_POST(self):
+                request = json.loads(self.rfile.read(int(self.headers["Content-Length"])) or b"{}")
+                operation = self.headers.get("X-Amz-Target", "").split(".")[-1]
+                time.sleep(endpoint.latency)
+                body = json.dumps(endpoint.handler(operation, request)).encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "application/x-amz-json-1.0")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+# Local stand-in for S3 path-style GetObject, with Range support, over a dict of
+# (bucket, key) -> bytes. bytes_sent counts the object bytes served.
+class StandInBucket:
+    def __init__(self, objects=None, latency=0.0):
+        self.objects = dict(objects or {})
+        self.latency = latency
+        self.bytes_sent = 0
+
+    def __enter__(self):
+        endpoint = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def setup(self):
+                super().setup()
+                self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+            def do_GET(self):
+                bucket, _, key = self.path.lstrip("/").partition("/")
+                data = endpoint.objects.get((bucket, key.split("?")[0]))
+                time.sleep(endpoint.latency)
+                if data is None:
+                    self.send_response(404)
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                    return
+                first, last = 0, len(data) - 1
+                if self.headers.get("Range"):
+                    start, _, end = self.headers["Range"][len("bytes="):].partition("-")
+                    first, last = int(start), min(int(end), last) if end else last
+                    self.send_response(206)
+                    self.send_header("Content-Range", f"bytes {first}-{last}/{len(data)}")
+                else:
+                    self.send_response(200)
+                self.send_header("Content-Length", str(last - first + 1))
+                self.end_headers()
+                try:
+                    # write in pieces so a client that stops reading stops the transfer
+                    for offset in range(first, last + 1, 65536):
+                        piece = data[offset:min(offset + 65536, last + 1)]
+                        self.wfile.write(piece)
+                        endpoint.bytes_sent += len(piece)
+                except (BrokenPipeError, ConnectionResetError):
+                    self.close_connection = True
+
+            def log_message(self, *args):
+                pass
+
+        self.server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+WORDS = ("the patient reports fever cough fatigue since monday no chest pain mild headache "
+         "taking ibuprofen twice daily blood pressure normal lungs clear follow up next week").split()
+
+
+# Build a transcribe medical output document for a conversation of the given length,
+# with per-word items, alternatives and speaker labels like the real service writes
+def synthetic_transcript(turns, words_per_turn=40):
+    items, segments, transcript_words = [], [], []
+    clock = 0.0
+    for turn in range(turns):
+        speaker = f"spk_{turn % 2}"
+        segment = {"start_time": f"{clock:.2f}", "speaker_label": speaker, "items": []}
+        for index in range(words_per_turn):
+            word = WORDS[(turn * 7 + index) % len(WORDS)]
+            start, clock = clock, clock + 0.35
+            items.append({
+                "start_time": f"{start:.2f}", "end_time": f"{clock:.2f}",
+                "alternatives": [{"confidence": "0.9987", "content": word}], "type": "pronunciation"
+            })
+            segment["items"].append({"start_time": f"{start:.2f}", "speaker_label": speaker, "end_time": f"{clock:.2f}"})
+            transcript_words.append(word)
+        items.append({"alternatives": [{"confidence": "0.0", "content": "."}], "type": "punctuation"})
+        transcript_words[-1] += "."
+        segment["end_time"] = f"{clock:.2f}"
+        segments.append(segment)
+    return {
+        "jobName": "synthetic",
+        "accountId": "123456789012",
+        "results": {
+            "transcripts": [{"transcript": " ".join(transcript_words)}],
+            "speaker_labels": {"speakers": 2, "segments": segments},
+            "items": items
+        },
+        "status": "COMPLETED"
+    }
@@ -0,0 +1,47 @@
+"""Simulate the end-to-end latency of summarization and entity detection, run one after the
+other (sequential mode) or as the two branches of a Parallel state (parallel mode), with
+and without the second entity pass over the summary.
+
+Model latency is a fixed overhead plus time per input and output token. Comprehend Medical
+latency is a fixed overhead plus time per thousand characters. Every state transition and
+lambda invocation adds --transition-seconds.
+
+    $ python benchmarks/sim_entity_detection.py --minutes 5,15,30,60
+"""
+import argparse
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--minutes", default="5,15,30,60")
+    parser.add_argument("--model-overhead-seconds", type=float, default=1.0)
+    parser.add_argument("--ms-per-input-token", type=float, default=0.2)
+    parser.add_argument("--ms-per-output-token", type=float, default=30)
+    parser.add_argument("--summary-tokens", type=int, default=600)
+    parser.add_argument("--comprehend-overhead-seconds", type=float, default=0.4)
+    parser.add_argument("--comprehend-seconds-per-kchar", type=float, default=0.25)
+    parser.add_argument("--transition-seconds", type=float, default=0.05)
+    args = parser.parse_args()
+
+    def summarize(chars):
+        return (args.model_overhead_seconds + (chars / 4 * args.ms_per_input_token
+                + args.summary_tokens * args.ms_per_output_token) / 1000 + args.transition_seconds)
+
+    def detect_entities(chars):
+        return args.comprehend_overhead_seconds + chars / 1000 * args.comprehend_seconds_per_kchar + args.transition_seconds
+
+    summary_chars = args.summary_tokens * 4
+    print(f"{'minutes':>7} {'chars':>7} {'sequential s':>12} {'parallel s':>10} {'+ summary pass s':>16} {'saved':>6}")
+    for minutes in (int(value) for value in args.minutes.split(",")):
+        # about 150 spoken words of 6 characters per minute
+        transcript_chars = minutes * 150 * 6
+        sequential = summarize(transcript_chars) + detect_entities(summary_chars)
+        # the pass state and the parallel state each add a transition
+        parallel = max(summarize(transcript_chars), args.transition_seconds + detect_entities(transcript_chars)) + args.transition_seconds
+        summary_pass = parallel + args.transition_seconds + detect_entities(summary_chars)
+        print(f"{minutes:>7} {transcript_chars:>7} {sequential:>12.2f} {parallel:>10.2f} {summary_pass:>16.2f} "
+              f"{1 - parallel / sequential:>6.0%}")
+
+
+if __name__ == "__main__":
+    main()
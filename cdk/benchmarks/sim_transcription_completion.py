@@ -0,0 +1,92 @@
+"""Simulate when the workflow notices a finished transcription, in polling and callback mode.
+
+Fixed polling waits 30 seconds before every status check. Adaptive polling uses the
+transcribe lambda's waits: a first check shortly before the expected transcription time
+(estimated from the audio length, here off by --estimate-error), then exponential backoff
+up to a cap.
+Callback mode parks a task token and is resumed by the S3 notification for the
+transcript, falling back to status checks when the callback times out. The timeout
+follows the expected transcription time, never below --callback-timeout-seconds.
+
+    $ python benchmarks/sim_transcription_completion.py --transcription-seconds 12,45,150,600,1800
+"""
+import argparse
+
+from common import load_lambda
+
+
+# Returns (seconds from job start until the workflow sees the result, lambda invocations)
+def polling(transcription_seconds, wait_seconds, lambda_seconds, started_at=0.0):
+    elapsed, invocations = started_at, 0
+    while True:
+        elapsed += wait_seconds + lambda_seconds
+        invocations += 1
+        if elapsed >= transcription_seconds:
+            return elapsed, invocations
+
+
+def adaptive_polling(transcription_seconds, expected_seconds, lambda_seconds, next_wait_seconds, started_at=None):
+    if started_at is None:
+        elapsed = lambda_seconds + next_wait_seconds(expected_seconds, 0, 0)
+    else:
+        elapsed = started_at  # the callback fallback checks at once
+    invocations = 0
+    while True:
+        elapsed += lambda_seconds
+        invocations += 1
+        if elapsed >= transcription_seconds:
+            return elapsed, invocations
+        elapsed += next_wait_seconds(expected_seconds, elapsed, invocations)
+
+
+def callback(transcription_seconds, lambda_seconds, event_delay_seconds, timeout_seconds, fallback):
+    registered_at = lambda_seconds
+    if transcription_seconds + event_delay_seconds <= registered_at + timeout_seconds:
+        # the register call resumes at once if the transcript is already there
+        resumed_at = max(transcription_seconds + event_delay_seconds, registered_at) + lambda_seconds
+        return resumed_at, 2
+    elapsed, invocations = fallback(registered_at + timeout_seconds)
+    return elapsed, invocations + 1
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--transcription-seconds", default="12,45,90,150,300,1200,1800")
+    parser.add_argument("--wait-seconds", type=float, default=30)
+    parser.add_argument("--lambda-seconds", type=float, default=0.3)
+    parser.add_argument("--event-delay-seconds", type=float, default=1.0)
+    parser.add_argument("--callback-timeout-seconds", type=float, default=180)
+    parser.add_argument("--estimate-error", type=float, default=0.2)
+    args = parser.parse_args()
+    transcribe = load_lambda("transcribe")
+    transcribe.callback_min_timeout_seconds = args.callback_timeout_seconds
+
+    print(f"{'job s':>7} | {'fixed seen at':>13} {'calls':>5} | {'adaptive seen at':>16} {'calls':>5} | "
+          f"{'callback seen at':>16} {'calls':>5}")
+    totals = [0.0, 0.0, 0.0]
+    for transcription_seconds in (float(value) for value in args.transcription_seconds.split(",")):
+        polled, polled_invocations = polling(transcription_seconds, args.wait_seconds, args.lambda_seconds)
+        polled += args.lambda_seconds  # the submit call
+        adapted, adapted_invocations = adaptive_polling(
+            transcription_seconds, transcription_seconds * (1 + args.estimate_error),
+            args.lambda_seconds, transcribe.next_wait_seconds)
+        expected_seconds = transcription_seconds * (1 + args.estimate_error)
+        resumed, resumed_invocations = callback(
+            transcription_seconds, args.lambda_seconds, args.event_delay_seconds,
+            transcribe.callback_timeout_seconds(expected_seconds),
+            lambda started_at: adaptive_polling(
+                transcription_seconds, expected_seconds,
+                args.lambda_seconds, transcribe.next_wait_seconds, started_at))
+        resumed += args.lambda_seconds
+        totals[0] += polled - transcription_seconds
+        totals[1] += adapted - transcription_seconds
+        totals[2] += resumed - transcription_seconds
+        print(f"{transcription_seconds:>7.0f} | {polled:>13.1f} {polled_invocations + 1:>5} | "
+              f"{adapted:>16.1f} {adapted_invocations + 1:>5} | {resumed:>16.1f} {resumed_invocations + 1:>5}")
+    count = len(args.transcription_seconds.split(","))
+    print(f"mean added latency: fixed polling {totals[0] / count:.1f} s, "
+          f"adaptive polling {totals[1] / count:.1f} s, callback {totals[2] / count:.1f} s")
+
+
+if __name__ == "__main__":
+    main()
@@ -3,6 +3,7 @@ from aws_cdk import (
     aws_apigateway as apigw,
     aws_lambda as lambda_,
     aws_s3 as s3,
+    aws_s3_notifications as s3n,
     aws_dynamodb as ddb,
     aws_iam as iam,
     RemovalPolicy,
@@ -17,13 +18,42 @@ class ChartAutomationCdkStack(Stack):
     def __init__(self, scope: Construct, construct_id: str, **kwargs) -> None:
         super().__init__(scope, construct_id, **kwargs)
 
+        # Get context values. In callback mode the workflow waits for the transcript to land in S3,
+        # with the polling loop as fallback. Polling mode only runs the polling loop
+        transcription_completion_mode = self.node.try_get_context('transcriptionCompletionMode') or 'callback'
+        transcription_callback_timeout = int(self.node.try_get_context('transcriptionCallbackTimeoutSeconds') or 180)
+        # an execution covers transcription, which takes about a third of the audio length, then
+        # summarization and entity detection, so the default fits the 4 hour Transcribe limit
+        state_machine_timeout = int(self.node.try_get_context('stateMachineTimeoutMinutes') or 120)
+        transcript_output_prefix = self.node.try_get_context('transcriptOutputPrefix') or 'audio_transcripts'
+        # summaries and entity lists above this size stay in S3 and the state carries pointers to them
+        # in parallel mode entities are detected in the transcript while it is summarized, and
+        # the entity summary pass also detects them in the summary once it is written
+        entity_detection_mode = self.node.try_get_context('entityDetectionMode') or 'sequential'
+        entity_summary_pass = str(self.node.try_get_context('entitySummaryPass') or 'false').lower() == 'true'
+        claim_check_threshold = self.node.try_get_context('claimCheckThresholdBytes')
+        claim_check_threshold = str(32768 if claim_check_threshold is None else claim_check_threshold)
+        upload_allowed_origins = str(self.node.try_get_context('uploadAllowedOrigins') or '*').split(',')
+
         # create s3 bucket for storing artifacts
         self.s3_bucket = s3.Bucket(
             self, 
             "S3Bucket",
             removal_policy=RemovalPolicy.DESTROY,
-            encryption=s3.BucketEncryption.KMS_MANAGED
+            encryption=s3.BucketEncryption.KMS_MANAGED,
+            # clients PUT audio parts straight to presigned URLs and need the ETag of each part
+            cors=[s3.CorsRule(
+                allowed_methods=[s3.HttpMethods.PUT],
+                allowed_origins=upload_allowed_origins,
+                allowed_headers=["*"],
+                exposed_headers=["ETag"]
+            )]
         )
+        # parts of abandoned direct uploads are billed until aborted
+        self.s3_bucket.add_lifecycle_rule(
+            prefix="audio_conversations/", abort_incomplete_multipart_upload_after=Duration.days(1))
+        # cached model completions are rebuilt on demand, so expire them with the cache ttl
+        self.s3_bucket.add_lifecycle_rule(prefix="cache/", expiration=Duration.days(7))
 
         # Create transcribe Lambda function 
         transcribe_lambda = lambda_.Function(
@@ -31,7 +61,10 @@ class ChartAutomationCdkStack(Stack):
             "TranscribeLambda",
              handler="main.lambda_handler",
              runtime=lambda_.Runtime.PYTHON_3_9,
-             code=lambda_.Code.from_asset("lambda/transcribe")
+             code=lambda_.Code.from_asset("lambda/transcribe"),
+             environment={
+                 "CALLBACK_MIN_TIMEOUT_SECONDS": str(transcription_callback_timeout)
+             }
         )
 
         transcribe_lambda.add_to_role_policy(
@@ -47,6 +80,23 @@ class ChartAutomationCdkStack(Stack):
         # Add s3 permission to transcribe lambda role policy
         self.s3_bucket.grant_read_write(transcribe_lambda)
 
+        if transcription_completion_mode == 'callback':
+            # resume waiting executions when their transcript is written
+            self.s3_bucket.add_event_notification(
+                s3.EventType.OBJECT_CREATED,
+                s3n.LambdaDestination(transcribe_lambda),
+                s3.NotificationKeyFilter(prefix=f"{transcript_output_prefix}/medical/", suffix=".json")
+            )
+            transcribe_lambda.add_to_role_policy(
+                iam.PolicyStatement(
+                    actions = [
+                        "states:SendTaskSuccess",
+                        "states:SendTaskFailure"
+                    ],
+                    resources =["*"]
+                )
+            )
+
         # Create Bedrock Helper Lambda function 
         bedrock_lambda = lambda_.Function(
             self, 
@@ -54,7 +104,12 @@ class ChartAutomationCdkStack(Stack):
              handler="main.lambda_handler",
              runtime=lambda_.Runtime.PYTHON_3_9,
              code=lambda_.Code.from_asset("lambda/bedrock"),
-             timeout=Duration.seconds(600)
+             timeout=Duration.seconds(600),
+             environment={
+                "SUMMARY_CACHE_BUCKET": self.s3_bucket.bucket_name,
+                "SUMMARY_CACHE_TTL_SECONDS": str(7 * 24 * 3600),
+                "CLAIM_CHECK_THRESHOLD_BYTES": claim_check_threshold
+            }
         )
 
         bedrock_lambda.add_to_role_policy(
@@ -65,8 +120,8 @@ class ChartAutomationCdkStack(Stack):
                 resources = ["*"]
             )
         )
-        # Add s3 permission to bedrock lambda role policy
-        self.s3_bucket.grant_read(bedrock_lambda)
+        # Add s3 permission to bedrock lambda role policy, write access is for partial summaries and the summary cache
+        self.s3_bucket.grant_read_write(bedrock_lambda)
 
         # Create comprehend health Lambda function 
         comprehend_health_lambda = lambda_.Function(
@@ -75,8 +130,15 @@ class ChartAutomationCdkStack(Stack):
              handler="main.lambda_handler",
              runtime=lambda_.Runtime.PYTHON_3_9,
              code=lambda_.Code.from_asset("lambda/comprehend-health"),
-             
+             # long transcripts are analyzed in chunks, several calls at a time
+             timeout=Duration.seconds(300),
+             memory_size=512,
+             environment={
+                "CLAIM_CHECK_THRESHOLD_BYTES": claim_check_threshold
+            }
         )
+        # read access is for summaries passed by reference, write access for entity lists
+        self.s3_bucket.grant_read_write(comprehend_health_lambda)
 
         comprehend_health_lambda.add_to_role_policy(
             iam.PolicyStatement(
@@ -101,6 +163,18 @@ class ChartAutomationCdkStack(Stack):
             output_path="$.Payload"
         )
 
+        wait_for_transcript = tasks.LambdaInvoke(
+            self, "Wait For Transcript",
+            lambda_function=transcribe_lambda,
+            integration_pattern=sfn.IntegrationPattern.WAIT_FOR_TASK_TOKEN,
+            payload=sfn.TaskInput.from_object({
+                "TaskToken": sfn.JsonPath.task_token,
+                "State": sfn.JsonPath.entire_payload
+            }),
+            # the submit step derives the timeout from the expected transcription time of the audio
+            task_timeout=sfn.Timeout.at("$.Outputs.TranscriptionOutput.CallbackTimeoutSeconds")
+        )
+
         invoke_bedrock_lambda  = tasks.LambdaInvoke(
             self, "Perform Summarization With Bedrock",
             lambda_function=bedrock_lambda,
@@ -113,10 +187,10 @@ class ChartAutomationCdkStack(Stack):
             output_path="$.Payload"
         )
 
+        # the transcribe lambda picks each wait from the expected transcription time with backoff
         wait_job = sfn.Wait(
-            self, "Wait 30 Seconds",
-            time=sfn.WaitTime.duration(
-                Duration.seconds(30))
+            self, "Wait Before Status Check",
+            time=sfn.WaitTime.seconds_path("$.Outputs.TranscriptionOutput.NextWaitSeconds")
         )
 
         fail_job = sfn.Fail(
@@ -129,18 +203,56 @@ class ChartAutomationCdkStack(Stack):
             comment='Conversation analysis succeeded'
         )
 
-        bedrock_chain = invoke_bedrock_lambda.next(invoke_comprehend_health_lambda).next(succeed_job)
-        chain = submit_transcribe_job.next(wait_job)\
-            .next(check_transcription_status)\
-            .next(sfn.Choice(self, "Transcription Complete?")\
-                .when(sfn.Condition.string_equals("$.Outputs.TranscriptionOutput.TranscriptionJobStatus", "COMPLETED"), bedrock_chain)\
-                .when(sfn.Condition.string_equals("$.Outputs.TranscriptionOutput.TranscriptionJobStatus", "FAILED"), fail_job)\
-                .otherwise(wait_job))
+        if entity_detection_mode == 'parallel':
+            detect_transcript_entities = sfn.Pass(
+                self, "Use Transcript For Entities",
+                result=sfn.Result.from_string("transcript"),
+                result_path="$.EntitySource"
+            ).next(tasks.LambdaInvoke(
+                self, "Detect Entities In Transcript",
+                lambda_function=comprehend_health_lambda,
+                output_path="$.Payload"
+            ))
+            # merge the branch outputs back into one event
+            summarize_and_detect_entities = sfn.Parallel(
+                self, "Summarize And Detect Entities",
+                result_selector={
+                    "ExecutionInput": sfn.JsonPath.object_at("$[0].ExecutionInput"),
+                    "Outputs": {
+                        "TranscriptionOutput": sfn.JsonPath.object_at("$[0].Outputs.TranscriptionOutput"),
+                        "BedrockOutput": sfn.JsonPath.object_at("$[0].Outputs.BedrockOutput"),
+                        "ComprehendMedicalOutput": sfn.JsonPath.object_at("$[1].Outputs.ComprehendMedicalOutput")
+                    }
+                }
+            ).branch(invoke_bedrock_lambda).branch(detect_transcript_entities)
+            bedrock_chain = summarize_and_detect_entities
+            if entity_summary_pass:
+                bedrock_chain = bedrock_chain.next(sfn.Pass(
+                    self, "Use Summary For Entities",
+                    result=sfn.Result.from_string("summary"),
+                    result_path="$.EntitySource"
+                )).next(invoke_comprehend_health_lambda)
+            bedrock_chain = bedrock_chain.next(succeed_job)
+        else:
+            bedrock_chain = invoke_bedrock_lambda.next(invoke_comprehend_health_lambda).next(succeed_job)
+        transcription_complete = sfn.Choice(self, "Transcription Complete?")\
+            .when(sfn.Condition.string_equals("$.Outputs.TranscriptionOutput.TranscriptionJobStatus", "COMPLETED"), bedrock_chain)\
+            .when(sfn.Condition.string_equals("$.Outputs.TranscriptionOutput.TranscriptionJobStatus", "FAILED"), fail_job)\
+            .otherwise(wait_job)
+        polling_chain = wait_job.next(check_transcription_status).next(transcription_complete)
+
+        if transcription_completion_mode == 'callback':
+            # fall back to polling when no transcript arrives before the callback times out,
+            # checking at once since the callback already waited
+            wait_for_transcript.add_catch(check_transcription_status, errors=[sfn.Errors.TIMEOUT], result_path=sfn.JsonPath.DISCARD)
+            chain = submit_transcribe_job.next(wait_for_transcript).next(transcription_complete)
+        else:
+            chain = submit_transcribe_job.next(polling_chain)
 
         state_machine = sfn.StateMachine(
             self, "StateMachine",
             definition_body=sfn.DefinitionBody.from_chainable(chain),
-            timeout=Duration.minutes(5)
+            timeout=Duration.minutes(state_machine_timeout)
         )
 
         # Create API Lambda function 
@@ -150,21 +262,39 @@ class ChartAutomationCdkStack(Stack):
              handler="main.lambda_handler",
              runtime=lambda_.Runtime.PYTHON_3_9,
              code=lambda_.Code.from_asset("lambda/api"),
+             timeout=Duration.seconds(29),
              environment={
-                "STATE_MACHINE_ARN": state_machine.state_machine_arn
+                "STATE_MACHINE_ARN": state_machine.state_machine_arn,
+                "BATCH_MAX_WORKERS": "10",
+                "UPLOAD_BUCKET": self.s3_bucket.bucket_name
             }
         )
         # add step functions permission to api lambda role policy
         state_machine.grant_start_execution(api_lambda)
+        state_machine.grant_read(api_lambda)
+        # read access lets the api lambda hash submitted audio for idempotent submission, and
+        # write access lets it start, presign and complete direct multipart uploads of audio
+        self.s3_bucket.grant_read(api_lambda)
+        self.s3_bucket.grant_put(api_lambda, "audio_conversations/*")
 
         # Create API Gateway
+        # every route returns or starts work on patient conversations, so callers must sign
+        # their requests with credentials allowed to invoke the API, like the frontend task role
         self.api = apigw.LambdaRestApi(
             self, 
             "ChartAutomationAPI",
-            handler=api_lambda
+            handler=api_lambda,
+            default_method_options=apigw.MethodOptions(authorization_type=apigw.AuthorizationType.IAM)
         )
         api_endpoint = self.api.root.add_resource("api")
         api_endpoint.add_method("POST")
+        api_endpoint.add_resource("batch").add_method("POST")
+        api_endpoint.add_resource("health").add_method("GET")
+        api_endpoint.add_resource("{execution}").add_method("GET")
+        uploads_endpoint = api_endpoint.add_resource("uploads")
+        uploads_endpoint.add_method("POST")
+        uploads_endpoint.add_resource("complete").add_method("POST")
+        uploads_endpoint.add_resource("abort").add_method("POST")
 
         CfnOutput(self, "API Endpoint", value=self.api.url)
         CfnOutput(self, "S3 Bucket", value=self.s3_bucket.bucket_name)
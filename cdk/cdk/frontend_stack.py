@@ -74,7 +74,11 @@ class ChartAutomationFrontendStack(Stack):
             environment={
                 'BucketName': s3_bucket.bucket_name,
                 'LLMAppAPIEndpoint': api.url,
-                'BedrockRegion': self.region
+                'BedrockRegion': self.region,
+                # share patient education by condition across tasks, under cache/ in the bucket
+                'EDUCATION_CACHE_S3': 'true',
+                # upload audio in parallel parts to presigned URLs from the API instead of through boto3
+                'UPLOAD_MODE': 'presigned'
             }
         )
         app_container.add_port_mappings(ecs.PortMapping(container_port=8501, protocol=ecs.Protocol.TCP))
@@ -88,6 +92,15 @@ class ChartAutomationFrontendStack(Stack):
             )
         )
 
+        # Add policy to call the IAM authorized analysis API
+        task_definition.add_to_task_role_policy(
+            iam.PolicyStatement(
+                effect=iam.Effect.ALLOW,
+                actions=["execute-api:Invoke"],
+                resources=[api.arn_for_execute_api()]
+            )
+        )
+
         # Add policy to get step function execution status
         task_definition.add_to_task_role_policy(
             iam.PolicyStatement(
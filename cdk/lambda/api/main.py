@@ -1,14 +1,113 @@
 import boto3
-from botocore.exceptions import ClientError
+from botocore.config import Config
+from botocore.exceptions import (
+    ClientError, HTTPClientError, ConnectionError as EndpointError, ConnectTimeoutError, EndpointConnectionError
+)
+from concurrent.futures import ThreadPoolExecutor
 import logging
 import os
 import json
+import hashlib
+import math
+import re
+import threading
+import time
+import uuid
+from urllib.parse import unquote, urlparse
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
 state_machine_arn = os.environ['STATE_MACHINE_ARN']
-input = {}
+batch_max_workers = int(os.environ.get('BATCH_MAX_WORKERS', '10'))
+batch_max_jobs = int(os.environ.get('BATCH_MAX_JOBS', '500'))
+idempotency_enabled = os.environ.get('IDEMPOTENCY_ENABLED', 'true').lower() == 'true'
+idempotency_max_attempts = int(os.environ.get('IDEMPOTENCY_MAX_ATTEMPTS', '5'))
+supported_languages = ('English',)
+result_max_wait_seconds = float(os.environ.get('RESULT_MAX_WAIT_SECONDS', '25'))
+upload_bucket = os.environ.get('UPLOAD_BUCKET')
+upload_prefix = 'audio_conversations/'
+# upload keys are the upload prefix, a uuid and the sanitized file name
+upload_key_pattern = re.compile(r'[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}-(.+)')
+upload_part_size = int(os.environ.get('UPLOAD_PART_SIZE_BYTES', str(8 * 1024 * 1024)))
+upload_url_expires_seconds = int(os.environ.get('UPLOAD_URL_EXPIRES_SECONDS', '3600'))
+# S3 limit of a multipart upload, and the largest media file Transcribe Medical accepts
+upload_max_parts = 10000
+upload_max_bytes = 2 * 1000 ** 3
+
+# AWS clients are created once per container and reused by warm invocations
+client_config = Config(
+    max_pool_connections=max(10, batch_max_workers),
+    tcp_keepalive=True,
+    retries={'mode': 'standard'}
+)
+# presigned upload URLs must be SigV4 signed for the KMS encrypted bucket
+service_client_configs = {
+    's3': client_config.merge(Config(signature_version='s3v4'))
+}
+aws_clients = {}
+aws_clients_created_at = {}
+aws_clients_lock = threading.Lock()
+
+# executions in these states never produced a result, so the same job may run again
+rerunnable_statuses = ('FAILED', 'TIMED_OUT', 'ABORTED')
+
+# C accelerated JSON string encoder, the same one json.dumps uses for str values
+encode_json_string = json.encoder.encode_basestring_ascii
+
+class JobRequest:
+    '''
+    One validated job submission. Instances are built per request and never shared,
+    so concurrent invocations cannot see each other's fields
+    '''
+
+    __slots__ = ('job_name', 'job_uri', 'output_location', 'output_prefix', 'language', 'idempotency_key')
+    fields = ('job_name', 'job_uri', 'output_location', 'output_prefix', 'language')
+
+    def __init__(self, job_name: str, job_uri: str, output_location: str, output_prefix: str,
+                 language: str, idempotency_key: str = None) -> None:
+        self.job_name = job_name
+        self.job_uri = job_uri
+        self.output_location = output_location
+        self.output_prefix = output_prefix
+        self.language = language
+        self.idempotency_key = idempotency_key
+
+    @classmethod
+    def from_dict(cls, data: dict, defaults: dict = None) -> 'JobRequest':
+        if not isinstance(data, dict):
+            raise ValueError("Job must be a JSON object")
+        if defaults:
+            data = {**defaults, **data}
+        invalid = [field for field in cls.fields if not isinstance(data.get(field), str) or not data[field]]
+        if invalid:
+            raise ValueError(f"Missing or invalid fields: {', '.join(invalid)}")
+        if not data['job_uri'].startswith('s3://'):
+            raise ValueError("job_uri must be an s3:// URI")
+        if data['language'] not in supported_languages:
+            raise ValueError(f"Unsupported language: {data['language']}")
+        idempotency_key = data.get('idempotency_key')
+        return cls(data['job_name'], data['job_uri'], data['output_location'], data['output_prefix'],
+                   data['language'], str(idempotency_key) if idempotency_key else None)
+
+    @classmethod
+    def from_body(cls, body: str) -> 'JobRequest':
+        try:
+            data = json.loads(body)
+        except (TypeError, ValueError):
+            raise ValueError("Request body must be a JSON object")
+        return cls.from_dict(data)
+
+    # Serialize the state machine input. Same output as json.dumps on the equivalent
+    # dict, built directly from the slots without creating the dict
+    def to_execution_input(self) -> str:
+        return (
+            '{"transcribe_job_name": ' + encode_json_string(self.job_name) +
+            ', "transcribe_job_uri": ' + encode_json_string(self.job_uri) +
+            ', "transcribe_job_bucket": ' + encode_json_string(self.output_location) +
+            ', "transcribe_job_output_prefix": ' + encode_json_string(self.output_prefix) +
+            ', "transcribe_job_language": ' + encode_json_string(self.language) + '}'
+        )
 
 def lambda_handler(event, context):
     logger.info(event)
@@ -20,34 +119,446 @@ def lambda_handler(event, context):
             "job_uri": "s3://chartautomationcdkstack-s3bucket07682993-10nyd5de7j6xe/speech_20230717144101316.mp3",
             "output_location": "chartautomationcdkstack-s3bucket07682993-10nyd5de7j6xe",
             "output_prefix": "audio_transcripts",
-            "language": "English"
+            "language": "English",
+            "idempotency_key": "optional, defaults to the content hash of job_uri"
         }
     }
     '''
 
-    body = json.loads(event['body'])
-    input['transcribe_job_name'] = body['job_name']
-    input['transcribe_job_uri'] = body['job_uri']
-    input['transcribe_job_bucket'] = body['output_location']
-    input['transcribe_job_output_prefix'] = body['output_prefix']
-    input['transcribe_job_language'] = body['language']
-
-    # start a step function execution
-    client = boto3.client('stepfunctions')
-    try:
-        response = client.start_execution(
-            stateMachineArn=state_machine_arn, input=json.dumps(input))
-        api_response = {
-            "isBase64Encoded": False,
-            "statusCode": 200,
-            "body":json.dumps({"sm_execution_arn": response["executionArn"]}),
-            "headers": {
-                "content-type": "application/json"
-            }
+    if event.get('resource') == '/api/batch':
+        return batch_handler(event)
+    if event.get('resource') == '/api/health':
+        return health_handler(event)
+    if event.get('resource') == '/api/{execution}':
+        return result_handler(event, context)
+    if event.get('resource') == '/api/uploads':
+        return upload_handler(event)
+    if event.get('resource') == '/api/uploads/complete':
+        return upload_complete_handler(event)
+    if event.get('resource') == '/api/uploads/abort':
+        return upload_abort_handler(event)
+
+    try:
+        job = JobRequest.from_body(event['body'])
+    except ValueError as err:
+        return api_response(400, {"errors": [{"error": str(err)}]})
+
+    # start a step function execution, or return the one already started for the same audio
+    try:
+        return api_response(200, start_job_execution(job, job_idempotency_key(job)))
+    except ClientError as err:
+        logger.error(
+            "Couldn't start state machine %s. Here's why: %s: %s", state_machine_arn,
+            err.response['Error']['Code'], err.response['Error']['Message'])
+        raise
+
+def batch_handler(event):
+
+    ''' Example batch event input format. Top level job fields are defaults for every job
+    {
+        "body": {
+            "output_location": "chartautomationcdkstack-s3bucket07682993-10nyd5de7j6xe",
+            "output_prefix": "audio_transcripts",
+            "language": "English",
+            "jobs": [
+                {"job_name": "visit-0001", "job_uri": "s3://chartautomationcdkstack-s3bucket07682993-10nyd5de7j6xe/visit-0001.mp3"},
+                {"job_name": "visit-0002", "job_uri": "s3://chartautomationcdkstack-s3bucket07682993-10nyd5de7j6xe/visit-0002.mp3"}
+            ]
         }
-        return api_response
+    }
+    '''
+
+    try:
+        body = json.loads(event['body'])
+    except (TypeError, ValueError):
+        return api_response(400, {"errors": [{"error": "Request body must be a JSON object"}]})
+
+    jobs, errors = validate_batch(body)
+    if errors:
+        return api_response(400, {"errors": errors})
+
+    results = start_executions(jobs)
+    failed = sum(1 for result in results if 'error' in result)
+    return api_response(200, {
+        "submitted": len(results) - failed,
+        "failed": failed,
+        "results": results
+    })
+
+# Function to validate every job of a batch before any execution is started
+def validate_batch(body):
+    if not isinstance(body, dict) or not isinstance(body.get('jobs'), list) or not body['jobs']:
+        return [], [{"error": "'jobs' must be a non-empty list"}]
+    if len(body['jobs']) > batch_max_jobs:
+        return [], [{"error": f"A batch accepts at most {batch_max_jobs} jobs"}]
+
+    defaults = {field: body[field] for field in JobRequest.fields if field in body}
+    jobs, errors, seen_names = [], [], set()
+    for index, data in enumerate(body['jobs']):
+        try:
+            job = JobRequest.from_dict(data, defaults)
+        except ValueError as err:
+            job_name = data.get('job_name') if isinstance(data, dict) else None
+            errors.append({"index": index, "job_name": job_name, "error": str(err)})
+            continue
+        if job.job_name in seen_names:
+            errors.append({"index": index, "job_name": job.job_name, "error": "Duplicate job_name in batch"})
+        else:
+            seen_names.add(job.job_name)
+            jobs.append(job)
+    return jobs, errors
+
+# Function to start one step function execution per job with bounded parallelism
+def start_executions(jobs):
+    max_workers = max(1, min(batch_max_workers, len(jobs)))
+
+    def start(job):
+        try:
+            result = start_job_execution(job, job_idempotency_key(job))
+            # a deduplicated job keeps its own name here and names the job whose results it gets
+            execution_job_name = result.pop('job_name', job.job_name)
+            if execution_job_name != job.job_name:
+                result['execution_job_name'] = execution_job_name
+            return {"job_name": job.job_name, **result}
+        except ClientError as err:
+            logger.error(
+                "Couldn't start state machine %s for job %s. Here's why: %s: %s", state_machine_arn,
+                job.job_name, err.response['Error']['Code'], err.response['Error']['Message'])
+            return {"job_name": job.job_name, "error": {
+                "code": err.response['Error']['Code'],
+                "message": err.response['Error']['Message']
+            }}
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return list(executor.map(start, jobs))
+
+# Function to derive the idempotency key of a job. A client supplied key wins, otherwise
+# the key is the content hash of the audio object plus the settings that shape the result
+def job_idempotency_key(job):
+    if not idempotency_enabled:
+        return None
+    if job.idempotency_key:
+        material = 'client:' + job.idempotency_key
+    else:
+        job_uri = urlparse(job.job_uri)
+        try:
+            head = call_aws('s3', 'head_object',
+                Bucket=job_uri.netloc, Key=job_uri.path.lstrip('/'), ChecksumMode='ENABLED')
+        except ClientError as err:
+            logger.warning("Couldn't read %s to deduplicate job %s: %s", job.job_uri, job.job_name, err)
+            return None
+        content_hash = head.get('ChecksumSHA256') or f"{head['ETag']}:{head['ContentLength']}"
+        material = f"s3:{content_hash}|{job.language}|{job.output_location}|{job.output_prefix}"
+    return hashlib.sha256(material.encode('utf-8')).hexdigest()
+
+# Function to start the execution of a job at most once per idempotency key. The key names
+# the execution, so step functions itself rejects a second start of the same job and the
+# existing execution is returned instead, unless it ended without a result
+def start_job_execution(job, idempotency_key):
+    execution_input = job.to_execution_input()
+    if idempotency_key is None:
+        response = call_aws('stepfunctions', 'start_execution',
+            stateMachineArn=state_machine_arn, input=execution_input)
+        return {"sm_execution_arn": response["executionArn"], "deduplicated": False}
+
+    for attempt in range(idempotency_max_attempts):
+        execution_name = f"chart-{idempotency_key[:64]}" + (f"-{attempt}" if attempt else "")
+        try:
+            response = call_aws('stepfunctions', 'start_execution',
+                stateMachineArn=state_machine_arn, name=execution_name, input=execution_input)
+            return {"sm_execution_arn": response["executionArn"], "deduplicated": False}
+        except ClientError as err:
+            if err.response['Error']['Code'] != 'ExecutionAlreadyExists':
+                raise
+        execution_arn = state_machine_arn.replace(':stateMachine:', ':execution:') + ':' + execution_name
+        execution = call_aws('stepfunctions', 'describe_execution', executionArn=execution_arn)
+        status = execution['status']
+        if status not in rerunnable_statuses:
+            # the existing execution writes its results under the job name it was started with
+            job_name = json.loads(execution.get('input') or '{}').get('transcribe_job_name', job.job_name)
+            logger.info("Job %s already submitted as %s (%s) for job %s", job.job_name, execution_arn, status, job_name)
+            return {"sm_execution_arn": execution_arn, "deduplicated": True, "status": status, "job_name": job_name}
+
+    # every named attempt has already run and failed, so start an unnamed execution
+    response = call_aws('stepfunctions', 'start_execution',
+        stateMachineArn=state_machine_arn, input=execution_input)
+    return {"sm_execution_arn": response["executionArn"], "deduplicated": False}
+
+def result_handler(event, context):
+
+    ''' Example result event input format. The execution is its URL encoded ARN or its name
+    {
+        "resource": "/api/{execution}",
+        "pathParameters": {"execution": "arn%3Aaws%3Astates%3Aus-east-1%3A123456789012%3Aexecution%3AStateMachine%3Achart-0f1e"},
+        "queryStringParameters": {"wait": "20"},
+        "headers": {"If-None-Match": "\"7d2f...\""}
+    }
+    '''
+
+    execution_prefix = state_machine_arn.replace(':stateMachine:', ':execution:') + ':'
+    execution = unquote((event.get('pathParameters') or {}).get('execution') or '')
+    execution_arn = execution if execution.startswith('arn:') else execution_prefix + execution
+    if not execution or not execution_arn.startswith(execution_prefix):
+        return api_response(404, {"errors": [{"error": "Unknown execution"}]})
+
+    query = event.get('queryStringParameters') or {}
+    try:
+        wait_seconds = float(query.get('wait', 0))
+    except ValueError:
+        wait_seconds = math.nan
+    # nan and inf pass float() but would never reach the deadline
+    if not math.isfinite(wait_seconds):
+        return api_response(400, {"errors": [{"error": "wait must be a number of seconds"}]})
+    wait_seconds = min(max(wait_seconds, 0), result_max_wait_seconds)
+    if context is not None:
+        # leave time to answer before the lambda itself times out
+        wait_seconds = min(wait_seconds, context.get_remaining_time_in_millis() / 1000 - 2)
+    headers = {key.lower(): value for key, value in (event.get('headers') or {}).items()}
+    if_none_match = headers.get('if-none-match')
+
+    # long poll until the execution finishes or changes from what the client already has
+    deadline = time.monotonic() + wait_seconds
+    poll_interval = 0.5
+    while True:
+        try:
+            execution_result = call_aws('stepfunctions', 'describe_execution', executionArn=execution_arn)
+        except ClientError as err:
+            if err.response['Error']['Code'] == 'ExecutionDoesNotExist':
+                return api_response(404, {"errors": [{"error": "Unknown execution"}]})
+            raise
+        result, etag = execution_result_body(execution_result)
+        if result['status'] != 'RUNNING' or (if_none_match and if_none_match != etag):
+            break
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            break
+        time.sleep(min(poll_interval, remaining))
+        poll_interval = min(poll_interval * 1.5, 3)
+
+    if if_none_match == etag:
+        return {"isBase64Encoded": False, "statusCode": 304, "body": "", "headers": {"etag": etag}}
+    response = api_response(200, result)
+    response['headers']['etag'] = etag
+    return response
+
+# Function to build the result body of an execution and its ETag
+def execution_result_body(execution_result):
+    result = {"sm_execution_arn": execution_result['executionArn'], "status": execution_result['status']}
+    if execution_result['status'] == 'SUCCEEDED':
+        result['output'] = json.loads(execution_result['output'])
+    elif execution_result['status'] != 'RUNNING':
+        result['error'] = execution_result.get('error')
+        result['cause'] = execution_result.get('cause')
+    digest = hashlib.sha256(
+        (result['status'] + '\n' + execution_result.get('output', '')).encode('utf-8')).hexdigest()
+    return result, f'"{digest[:32]}"'
+
+def upload_handler(event):
+
+    ''' Example upload event input format. The response holds one presigned URL per part,
+    the client PUTs each part of part_size bytes to its URL and keeps the returned ETag
+    {
+        "resource": "/api/uploads",
+        "body": {
+            "file_name": "speech_20230717144101316.mp3",
+            "size": 57671680,
+            "content_type": "audio/mpeg"
+        }
+    }
+    '''
+
+    try:
+        body = json.loads(event['body'])
+    except (TypeError, ValueError):
+        return api_response(400, {"errors": [{"error": "Request body must be a JSON object"}]})
+    if not isinstance(body, dict):
+        return api_response(400, {"errors": [{"error": "Request body must be a JSON object"}]})
+    file_name, size = body.get('file_name'), body.get('size')
+    if not isinstance(file_name, str) or not upload_file_name(file_name):
+        return api_response(400, {"errors": [{"error": "file_name must name an audio file"}]})
+    if not isinstance(size, int) or isinstance(size, bool) or not 0 < size <= upload_max_bytes:
+        return api_response(400, {"errors": [{"error": f"size must be between 1 and {upload_max_bytes} bytes"}]})
+
+    # the part size grows when UPLOAD_PART_SIZE_BYTES is too small for a long recording, so an
+    # upload never needs more parts than S3 allows
+    part_size = max(upload_part_size, math.ceil(size / upload_max_parts))
+    part_count = math.ceil(size / part_size)
+    key = f"{upload_prefix}{uuid.uuid4()}-{upload_file_name(file_name)}"
+    upload = call_aws('s3', 'create_multipart_upload', Bucket=upload_bucket, Key=key,
+        ContentType=body.get('content_type') or 'application/octet-stream')
+    parts = [
+        {"part_number": part_number, "url": get_client('s3').generate_presigned_url('upload_part',
+            Params={'Bucket': upload_bucket, 'Key': key, 'UploadId': upload['UploadId'], 'PartNumber': part_number},
+            ExpiresIn=upload_url_expires_seconds)}
+        for part_number in range(1, part_count + 1)
+    ]
+    return api_response(200, {
+        "bucket": upload_bucket,
+        "key": key,
+        "upload_id": upload['UploadId'],
+        "job_name": upload_job_name(key),
+        "part_size": part_size,
+        "expires_in": upload_url_expires_seconds,
+        "parts": parts
+    })
+
+def upload_complete_handler(event):
+
+    ''' Example upload completion event input format. The job starts once S3 has assembled the object
+    {
+        "resource": "/api/uploads/complete",
+        "body": {
+            "key": "audio_conversations/5b0f...-speech_20230717144101316.mp3",
+            "upload_id": "VXBsb2FkIElE...",
+            "parts": [{"part_number": 1, "etag": "\"a54357aff0632cce46d942af68356b38\""}],
+            "output_prefix": "audio_transcripts",
+            "language": "English"
+        }
+    }
+    '''
+
+    try:
+        body = upload_request(event)
+        parts = upload_parts(body.get('parts'))
+        key = body['key']
+        job = JobRequest.from_dict({
+            "output_prefix": "audio_transcripts",
+            **{field: body[field] for field in ('output_prefix', 'language', 'idempotency_key') if field in body},
+            "job_name": upload_job_name(key),
+            "job_uri": f"s3://{upload_bucket}/{key}",
+            "output_location": upload_bucket
+        })
+    except ValueError as err:
+        return api_response(400, {"errors": [{"error": str(err)}]})
+
+    try:
+        call_aws('s3', 'complete_multipart_upload', Bucket=upload_bucket, Key=key,
+            UploadId=body['upload_id'], MultipartUpload={'Parts': parts})
+    except ClientError as err:
+        if err.response['Error']['Code'] in ('NoSuchUpload', 'InvalidPart', 'InvalidPartOrder', 'EntityTooSmall'):
+            return api_response(400, {"errors": [{"error": err.response['Error']['Message'],
+                                                  "code": err.response['Error']['Code']}]})
+        raise
+
+    try:
+        # a deduplicated upload answers with the job name of the existing execution
+        return api_response(200, {"job_name": job.job_name, "key": key,
+                                  **start_job_execution(job, job_idempotency_key(job))})
     except ClientError as err:
         logger.error(
             "Couldn't start state machine %s. Here's why: %s: %s", state_machine_arn,
             err.response['Error']['Code'], err.response['Error']['Message'])
         raise
+
+def upload_abort_handler(event):
+    try:
+        body = upload_request(event)
+    except ValueError as err:
+        return api_response(400, {"errors": [{"error": str(err)}]})
+    try:
+        call_aws('s3', 'abort_multipart_upload', Bucket=upload_bucket, Key=body['key'], UploadId=body['upload_id'])
+    except ClientError as err:
+        if err.response['Error']['Code'] != 'NoSuchUpload':
+            raise
+    return api_response(200, {"key": body['key'], "aborted": True})
+
+# Function to parse the body of a request about an upload this API started
+def upload_request(event):
+    try:
+        body = json.loads(event['body'])
+    except (TypeError, ValueError):
+        raise ValueError("Request body must be a JSON object")
+    if not isinstance(body, dict):
+        raise ValueError("Request body must be a JSON object")
+    key, upload_id = body.get('key'), body.get('upload_id')
+    if not isinstance(upload_id, str) or not upload_id:
+        raise ValueError("upload_id is required")
+    match = None
+    if isinstance(key, str) and key.startswith(upload_prefix):
+        match = upload_key_pattern.fullmatch(key[len(upload_prefix):])
+    # the file name is checked apart from the uuid, as it was sanitized when the key was built
+    if match is None or upload_file_name(match.group(1)) != match.group(1):
+        raise ValueError("key is not an upload of this API")
+    return body
+
+# Function to validate the uploaded parts and order them for completion
+def upload_parts(parts):
+    if not isinstance(parts, list) or not parts or len(parts) > upload_max_parts:
+        raise ValueError(f"parts must list between 1 and {upload_max_parts} parts")
+    completed = {}
+    for part in parts:
+        if (not isinstance(part, dict) or not isinstance(part.get('part_number'), int)
+                or not 1 <= part['part_number'] <= upload_max_parts
+                or not isinstance(part.get('etag'), str) or not part['etag']):
+            raise ValueError("Each part needs a part_number and the etag S3 returned for it")
+        completed[part['part_number']] = part['etag']
+    return [{'PartNumber': part_number, 'ETag': completed[part_number]} for part_number in sorted(completed)]
+
+# Function to reduce a file name to the characters transcribe accepts in a job name
+def upload_file_name(file_name):
+    return re.sub(r'[^0-9A-Za-z._-]', '-', os.path.basename(file_name)).strip('.-')[:150]
+
+# Function to derive the job name of an uploaded key, the file name without its extension
+def upload_job_name(key):
+    return os.path.splitext(key.rsplit('/', 1)[-1])[0]
+
+def health_handler(event):
+    status_code, status = 200, 'ok'
+
+    # a deep check makes one cheap call so a broken client or connection is recycled here
+    query = event.get('queryStringParameters') or {}
+    if query.get('deep') == 'true':
+        try:
+            call_aws('stepfunctions', 'describe_state_machine', stateMachineArn=state_machine_arn)
+        except (ClientError, HTTPClientError, EndpointError) as err:
+            logger.error("Step functions health check failed: %s", err)
+            status_code, status = 503, 'unhealthy'
+
+    now = time.time()
+    return api_response(status_code, {
+        "status": status,
+        "clients": {
+            service_name: {"age_seconds": round(now - created_at, 3)}
+            for service_name, created_at in list(aws_clients_created_at.items())
+        }
+    })
+
+# Function to get the client of an AWS service, creating it on first use
+def get_client(service_name):
+    client = aws_clients.get(service_name)
+    if client is None:
+        with aws_clients_lock:
+            client = aws_clients.get(service_name)
+            if client is None:
+                client = aws_clients[service_name] = boto3.client(
+                    service_name, config=service_client_configs.get(service_name, client_config))
+                aws_clients_created_at[service_name] = time.time()
+    return client
+
+# Function to drop a cached client so the next call builds a fresh one
+def reset_client(service_name):
+    with aws_clients_lock:
+        aws_clients.pop(service_name, None)
+        aws_clients_created_at.pop(service_name, None)
+
+# Function to call AWS with the cached client. A failure to connect recycles the client
+# once, since the pooled connections may have gone stale. Errors after the request was
+# sent, like read timeouts, are not retried here: the call may have reached AWS, and
+# repeating a start_execution without a name would start a second execution
+def call_aws(service_name, operation_name, **kwargs):
+    try:
+        return getattr(get_client(service_name), operation_name)(**kwargs)
+    except (EndpointConnectionError, ConnectTimeoutError) as err:
+        logger.warning("%s connection failed, recreating client: %s", service_name, err)
+        reset_client(service_name)
+        return getattr(get_client(service_name), operation_name)(**kwargs)
+
+def api_response(status_code, body):
+    return {
+        "isBase64Encoded": False,
+        "statusCode": status_code,
+        "body": json.dumps(body),
+        "headers": {
+            "content-type": "application/json"
+        }
+    }
@@ -1,16 +1,57 @@
 import boto3
+from botocore.config import Config
+from botocore.exceptions import ClientError
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
 import logging
 import json
+import os
+import re
+import threading
+import time
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
+# Transcripts longer than summary_chunk_chars are summarized in chunks of speaker turns
+# on up to summary_max_workers concurrent model calls, then the chunk summaries are combined
+summary_chunk_chars = int(os.environ.get('SUMMARY_CHUNK_CHARS', '24000'))
+summary_chunk_max_tokens = int(os.environ.get('SUMMARY_CHUNK_MAX_TOKENS', '512'))
+summary_max_workers = int(os.environ.get('SUMMARY_MAX_WORKERS', '8'))
+
 session = boto3.Session()
-bedrock = session.client(service_name='bedrock-runtime', region_name='us-east-1')
+bedrock = session.client(service_name='bedrock-runtime', region_name='us-east-1',
+    config=Config(max_pool_connections=max(10, summary_max_workers)))
 s3 = session.client('s3')
 
 bedrock_model_id = "anthropic.claude-v2"
 
+# Completions are cached by a hash of the model id and request body, in memory for warm
+# containers and in S3 with a TTL when summary_cache_bucket is set
+summary_cache_size = int(os.environ.get('SUMMARY_CACHE_SIZE', '128'))
+summary_cache_bucket = os.environ.get('SUMMARY_CACHE_BUCKET')
+summary_cache_prefix = os.environ.get('SUMMARY_CACHE_PREFIX', 'cache/summaries/')
+summary_cache_ttl_seconds = int(os.environ.get('SUMMARY_CACHE_TTL_SECONDS', str(7 * 24 * 3600)))
+summary_cache = OrderedDict()
+summary_cache_stats = {'MemoryHits': 0, 'S3Hits': 0, 'Misses': 0}
+summary_cache_lock = threading.Lock()
+
+# The transcript is read with a ranged GET of the first transcript_range_bytes of the transcribe
+# output, which holds the whole transcript for most recordings. The rest of the object, with
+# the per-word items, is only streamed when the transcript is longer or the items are needed
+transcript_range_bytes = int(os.environ.get('TRANSCRIPT_RANGE_BYTES', str(256 * 1024)))
+transcript_stream_chunk_bytes = int(os.environ.get('TRANSCRIPT_STREAM_CHUNK_BYTES', str(64 * 1024)))
+transcript_pattern = re.compile(rb'"transcripts"\s*:\s*\[\s*\{\s*"transcript"\s*:\s*"')
+
+# Summaries larger than claim_check_threshold_bytes are left in S3 and the state only
+# carries a pointer to them with their size and SHA-256 digest
+claim_check_threshold_bytes = int(os.environ.get('CLAIM_CHECK_THRESHOLD_BYTES', '32768'))
+
+# Stream the summary from the model and write it to S3 as it is generated
+summary_streaming = os.environ.get('SUMMARY_STREAMING', 'true').lower() == 'true'
+partial_summary_interval_seconds = float(os.environ.get('PARTIAL_SUMMARY_INTERVAL_SECONDS', '1'))
+
 def lambda_handler(event, context):
 
     '''
@@ -24,34 +65,129 @@ def lambda_handler(event, context):
     }
     '''
     logger.info(event)
+    for stat in summary_cache_stats:
+        summary_cache_stats[stat] = 0
     
     body = event['ExecutionInput']
     language = body['transcribe_job_language']
     bucket_name = body['transcribe_job_bucket']
     s3_file_name = body['transcribe_job_output_prefix']+'/medical/'+body['transcribe_job_name']+'.json'
-    s3_file_object = s3.get_object(Bucket=bucket_name, Key=s3_file_name)
-    s3_file_content = s3_file_object['Body'].read().decode('utf-8')
-    json_obj = json.loads(s3_file_content)
-    full_transcript = json_obj['results']['transcripts'][0]['transcript']
+    transcript_object = TranscriptObject(bucket_name, s3_file_name)
+    full_transcript = transcript_object.transcript
 
     command = 'Summarize this conversation in '+language+'. Highlight the key observations and acion items in as much details possible'
-    prompt_text = full_transcript+'. '+command.lower()
+    if len(full_transcript) > summary_chunk_chars:
+        # map: summarize chunks of the conversation in parallel, reduce: summarize the summaries
+        chunks = chunk_turns(speaker_turns(transcript_object.results()), summary_chunk_chars)
+        chunk_summaries = summarize_chunks(chunks, language)
+        prompt_text = reduce_prompt(chunk_summaries, command)
+    else:
+        transcript_object.close()
+        prompt_text = full_transcript+'. '+command.lower()
 
-    transcript_summarization = call_bedrock_model(prompt_text)
-    result = transcript_summarization.replace("$","\$")
+    summary_key = body['transcribe_job_output_prefix']+'/summaries/'+body['transcribe_job_name']+'.txt'
+    if summary_streaming:
+        partial_summary = PartialSummaryWriter(bucket_name, summary_key)
+        transcript_summarization = stream_bedrock_model(prompt_text, partial_summary.update)
+        partial_summary.complete(transcript_summarization)
+    else:
+        transcript_summarization = call_bedrock_model(prompt_text)
+    result = transcript_summarization.replace("$","\\$")
 
     event['Outputs']['BedrockOutput'] = {}
-    event['Outputs']['BedrockOutput']['bedrock_model_result'] = result
+    result_bytes = result.encode('utf-8')
+    if len(result_bytes) > claim_check_threshold_bytes:
+        # a streamed summary is already complete at summary_key
+        if not summary_streaming:
+            PartialSummaryWriter(bucket_name, summary_key).complete(transcript_summarization)
+        event['Outputs']['BedrockOutput']['bedrock_model_result_ref'] = artifact_ref(bucket_name, summary_key, result_bytes)
+    else:
+        event['Outputs']['BedrockOutput']['bedrock_model_result'] = result
 
+    emit_summary_cache_metrics()
     return event
 
-def call_bedrock_model(prompt_text, max_tokens_to_sample=1024):
+# Function to rebuild the speaker turns of a conversation from the transcribe medical items
+# and speaker labels, e.g. "spk_0: How are you feeling today?"
+def speaker_turns(results):
+    segments = (results.get('speaker_labels') or {}).get('segments')
+    if not segments or not results.get('items'):
+        return [sentence for sentence in re.split(r'(?<=[.!?])\s+', results['transcripts'][0]['transcript']) if sentence]
+
+    speakers = {}
+    for segment in segments:
+        for item in segment.get('items', []):
+            speakers[item['start_time']] = item['speaker_label']
+
+    turns, speaker, words = [], None, []
+    for item in results['items']:
+        content = item['alternatives'][0]['content']
+        if item['type'] == 'punctuation':
+            if words:
+                words[-1] += content
+            continue
+        item_speaker = speakers.get(item.get('start_time'), speaker)
+        if item_speaker != speaker and words:
+            turns.append(f"{speaker}: {' '.join(words)}")
+            words = []
+        speaker = item_speaker
+        words.append(content)
+    if words:
+        turns.append(f"{speaker}: {' '.join(words)}")
+    return turns
+
+# Function to pack consecutive turns into chunks of at most max_chars. A longer turn is cut on words
+def chunk_turns(turns, max_chars):
+    chunks, chunk, chunk_length = [], [], 0
+    for turn in turns:
+        while len(turn) > max_chars:
+            cut = turn.rfind(' ', 0, max_chars)
+            cut = cut if cut > 0 else max_chars
+            piece, turn = turn[:cut], turn[cut:].lstrip()
+            if chunk:
+                chunks.append('\n'.join(chunk))
+                chunk, chunk_length = [], 0
+            chunks.append(piece)
+        if chunk and chunk_length + len(turn) + 1 > max_chars:
+            chunks.append('\n'.join(chunk))
+            chunk, chunk_length = [], 0
+        chunk.append(turn)
+        chunk_length += len(turn) + 1
+    if chunk:
+        chunks.append('\n'.join(chunk))
+    return chunks
+
+# Function to summarize every chunk of the conversation, in order, with bounded parallelism
+def summarize_chunks(chunks, language):
+    def summarize(numbered_chunk):
+        number, chunk = numbered_chunk
+        prompt_text = (f"{chunk}\n\nThis is part {number} of {len(chunks)} of a conversation between a patient "
+            f"and a medical provider. Summarize this part in {language}. Keep every observation, symptom, "
+            "diagnosis, medication and action item")
+        return call_bedrock_model(prompt_text, max_tokens_to_sample=summary_chunk_max_tokens)
+
+    with ThreadPoolExecutor(max_workers=max(1, min(summary_max_workers, len(chunks)))) as executor:
+        return list(executor.map(summarize, enumerate(chunks, start=1)))
+
+def reduce_prompt(chunk_summaries, command):
+    parts = [f"Summary of part {number} of the conversation:\n{summary.strip()}"
+        for number, summary in enumerate(chunk_summaries, start=1)]
+    return '\n\n'.join(parts)+'\n\nThese are summaries of consecutive parts of one conversation. '+command.lower()
+
+def bedrock_request_body(prompt_text, max_tokens_to_sample):
     body = {
         "prompt": f"\n\nHuman: {prompt_text}\n\nAssistant:",
         "max_tokens_to_sample": max_tokens_to_sample
     }
     body_string = json.dumps(body)
-    body = bytes(body_string, 'utf-8')
+    return bytes(body_string, 'utf-8')
+
+def call_bedrock_model(prompt_text, max_tokens_to_sample=1024):
+    body = bedrock_request_body(prompt_text, max_tokens_to_sample)
+    cache_key = summary_cache_key(body)
+    result_text = summary_cache_get(cache_key)
+    if result_text is not None:
+        return result_text
     response = bedrock.invoke_model(
         modelId = bedrock_model_id,
         contentType = "application/json",
@@ -61,5 +197,209 @@ def call_bedrock_model(prompt_text, max_tokens_to_sample=1024):
     json_str = response_lines[0].decode('utf-8')
     json_obj = json.loads(json_str)
     result_text = json_obj['completion']
+    summary_cache_put(cache_key, result_text)
+    return result_text
+
+# Function to call the bedrock model with a streamed response. The response body is decoded
+# by botocore's EventStream as chunks arrive, and on_partial gets the completion so far
+def stream_bedrock_model(prompt_text, on_partial=None, max_tokens_to_sample=1024):
+    body = bedrock_request_body(prompt_text, max_tokens_to_sample)
+    cache_key = summary_cache_key(body)
+    result_text = summary_cache_get(cache_key)
+    if result_text is not None:
+        if on_partial is not None:
+            on_partial(result_text)
+        return result_text
+    response = bedrock.invoke_model_with_response_stream(
+        modelId = bedrock_model_id,
+        contentType = "application/json",
+        accept = "application/json",
+        body = body)
+    result_text = ''
+    for event in response['body']:
+        if 'chunk' not in event:
+            continue
+        result_text += json.loads(event['chunk']['bytes'])['completion']
+        if on_partial is not None:
+            on_partial(result_text)
+    summary_cache_put(cache_key, result_text)
+    return result_text
+
+# Function to get the cache key of a model request. The body holds the prompt, the token
+# limit and every other inference parameter
+def summary_cache_key(body):
+    return hashlib.sha256(bedrock_model_id.encode('utf-8') + b'\n' + body).hexdigest()
+
+# Function to look a completion up in memory, then in S3
+def summary_cache_get(cache_key):
+    with summary_cache_lock:
+        if cache_key in summary_cache:
+            summary_cache.move_to_end(cache_key)
+            summary_cache_stats['MemoryHits'] += 1
+            return summary_cache[cache_key]
+
+    result_text = None
+    if summary_cache_bucket:
+        try:
+            cached = json.loads(s3.get_object(Bucket=summary_cache_bucket, Key=summary_cache_prefix+cache_key+'.json')['Body'].read())
+            if cached['expires_at'] > time.time():
+                result_text = cached['completion']
+        except ClientError as err:
+            if err.response['Error']['Code'] != 'NoSuchKey':
+                logger.warning("Couldn't read summary cache entry %s: %s", cache_key, err)
+
+    with summary_cache_lock:
+        if result_text is None:
+            summary_cache_stats['Misses'] += 1
+            return None
+        summary_cache_stats['S3Hits'] += 1
+    summary_cache_remember(cache_key, result_text)
     return result_text
 
+# Function to store a completion in memory and in S3
+def summary_cache_put(cache_key, result_text):
+    summary_cache_remember(cache_key, result_text)
+    if summary_cache_bucket:
+        try:
+            s3.put_object(
+                Bucket=summary_cache_bucket,
+                Key=summary_cache_prefix+cache_key+'.json',
+                Body=json.dumps({"completion": result_text, "expires_at": time.time() + summary_cache_ttl_seconds}),
+                ContentType='application/json'
+            )
+        except ClientError as err:
+            logger.warning("Couldn't write summary cache entry %s: %s", cache_key, err)
+
+def summary_cache_remember(cache_key, result_text):
+    with summary_cache_lock:
+        summary_cache[cache_key] = result_text
+        summary_cache.move_to_end(cache_key)
+        while len(summary_cache) > summary_cache_size:
+            summary_cache.popitem(last=False)
+
+# Function to emit the cache hits and misses of this invocation as CloudWatch embedded metrics
+def emit_summary_cache_metrics():
+    print(json.dumps({
+        "_aws": {
+            "Timestamp": int(time.time() * 1000),
+            "CloudWatchMetrics": [{
+                "Namespace": "ChartAutomation",
+                "Dimensions": [["Cache"]],
+                "Metrics": [{"Name": stat, "Unit": "Count"} for stat in summary_cache_stats]
+            }]
+        },
+        "Cache": "summary",
+        **summary_cache_stats
+    }))
+
+# Function to build the pointer to an artifact stored in S3 that travels in the state instead of it
+def artifact_ref(bucket, key, data):
+    return {"bucket": bucket, "key": key, "size": len(data), "sha256": hashlib.sha256(data).hexdigest()}
+
+class TranscriptObject:
+    '''
+    Reads a transcribe medical output document from S3. The transcript string is scanned for
+    in the raw bytes as they arrive, so the per-word items after it are not downloaded or
+    parsed unless results() is called
+    '''
+
+    def __init__(self, bucket, key):
+        self.bucket = bucket
+        self.key = key
+        self.data = bytearray()
+        self.size = None
+        self.body = None
+        self.chunks = None
+        self.transcript = self.read_transcript()
+
+    def read_transcript(self):
+        response = s3.get_object(Bucket=self.bucket, Key=self.key, Range=f'bytes=0-{transcript_range_bytes - 1}')
+        self.data += response['Body'].read()
+        # ContentRange is "bytes 0-262143/<object size>", and S3 returns the whole object without it
+        self.size = int(response.get('ContentRange', '').rpartition('/')[2] or len(self.data))
+
+        start, scanned = None, 0
+        while True:
+            if start is None:
+                match = transcript_pattern.search(self.data, max(0, scanned - 64))
+                if match:
+                    start = scanned = match.end()
+            if start is not None:
+                end = closing_quote(self.data, scanned)
+                if end >= 0:
+                    return json.decoder.scanstring(self.data[start:end + 1].decode('utf-8'), 0)[0]
+            scanned = len(self.data)
+            if not self.read_more():
+                break
+        logger.warning("No transcript found by scanning %s, parsing the whole document", self.key)
+        return self.results()['transcripts'][0]['transcript']
+
+    def read_more(self):
+        if len(self.data) >= self.size:
+            return False
+        if self.body is None:
+            self.body = s3.get_object(Bucket=self.bucket, Key=self.key, Range=f'bytes={len(self.data)}-')['Body']
+            self.chunks = self.body.iter_chunks(transcript_stream_chunk_bytes)
+        chunk = next(self.chunks, b'')
+        if not chunk:
+            self.size = len(self.data)
+            return False
+        self.data += chunk
+        return True
+
+    def results(self):
+        while self.read_more():
+            pass
+        return json.loads(self.data)['results']
+
+    def close(self):
+        # stop the download of the rest of the object
+        if self.body is not None:
+            self.body.close()
+            self.body = None
+
+# Function to find the quote that ends a JSON string, skipping escaped quotes. Returns -1 when
+# the string continues past the data read so far
+def closing_quote(data, start):
+    end = data.find(b'"', start)
+    while end >= 0:
+        backslashes = 0
+        while data[end - backslashes - 1] == 0x5c:
+            backslashes += 1
+        if backslashes % 2 == 0:
+            return end
+        end = data.find(b'"', end + 1)
+    return -1
+
+class PartialSummaryWriter:
+    '''
+    Writes the summary to S3 while it is generated, at most once per interval, so the
+    frontend can show it before the workflow finishes. The summary-status metadata is
+    partial until the complete summary is written
+    '''
+
+    def __init__(self, bucket, key, interval_seconds=None):
+        self.bucket = bucket
+        self.key = key
+        self.interval_seconds = partial_summary_interval_seconds if interval_seconds is None else interval_seconds
+        self.last_write = None
+        self.written_length = 0
+
+    def update(self, text):
+        now = time.monotonic()
+        if len(text) > self.written_length and (self.last_write is None or now - self.last_write >= self.interval_seconds):
+            self.write(text, 'partial')
+            self.last_write = now
+
+    def complete(self, text):
+        self.write(text, 'complete')
+
+    def write(self, text, status):
+        s3.put_object(
+            Bucket=self.bucket,
+            Key=self.key,
+            Body=text.replace("$","\\$").encode('utf-8'),
+            ContentType='text/plain; charset=utf-8',
+            Metadata={'summary-status': status}
+        )
+        self.written_length = len(text)
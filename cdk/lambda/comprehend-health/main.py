@@ -1,9 +1,61 @@
+import bisect
 import boto3
+from botocore.config import Config
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import json
 import logging
+import os
+import random
+import re
+import threading
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
+# Entity lists larger than claim_check_threshold_bytes are left in S3 and the state only
+# carries a pointer to them with their size and SHA-256 digest
+claim_check_threshold_bytes = int(os.environ.get('CLAIM_CHECK_THRESHOLD_BYTES', '32768'))
+
+# DetectEntitiesV2 takes up to 20,000 characters, so longer texts are split on sentence
+# boundaries into overlapping chunks that are analyzed on up to entity_max_workers calls at once
+entity_chunk_chars = int(os.environ.get('ENTITY_CHUNK_CHARS', '20000'))
+entity_chunk_overlap_chars = int(os.environ.get('ENTITY_CHUNK_OVERLAP_CHARS', '500'))
+entity_max_workers = int(os.environ.get('ENTITY_MAX_WORKERS', '4'))
+
+# Entities are cached per sentence in warm containers, keyed by a hash of the sentence, so
+# an edited summary only sends its changed sentences to Comprehend Medical
+entity_cache_size = int(os.environ.get('ENTITY_CACHE_SIZE', '10000'))
+entity_cache = OrderedDict()
+entity_cache_lock = threading.Lock()
+
+# Entities are written as entity_columns, parallel arrays with dictionary encoded categories
+# and types, or as the entities list of Comprehend Medical when this is "entities"
+entity_output_format = os.environ.get('ENTITY_OUTPUT_FORMAT', 'columnar')
+
+# The transcript is read with a ranged GET of the first transcript_range_bytes of the transcribe
+# output, and only streamed further when the transcript is longer. The per-word items after
+# it are not needed for entity detection
+transcript_range_bytes = int(os.environ.get('TRANSCRIPT_RANGE_BYTES', str(256 * 1024)))
+transcript_stream_chunk_bytes = int(os.environ.get('TRANSCRIPT_STREAM_CHUNK_BYTES', str(64 * 1024)))
+transcript_pattern = re.compile(rb'"transcripts"\s*:\s*\[\s*\{\s*"transcript"\s*:\s*"')
+
+# Share of Comprehend Medical responses logged, as one JSON line of counts without any text
+entity_log_sample_rate = float(os.environ.get('ENTITY_LOG_SAMPLE_RATE', '0.01'))
+
+s3 = boto3.client('s3')
+
+# The comprehend medical client is built on first use and kept for the life of the container,
+# with a connection pool large enough for the concurrent chunk calls
+client_config = Config(
+    max_pool_connections=max(10, entity_max_workers),
+    tcp_keepalive=True,
+    retries={'mode': 'standard'}
+)
+comprehend_client = None
+comprehend_client_lock = threading.Lock()
+
 
 def lambda_handler(event, context):
 
@@ -17,25 +69,337 @@ def lambda_handler(event, context):
         "transcribe_job_language": "transcribe_job_language",
         "bedrock_model_result": "xxxxxx"
     }
+    The summary is read from S3 when the bedrock lambda passed bedrock_model_result_ref instead.
+    EntitySource selects the text to analyze when the workflow detects entities in parallel
+    with summarization: "transcript" writes ComprehendMedicalOutput from the transcript,
+    "summary" writes ComprehendMedicalSummaryOutput from the summary
     '''
 
     logger.info(event)
-    bedrock_model_result = event['Outputs']['BedrockOutput']['bedrock_model_result']
-    entities = detect_entities(bedrock_model_result)
+    body = event['ExecutionInput']
+    entity_source = event.pop('EntitySource', None)
+    if entity_source == 'transcript':
+        transcript_key = body['transcribe_job_output_prefix']+'/medical/'+body['transcribe_job_name']+'.json'
+        transcript_object = TranscriptObject(body['transcribe_job_bucket'], transcript_key)
+        transcript_object.close()
+        document = transcript_object.transcript
+    else:
+        bedrock_output = event['Outputs']['BedrockOutput']
+        if 'bedrock_model_result_ref' in bedrock_output:
+            document = load_artifact(bedrock_output['bedrock_model_result_ref']).decode('utf-8')
+        else:
+            document = bedrock_output['bedrock_model_result']
+    entities = detect_entities(document)
 
-    event['Outputs']['ComprehendMedicalOutput'] = {}
-    event['Outputs']['ComprehendMedicalOutput']['entities'] = entities
+    if entity_source == 'summary':
+        output_name, entities_name = 'ComprehendMedicalSummaryOutput', body['transcribe_job_name']+'-summary'
+    else:
+        output_name, entities_name = 'ComprehendMedicalOutput', body['transcribe_job_name']
+    if entity_output_format == 'columnar':
+        field, entities = 'entity_columns', entity_columns(entities)
+    else:
+        field = 'entities'
+    event['Outputs'][output_name] = {}
+    entities_bytes = json.dumps(entities, separators=(',', ':')).encode('utf-8')
+    if len(entities_bytes) > claim_check_threshold_bytes:
+        entities_key = body['transcribe_job_output_prefix']+'/entities/'+entities_name+'.json'
+        s3.put_object(Bucket=body['transcribe_job_bucket'], Key=entities_key, Body=entities_bytes, ContentType='application/json')
+        event['Outputs'][output_name][field+'_ref'] = {
+            "bucket": body['transcribe_job_bucket'],
+            "key": entities_key,
+            "size": len(entities_bytes),
+            "sha256": hashlib.sha256(entities_bytes).hexdigest()
+        }
+    else:
+        event['Outputs'][output_name][field] = entities
     
     return event
 
-# Function to detect entities in a document with AWS Comprehend Medical
+# Function to read an artifact stored in S3 by an earlier step and check it against its digest
+def load_artifact(ref):
+    data = s3.get_object(Bucket=ref['bucket'], Key=ref['key'])['Body'].read()
+    if hashlib.sha256(data).hexdigest() != ref['sha256']:
+        raise ValueError(f"Artifact s3://{ref['bucket']}/{ref['key']} does not match its digest")
+    return data
+
+class TranscriptObject:
+    '''
+    Reads the transcript of a transcribe medical output document from S3. The transcript string
+    is scanned for in the raw bytes as they arrive, so the per-word items after it are not
+    downloaded or parsed
+    '''
+
+    def __init__(self, bucket, key):
+        self.bucket = bucket
+        self.key = key
+        self.data = bytearray()
+        self.size = None
+        self.body = None
+        self.chunks = None
+        self.transcript = self.read_transcript()
+
+    def read_transcript(self):
+        response = s3.get_object(Bucket=self.bucket, Key=self.key, Range=f'bytes=0-{transcript_range_bytes - 1}')
+        self.data += response['Body'].read()
+        # ContentRange is "bytes 0-262143/<object size>", and S3 returns the whole object without it
+        self.size = int(response.get('ContentRange', '').rpartition('/')[2] or len(self.data))
+
+        start, scanned = None, 0
+        while True:
+            if start is None:
+                match = transcript_pattern.search(self.data, max(0, scanned - 64))
+                if match:
+                    start = scanned = match.end()
+            if start is not None:
+                end = closing_quote(self.data, scanned)
+                if end >= 0:
+                    return json.decoder.scanstring(self.data[start:end + 1].decode('utf-8'), 0)[0]
+            scanned = len(self.data)
+            if not self.read_more():
+                break
+        logger.warning("No transcript found by scanning %s, parsing the whole document", self.key)
+        return json.loads(self.data)['results']['transcripts'][0]['transcript']
+
+    def read_more(self):
+        if len(self.data) >= self.size:
+            return False
+        if self.body is None:
+            self.body = s3.get_object(Bucket=self.bucket, Key=self.key, Range=f'bytes={len(self.data)}-')['Body']
+            self.chunks = self.body.iter_chunks(transcript_stream_chunk_bytes)
+        chunk = next(self.chunks, b'')
+        if not chunk:
+            self.size = len(self.data)
+            return False
+        self.data += chunk
+        return True
+
+    def close(self):
+        # stop the download of the rest of the object
+        if self.body is not None:
+            self.body.close()
+            self.body = None
+
+# Function to find the quote that ends a JSON string, skipping escaped quotes. Returns -1 when
+# the string continues past the data read so far
+def closing_quote(data, start):
+    end = data.find(b'"', start)
+    while end >= 0:
+        backslashes = 0
+        while data[end - backslashes - 1] == 0x5c:
+            backslashes += 1
+        if backslashes % 2 == 0:
+            return end
+        end = data.find(b'"', end + 1)
+    return -1
+
+# Function to detect entities in a document with AWS Comprehend Medical. Sentences seen
+# before take their entities from the cache, so only the runs of new or edited sentences
+# are analyzed, with their chunks on up to entity_max_workers concurrent calls
 def detect_entities(document):
-    comprehend = boto3.client(service_name='comprehendmedical')
-    try:
+    sentences = sentence_spans(document)
+    keys = [entity_cache_key(document[start:end]) for start, end in sentences]
+    cached = [entity_cache_get(key) for key in keys]
+
+    runs, run = [], None
+    for index, entities in enumerate(cached):
+        if entities is not None:
+            run = None
+        elif run is None:
+            run = [index, index]
+            runs.append(run)
+        else:
+            run[1] = index
+    logger.info("Entity cache hits for %d of %d sentences", len(sentences) - sum(last - first + 1 for first, last in runs), len(sentences))
+
+    run_chunks = []
+    for first, last in runs:
+        run_start, run_end = sentences[first][0], sentences[last][1]
+        run_chunks.append([(run_start + start, run_start + end) for start, end in
+            sentence_chunks(document[run_start:run_end], entity_chunk_chars, entity_chunk_overlap_chars)])
+    chunks = [chunk for chunks in run_chunks for chunk in chunks]
+    comprehend = get_comprehend_client()
+
+    def detect_chunk_entities(chunk):
         response = comprehend.detect_entities_v2(
-            Text=document,
+            Text=document[chunk[0]:chunk[1]],
         )
-        print(response)
-    except Exception as e:
-        raise e
-    return response['Entities']
\ No newline at end of file
+        if random.random() < entity_log_sample_rate:
+            log_entity_response(response, chunk[1] - chunk[0])
+        return response['Entities']
+
+    if len(chunks) > 1:
+        with ThreadPoolExecutor(max_workers=min(entity_max_workers, len(chunks))) as executor:
+            chunk_entities = iter(list(executor.map(detect_chunk_entities, chunks)))
+    else:
+        chunk_entities = iter([detect_chunk_entities(chunk) for chunk in chunks])
+
+    # give the entities of each run to the sentence they are in, relative to its start, and
+    # cache them. Sentences with an entity or attribute that crosses into the next one are not cached
+    groups = []
+    for (first, last), chunks in zip(runs, run_chunks):
+        entities = merge_chunk_entities(chunks, [next(chunk_entities) for _ in chunks])
+        starts = [sentences[index][0] for index in range(first, last + 1)]
+        sentence_entities = [[] for _ in starts]
+        crossing = set()
+        for entity in entities:
+            position = bisect.bisect_right(starts, entity['BeginOffset']) - 1
+            sentence_start, sentence_end = sentences[first + position]
+            sentence_entities[position].append(entity)
+            if not all(sentence_start <= span['BeginOffset'] and span['EndOffset'] <= sentence_end
+                       for span in [entity] + entity.get('Attributes', [])):
+                crossing.add(position)
+        for position, entities in enumerate(sentence_entities):
+            if position in crossing:
+                groups.append((0, entities))
+                continue
+            sentence_start = sentences[first + position][0]
+            cached[first + position] = [shift_entity(entity, -sentence_start, 0) for entity in entities]
+            entity_cache_put(keys[first + position], cached[first + position])
+
+    groups.extend((sentences[index][0], entities) for index, entities in enumerate(cached) if entities is not None)
+    return renumber_entities(groups)
+
+# Function to turn a list of entities into parallel arrays, one row per entity followed by
+# rows for its attributes, which point to the row of their entity in Parent. Category and
+# Type hold indexes into the categories and types lists
+def entity_columns(entities):
+    categories, types = {}, {}
+    columns = {"Text": [], "Category": [], "Type": [], "Score": [], "BeginOffset": [], "EndOffset": [], "Traits": [], "Parent": []}
+
+    def add_row(entity, parent):
+        columns['Text'].append(entity['Text'])
+        columns['Category'].append(categories.setdefault(entity.get('Category', ''), len(categories)))
+        columns['Type'].append(types.setdefault(entity['Type'], len(types)))
+        columns['Score'].append(round(entity['Score'], 4))
+        columns['BeginOffset'].append(entity['BeginOffset'])
+        columns['EndOffset'].append(entity['EndOffset'])
+        columns['Traits'].append([trait['Name'] for trait in entity.get('Traits', [])])
+        columns['Parent'].append(parent)
+
+    for entity in entities:
+        parent = len(columns['Text'])
+        add_row(entity, -1)
+        for attribute in entity.get('Attributes', []):
+            add_row(attribute, parent)
+    return {"categories": list(categories), "types": list(types), "columns": columns}
+
+# Function to log a Comprehend Medical response as counts, leaving out the text it was about
+def log_entity_response(response, chars):
+    categories = {}
+    for entity in response['Entities']:
+        categories[entity['Category']] = categories.get(entity['Category'], 0) + 1
+    logger.info(json.dumps({
+        "message": "DetectEntitiesV2 response",
+        "request_id": response.get('ResponseMetadata', {}).get('RequestId'),
+        "model_version": response.get('ModelVersion'),
+        "chars": chars,
+        "entities": len(response['Entities']),
+        "unmapped_attributes": len(response.get('UnmappedAttributes', [])),
+        "categories": categories
+    }))
+
+# Function to split a text into (start, end) spans of its sentences and lines, without the
+# whitespace around them
+def sentence_spans(text):
+    spans, start = [], 0
+    for end in [match.end() for match in re.finditer(r'[.!?]+\s+|\n\s*', text)] + [len(text)]:
+        sentence = text[start:end]
+        sentence_start = start + len(sentence) - len(sentence.lstrip())
+        sentence_end = start + len(sentence.rstrip())
+        if sentence_end > sentence_start:
+            spans.append((sentence_start, sentence_end))
+        start = end
+    return spans
+
+# Function to combine groups of (offset, entities) into one list ordered by position, with
+# offsets into the document and ids unique across groups
+def renumber_entities(groups):
+    merged, id_offset = [], 0
+    for offset, entities in groups:
+        merged.extend(shift_entity(entity, offset, id_offset) for entity in entities)
+        id_offset += 1 + max([entity['Id'] for entity in entities] +
+                             [attribute['Id'] for entity in entities for attribute in entity.get('Attributes', [])], default=-1)
+    merged.sort(key=lambda entity: entity['BeginOffset'])
+    return merged
+
+# Function to get the cache key of a sentence
+def entity_cache_key(sentence):
+    return hashlib.sha256(sentence.encode('utf-8')).hexdigest()
+
+# Function to look the entities of a sentence up in the cache
+def entity_cache_get(cache_key):
+    with entity_cache_lock:
+        entities = entity_cache.get(cache_key)
+        if entities is not None:
+            entity_cache.move_to_end(cache_key)
+        return entities
+
+# Function to store the entities of a sentence in the cache
+def entity_cache_put(cache_key, entities):
+    if entity_cache_size <= 0:
+        return
+    with entity_cache_lock:
+        entity_cache[cache_key] = entities
+        entity_cache.move_to_end(cache_key)
+        while len(entity_cache) > entity_cache_size:
+            entity_cache.popitem(last=False)
+
+# Function to get the comprehend medical client, creating it on first use
+def get_comprehend_client():
+    global comprehend_client
+    if comprehend_client is None:
+        with comprehend_client_lock:
+            if comprehend_client is None:
+                comprehend_client = boto3.client(service_name='comprehendmedical', config=client_config)
+    return comprehend_client
+
+# Function to split a text into (start, end) chunks of at most max_chars that end on sentence
+# boundaries where possible, each starting on a sentence about overlap_chars before the
+# previous chunk ends so entities on the boundary are seen whole
+def sentence_chunks(text, max_chars, overlap_chars):
+    if len(text) <= max_chars:
+        return [(0, len(text))]
+    boundaries = [match.end() for match in re.finditer(r'[.!?]+\s+', text)]
+    chunks, start = [], 0
+    while True:
+        if len(text) - start <= max_chars:
+            chunks.append((start, len(text)))
+            return chunks
+        end = max((boundary for boundary in boundaries if start < boundary <= start + max_chars), default=None)
+        if end is None or end - start <= overlap_chars:
+            # no sentence boundary in reach, cut at the last whitespace instead
+            end = text.rfind(' ', start + overlap_chars + 1, start + max_chars) + 1 or start + max_chars
+        chunks.append((start, end))
+        next_start = min((boundary for boundary in boundaries if end - overlap_chars <= boundary < end), default=end)
+        start = next_start if next_start > start else end
+
+# Function to merge the entities of overlapping chunks. Each chunk owns the entities that start
+# before the middle of its overlap with the next chunk, offsets are moved from the chunk to the
+# document and ids are made unique across chunks
+def merge_chunk_entities(chunks, chunk_entities):
+    merged, seen, id_offset = [], set(), 0
+    for index, ((start, end), entities) in enumerate(zip(chunks, chunk_entities)):
+        owned_from = 0 if index == 0 else (chunks[index - 1][1] + start) // 2 - start
+        owned_to = end - start if index == len(chunks) - 1 else (end + chunks[index + 1][0]) // 2 - start
+        for entity in entities:
+            if not owned_from <= entity['BeginOffset'] < owned_to:
+                continue
+            entity = shift_entity(entity, start, id_offset)
+            key = (entity['BeginOffset'], entity['EndOffset'], entity['Category'], entity['Type'])
+            if key not in seen:
+                seen.add(key)
+                merged.append(entity)
+        id_offset += 1 + max([entity['Id'] for entity in entities] +
+                             [attribute['Id'] for entity in entities for attribute in entity.get('Attributes', [])], default=-1)
+    return merged
+
+def shift_entity(entity, offset, id_offset):
+    entity = dict(entity, Id=entity['Id'] + id_offset,
+                  BeginOffset=entity['BeginOffset'] + offset, EndOffset=entity['EndOffset'] + offset)
+    if 'Attributes' in entity:
+        entity['Attributes'] = [
+            dict(attribute, Id=attribute['Id'] + id_offset,
+                 BeginOffset=attribute['BeginOffset'] + offset, EndOffset=attribute['EndOffset'] + offset)
+            for attribute in entity['Attributes']
+        ]
+    return entity
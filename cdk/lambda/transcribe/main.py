@@ -1,10 +1,36 @@
 import boto3
+from botocore.exceptions import ClientError
 import logging
+import json
+import os
+import time
+from urllib.parse import unquote_plus, urlparse
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
 client = boto3.client('transcribe')
+s3 = boto3.client('s3')
+sfn = boto3.client('stepfunctions')
+
+# The first status check comes at poll_first_check_ratio of the expected transcription time,
+# estimated from the audio length, then waits grow exponentially from poll_min_wait_seconds
+# up to poll_max_wait_seconds
+poll_first_check_ratio = float(os.environ.get('POLL_FIRST_CHECK_RATIO', '0.7'))
+poll_min_wait_seconds = int(os.environ.get('POLL_MIN_WAIT_SECONDS', '5'))
+poll_max_wait_seconds = int(os.environ.get('POLL_MAX_WAIT_SECONDS', '15'))
+poll_backoff_cap_ratio = float(os.environ.get('POLL_BACKOFF_CAP_RATIO', '0.25'))
+transcribe_realtime_factor = float(os.environ.get('TRANSCRIBE_REALTIME_FACTOR', '0.35'))
+transcribe_overhead_seconds = float(os.environ.get('TRANSCRIBE_OVERHEAD_SECONDS', '8'))
+default_expected_seconds = 30
+# In callback mode the wait for the transcript lasts the expected transcription time with
+# headroom for a low estimate, and never less than callback_min_timeout_seconds
+callback_min_timeout_seconds = int(os.environ.get('CALLBACK_MIN_TIMEOUT_SECONDS', '180'))
+callback_timeout_ratio = float(os.environ.get('CALLBACK_TIMEOUT_RATIO', '1.5'))
+callback_timeout_headroom_seconds = int(os.environ.get('CALLBACK_TIMEOUT_HEADROOM_SECONDS', '60'))
+
+# Typical bitrates in bits per second of the audio formats the frontend accepts
+audio_bitrates = {'mp3': 128000, 'mp4': 128000, 'm4a': 128000, 'wav': 256000, 'flac': 512000}
 
 def lambda_handler(event, context):
     '''
@@ -19,6 +45,12 @@ def lambda_handler(event, context):
     '''
 
     logger.info(event)
+
+    if event.get('Records') is not None:  # A transcript landed in S3, resume the execution waiting for it
+        return transcript_created(event)
+
+    if event.get('TaskToken') is not None:  # The execution waits for its transcript, park the task token
+        return register_task_token(event['TaskToken'], event['State'])
     
     if event.get('Outputs') is not None:  # Its an existing transcription job so just check status, update and return
 
@@ -27,7 +59,15 @@ def lambda_handler(event, context):
 
         # Get AWS transcribe transcription job status
         response = get_transcription_job_status(transcribe_job_name)
-        event['Outputs']['TranscriptionOutput']['TranscriptionJobStatus'] = response['MedicalTranscriptionJob']['TranscriptionJobStatus']
+        transc_out = event['Outputs']['TranscriptionOutput']
+        transc_out['TranscriptionJobStatus'] = response['MedicalTranscriptionJob']['TranscriptionJobStatus']
+
+        # Decide how long to wait before the next status check
+        transc_out['PollCount'] = transc_out.get('PollCount', 0) + 1
+        transc_out['NextWaitSeconds'] = next_wait_seconds(
+            transc_out.get('ExpectedSeconds', default_expected_seconds),
+            time.time() - transc_out.get('SubmittedAt', time.time()),
+            transc_out['PollCount'])
         
         return event
 
@@ -57,6 +97,11 @@ def lambda_handler(event, context):
         transc_out['TranscriptionJobStatus'] = response['TranscriptionJobStatus']
         transc_out['LanguageCode'] = response['LanguageCode']
         transc_out['Media'] = response['Media']
+        transc_out['SubmittedAt'] = int(time.time())
+        transc_out['ExpectedSeconds'] = expected_transcription_seconds(transcribe_job_uri)
+        transc_out['PollCount'] = 0
+        transc_out['NextWaitSeconds'] = next_wait_seconds(transc_out['ExpectedSeconds'], 0, 0)
+        transc_out['CallbackTimeoutSeconds'] = callback_timeout_seconds(transc_out['ExpectedSeconds'])
         filtered_response['Outputs']['TranscriptionOutput'] = transc_out
 
         return filtered_response
@@ -83,4 +128,91 @@ def get_transcription_job_status(job_name):
     response = client.get_medical_transcription_job(MedicalTranscriptionJobName=job_name)
     return response
 
+# Function to estimate how long transcription takes from the size and format of the audio
+def expected_transcription_seconds(job_uri):
+    media = urlparse(job_uri)
+    try:
+        head = s3.head_object(Bucket=media.netloc, Key=media.path.lstrip('/'))
+    except ClientError as err:
+        logger.warning("Couldn't read %s to estimate its length: %s", job_uri, err)
+        return default_expected_seconds
+    extension = media.path.rsplit('.', 1)[-1].lower()
+    audio_seconds = head['ContentLength'] * 8 / audio_bitrates.get(extension, audio_bitrates['mp3'])
+    return int(audio_seconds * transcribe_realtime_factor + transcribe_overhead_seconds)
+
+# Function to get the wait before the next status check. The first check comes shortly before
+# the job is expected to finish, so an overestimate does not delay it, then waits grow
+# exponentially up to a cap that scales with the expected time, so an overrunning short job is
+# not left waiting for long
+def next_wait_seconds(expected_seconds, elapsed_seconds, poll_count):
+    if poll_count == 0:
+        return int(max(expected_seconds * poll_first_check_ratio - elapsed_seconds, poll_min_wait_seconds))
+    backoff_cap = min(max(expected_seconds * poll_backoff_cap_ratio, poll_min_wait_seconds), poll_max_wait_seconds)
+    return int(min(poll_min_wait_seconds * 2 ** (poll_count - 1), backoff_cap))
+
+# Function to get how long an execution waits for its transcript before falling back to polling
+def callback_timeout_seconds(expected_seconds):
+    return max(int(expected_seconds * callback_timeout_ratio) + callback_timeout_headroom_seconds,
+               callback_min_timeout_seconds)
+
+# Function to get the S3 key that holds the task token of a job waiting for its transcript
+def task_token_key(output_prefix, job_name):
+    return f"{output_prefix}/callbacks/{job_name}.json"
+
+# Function to park the task token of an execution until its transcript is written to S3
+def register_task_token(task_token, state):
+    '''
+    Expected event input format
+    {
+        "TaskToken": "step functions task token",
+        "State": {"ExecutionInput": {...}, "Outputs": {"TranscriptionOutput": {...}}}
+    }
+    '''
+    execution_input = state['ExecutionInput']
+    job_name = execution_input['transcribe_job_name']
+    s3.put_object(
+        Bucket=execution_input['transcribe_job_bucket'],
+        Key=task_token_key(execution_input['transcribe_job_output_prefix'], job_name),
+        Body=json.dumps({"TaskToken": task_token, "State": state}),
+        ContentType='application/json'
+    )
+
+    # the transcript may have landed before the token was stored, so check once now
+    status = get_transcription_job_status(job_name)['MedicalTranscriptionJob']['TranscriptionJobStatus']
+    if status in ('COMPLETED', 'FAILED'):
+        resume_execution(execution_input['transcribe_job_bucket'],
+            task_token_key(execution_input['transcribe_job_output_prefix'], job_name), status)
+    return {}
+
+# Function to resume the executions whose transcripts were just written to S3
+def transcript_created(event):
+    for record in event['Records']:
+        bucket = record['s3']['bucket']['name']
+        key = unquote_plus(record['s3']['object']['key'])
+        output_prefix, _, file_name = key.rpartition('/medical/')
+        if not file_name.endswith('.json'):
+            continue
+        resume_execution(bucket, task_token_key(output_prefix, file_name[:-len('.json')]), 'COMPLETED')
+    return {}
+
+# Function to send the parked task token back to step functions with the job status
+def resume_execution(bucket, token_key, status):
+    try:
+        callback = json.loads(s3.get_object(Bucket=bucket, Key=token_key)['Body'].read())
+    except ClientError as err:
+        if err.response['Error']['Code'] != 'NoSuchKey':
+            raise
+        # polling mode, or the token is not stored yet and will be checked when it is
+        logger.info("No execution waiting on %s", token_key)
+        return
 
+    state = callback['State']
+    state['Outputs']['TranscriptionOutput']['TranscriptionJobStatus'] = status
+    try:
+        sfn.send_task_success(taskToken=callback['TaskToken'], output=json.dumps(state))
+    except ClientError as err:
+        if err.response['Error']['Code'] not in ('TaskTimedOut', 'TaskDoesNotExist', 'InvalidToken'):
+            raise
+        # already resumed by the other path, or timed out and fell back to polling
+        logger.info("Task token for %s is no longer valid: %s", token_key, err.response['Error']['Code'])
+    s3.delete_object(Bucket=bucket, Key=token_key)
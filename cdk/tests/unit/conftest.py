@@ -0,0 +1,26 @@
+import importlib.util
+import pathlib
+
+import pytest
+
+LAMBDA_ROOT = pathlib.Path(__file__).resolve().parents[2] / "lambda"
+
+
+@pytest.fixture
+def load_lambda(monkeypatch):
+    # Lambda handlers all live in a main.py under lambda/<name>, so load them by
+    # path under a unique module name with a clean environment for each test.
+    monkeypatch.setenv("AWS_DEFAULT_REGION", "us-east-1")
+    monkeypatch.setenv("AWS_ACCESS_KEY_ID", "testing")
+    monkeypatch.setenv("AWS_SECRET_ACCESS_KEY", "testing")
+
+    def _load(name, **env):
+        for key, value in env.items():
+            monkeypatch.setenv(key, value)
+        module_name = name.replace("-", "_") + "_main"
+        spec = importlib.util.spec_from_file_location(module_name, LAMBDA_ROOT / name / "main.py")
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        return module
+
+    return _load
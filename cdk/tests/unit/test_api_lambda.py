@@ -0,0 +1,512 @@
+import json
+import threading
+import time
+from urllib.parse import quote
+
+import pytest
+from botocore.exceptions import ClientError
+
+STATE_MACHINE_ARN = "arn:aws:states:us-east-1:123456789012:stateMachine:StateMachine"
+
+
+class FakeStepFunctions:
+    """Step functions and S3 head_object stand-in, with named executions rejected when reused."""
+
+    def __init__(self, latency=0.0, fail_jobs=()):
+        self.latency = latency
+        self.fail_jobs = set(fail_jobs)
+        # when set, each start waits for the barrier's other parties, so it only passes concurrently
+        self.barrier = None
+        self.in_flight = self.max_in_flight = 0
+        self.calls = []
+        self.executions = {}
+        self.etags = {}
+        self.uploads = {}
+        self.inputs = {}
+        self.lock = threading.Lock()
+
+    def start_execution(self, stateMachineArn, input, **kwargs):
+        with self.lock:
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            time.sleep(self.latency)
+            if self.barrier is not None:
+                self.barrier.wait(timeout=10)
+        finally:
+            with self.lock:
+                self.in_flight -= 1
+        job_name = json.loads(input)["transcribe_job_name"]
+        with self.lock:
+            self.calls.append((stateMachineArn, json.loads(input), kwargs))
+            if job_name in self.fail_jobs:
+                raise ClientError(
+                    {"Error": {"Code": "ExecutionLimitExceeded", "Message": "Too many executions"}},
+                    "StartExecution")
+            name = kwargs.get("name", job_name)
+            execution_arn = f"arn:aws:states:us-east-1:123456789012:execution:StateMachine:{name}"
+            if execution_arn in self.executions:
+                raise ClientError(
+                    {"Error": {"Code": "ExecutionAlreadyExists", "Message": "Execution already exists"}},
+                    "StartExecution")
+            self.executions[execution_arn] = "RUNNING"
+            self.inputs[execution_arn] = input
+        return {"executionArn": execution_arn}
+
+    def describe_execution(self, executionArn):
+        return {"executionArn": executionArn, "status": self.executions[executionArn], "input": self.inputs[executionArn]}
+
+    def head_object(self, Bucket, Key, **kwargs):
+        return {"ETag": self.etags.get(Key, f'"{Key}"'), "ContentLength": 1024}
+
+    def create_multipart_upload(self, Bucket, Key, **kwargs):
+        self.uploads[Key] = {"bucket": Bucket, "kwargs": kwargs, "parts": None}
+        return {"Bucket": Bucket, "Key": Key, "UploadId": f"upload-{len(self.uploads)}"}
+
+    def generate_presigned_url(self, ClientMethod, Params, ExpiresIn):
+        return (f"https://{Params['Bucket']}.s3.amazonaws.com/{Params['Key']}?uploadId={Params['UploadId']}"
+                f"&partNumber={Params['PartNumber']}&X-Amz-Expires={ExpiresIn}")
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload):
+        if Key not in self.uploads:
+            raise ClientError(
+                {"Error": {"Code": "NoSuchUpload", "Message": "The specified upload does not exist"}},
+                "CompleteMultipartUpload")
+        self.uploads[Key]["parts"] = MultipartUpload["Parts"]
+        return {"Bucket": Bucket, "Key": Key}
+
+    def abort_multipart_upload(self, Bucket, Key, UploadId):
+        self.uploads.pop(Key, None)
+
+
+@pytest.fixture
+def api(load_lambda):
+    return load_lambda("api", STATE_MACHINE_ARN=STATE_MACHINE_ARN, UPLOAD_BUCKET="bucket")
+
+
+@pytest.fixture
+def stepfunctions(api, monkeypatch):
+    client = FakeStepFunctions()
+    monkeypatch.setattr(api.boto3, "client", lambda *args, **kwargs: client)
+    return client
+
+
+def batch_event(body):
+    return {"resource": "/api/batch", "httpMethod": "POST", "body": json.dumps(body)}
+
+
+def batch_body(count, **defaults):
+    body = {"output_location": "bucket", "output_prefix": "audio_transcripts", "language": "English"}
+    body.update(defaults)
+    body["jobs"] = [{"job_name": f"visit-{i:04d}", "job_uri": f"s3://bucket/visit-{i:04d}.mp3"} for i in range(count)]
+    return body
+
+
+def test_batch_starts_one_execution_per_job_in_order(api, stepfunctions):
+    response = api.lambda_handler(batch_event(batch_body(5)), None)
+
+    assert response["statusCode"] == 200
+    body = json.loads(response["body"])
+    assert body["submitted"] == 5 and body["failed"] == 0
+    assert [result["job_name"] for result in body["results"]] == [f"visit-{i:04d}" for i in range(5)]
+    assert len({result["sm_execution_arn"] for result in body["results"]}) == 5
+    _, execution_input, _ = stepfunctions.calls[0]
+    assert execution_input["transcribe_job_bucket"] == "bucket"
+    assert execution_input["transcribe_job_language"] == "English"
+
+
+def test_batch_is_rejected_before_starting_anything_when_a_job_is_invalid(api, stepfunctions):
+    body = batch_body(3)
+    body["jobs"][1] = {"job_name": "visit-0001"}
+    body["jobs"].append({"job_name": "visit-0000", "job_uri": "s3://bucket/again.mp3"})
+
+    response = api.lambda_handler(batch_event(body), None)
+
+    assert response["statusCode"] == 400
+    errors = json.loads(response["body"])["errors"]
+    assert [error["index"] for error in errors] == [1, 3]
+    assert "job_uri" in errors[0]["error"]
+    assert stepfunctions.calls == []
+
+
+def test_batch_reports_per_job_errors(api, stepfunctions):
+    stepfunctions.fail_jobs = {"visit-0002"}
+
+    body = json.loads(api.lambda_handler(batch_event(batch_body(4)), None)["body"])
+
+    assert body["submitted"] == 3 and body["failed"] == 1
+    assert body["results"][2] == {
+        "job_name": "visit-0002",
+        "error": {"code": "ExecutionLimitExceeded", "message": "Too many executions"}
+    }
+
+
+def test_batch_submits_up_to_max_workers_jobs_at_once(api, stepfunctions):
+    api.idempotency_enabled = False
+    api.batch_max_workers = 1
+    api.lambda_handler(batch_event(batch_body(20)), None)
+    assert stepfunctions.max_in_flight == 1
+
+    # every start blocks until ten are in flight together, which sequential submission never reaches
+    api.batch_max_workers = 10
+    stepfunctions.executions.clear()
+    stepfunctions.barrier = threading.Barrier(10)
+    body = json.loads(api.lambda_handler(batch_event(batch_body(20)), None)["body"])
+
+    assert body["submitted"] == 20 and body["failed"] == 0
+    assert stepfunctions.max_in_flight == 10
+
+
+def test_stepfunctions_client_is_created_once_and_reused(api, monkeypatch):
+    created = []
+
+    def make_client(service_name, config):
+        created.append((service_name, config))
+        return FakeStepFunctions()
+
+    monkeypatch.setattr(api.boto3, "client", make_client)
+    for _ in range(3):
+        api.lambda_handler(batch_event(batch_body(4)), None)
+
+    assert sorted(service_name for service_name, _ in created) == ["s3", "stepfunctions"]
+    assert all(config.tcp_keepalive for _, config in created)
+
+
+def test_connection_failure_recycles_the_client(api, monkeypatch):
+    from botocore.exceptions import EndpointConnectionError
+
+    class BrokenStepFunctions(FakeStepFunctions):
+        def describe_state_machine(self, **kwargs):
+            raise EndpointConnectionError(endpoint_url="https://states.us-east-1.amazonaws.com")
+
+    class HealthyStepFunctions(FakeStepFunctions):
+        def describe_state_machine(self, **kwargs):
+            return {"status": "ACTIVE"}
+
+    clients = [BrokenStepFunctions(), HealthyStepFunctions()]
+    monkeypatch.setattr(api.boto3, "client", lambda *args, **kwargs: clients.pop(0))
+    event = {"resource": "/api/health", "httpMethod": "GET", "queryStringParameters": {"deep": "true"}}
+
+    response = api.lambda_handler(event, None)
+
+    assert response["statusCode"] == 200
+    assert "stepfunctions" in json.loads(response["body"])["clients"]
+    assert isinstance(api.aws_clients["stepfunctions"], HealthyStepFunctions)
+
+
+def test_read_timeout_is_not_retried_by_recycling_the_client(api, monkeypatch):
+    from botocore.exceptions import ReadTimeoutError
+
+    class SlowStepFunctions(FakeStepFunctions):
+        def start_execution(self, stateMachineArn, input, **kwargs):
+            super().start_execution(stateMachineArn, input, **kwargs)
+            # the execution started, only its response was lost
+            raise ReadTimeoutError(endpoint_url="https://states.us-east-1.amazonaws.com")
+
+    client = SlowStepFunctions()
+    built = []
+    monkeypatch.setattr(api.boto3, "client", lambda *args, **kwargs: built.append(client) or client)
+    api.idempotency_enabled = False
+
+    with pytest.raises(ReadTimeoutError):
+        api.lambda_handler(submit_event("job-1", "s3://bucket/a.mp3"), None)
+
+    assert len(client.calls) == 1 and len(built) == 1
+
+
+def submit_event(job_name, job_uri, **extra):
+    return {"httpMethod": "POST", "body": json.dumps({
+        "job_name": job_name, "job_uri": job_uri, "output_location": "bucket",
+        "output_prefix": "audio_transcripts", "language": "English", **extra
+    })}
+
+
+def test_resubmitting_the_same_audio_returns_the_existing_execution(api, stepfunctions):
+    stepfunctions.etags = {"first-upload.mp3": '"abc"', "second-upload.mp3": '"abc"'}
+
+    first = json.loads(api.lambda_handler(submit_event("job-1", "s3://bucket/first-upload.mp3"), None)["body"])
+    second = json.loads(api.lambda_handler(submit_event("job-2", "s3://bucket/second-upload.mp3"), None)["body"])
+
+    assert first["deduplicated"] is False
+    assert second == {"sm_execution_arn": first["sm_execution_arn"], "deduplicated": True, "status": "RUNNING", "job_name": "job-1"}
+    assert len(stepfunctions.executions) == 1
+
+
+def test_failed_execution_is_rerun_under_a_new_name(api, stepfunctions):
+    first = json.loads(api.lambda_handler(submit_event("job-1", "s3://bucket/a.mp3"), None)["body"])
+    stepfunctions.executions[first["sm_execution_arn"]] = "FAILED"
+
+    second = json.loads(api.lambda_handler(submit_event("job-2", "s3://bucket/a.mp3"), None)["body"])
+
+    assert second["deduplicated"] is False
+    assert second["sm_execution_arn"] == first["sm_execution_arn"] + "-1"
+
+
+def test_client_supplied_idempotency_key_takes_precedence(api, stepfunctions):
+    responses = [
+        json.loads(api.lambda_handler(submit_event(f"job-{i}", f"s3://bucket/{i}.mp3", idempotency_key="visit-42"), None)["body"])
+        for i in range(2)
+    ]
+
+    assert responses[1]["deduplicated"] is True
+    assert responses[0]["sm_execution_arn"] == responses[1]["sm_execution_arn"]
+
+
+def test_job_request_serializes_like_json_dumps(api):
+    job = api.JobRequest.from_dict({
+        "job_name": 'visit "7"', "job_uri": "s3://bucket/café\n.mp3", "output_location": "bucket",
+        "output_prefix": "audio_transcripts", "language": "English"
+    })
+
+    assert job.to_execution_input() == json.dumps({
+        "transcribe_job_name": 'visit "7"',
+        "transcribe_job_uri": "s3://bucket/café\n.mp3",
+        "transcribe_job_bucket": "bucket",
+        "transcribe_job_output_prefix": "audio_transcripts",
+        "transcribe_job_language": "English"
+    })
+    with pytest.raises(AttributeError):
+        job.extra = "slots only"
+
+
+def test_invalid_request_is_rejected_without_reusing_previous_fields(api, stepfunctions):
+    api.lambda_handler(submit_event("job-1", "s3://bucket/a.mp3"), None)
+
+    response = api.lambda_handler({"body": json.dumps({"job_name": "job-2"})}, None)
+
+    assert response["statusCode"] == 400
+    assert "job_uri" in json.loads(response["body"])["errors"][0]["error"]
+    assert len(stepfunctions.calls) == 1
+
+
+def test_concurrent_requests_keep_their_own_fields(api, stepfunctions):
+    from concurrent.futures import ThreadPoolExecutor
+
+    stepfunctions.latency = 0.001
+    events = [submit_event(f"job-{i}", f"s3://bucket/{i}.mp3") for i in range(50)]
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        list(executor.map(lambda event: api.lambda_handler(event, None), events))
+
+    assert sorted(call[1]["transcribe_job_uri"] for call in stepfunctions.calls) == \
+        sorted(f"s3://bucket/{i}.mp3" for i in range(50))
+    assert all(call[1]["transcribe_job_name"] == "job-" + call[1]["transcribe_job_uri"][12:-4]
+               for call in stepfunctions.calls)
+
+
+class FakeContext:
+    def get_remaining_time_in_millis(self):
+        return 29000
+
+
+def result_event(execution, wait=None, etag=None):
+    return {
+        "resource": "/api/{execution}", "httpMethod": "GET",
+        "pathParameters": {"execution": quote(execution, safe="")},
+        "queryStringParameters": {"wait": str(wait)} if wait is not None else None,
+        "headers": {"If-None-Match": etag} if etag else {}
+    }
+
+
+class FakeClock:
+    """Stands in for the time module of the api lambda, so long polls wait without sleeping."""
+
+    def __init__(self):
+        self.now = 0.0
+        self.sleeps = []
+
+    def monotonic(self):
+        return self.now
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+@pytest.fixture
+def clock(api, monkeypatch):
+    fake = FakeClock()
+    monkeypatch.setattr(api, "time", fake)
+    return fake
+
+
+@pytest.fixture
+def running_execution(api, stepfunctions):
+    arn = json.loads(api.lambda_handler(submit_event("job-1", "s3://bucket/a.mp3"), None)["body"])["sm_execution_arn"]
+    output = json.dumps({"Outputs": {"BedrockOutput": {"bedrock_model_result": "summary"}}})
+    stepfunctions.describe_calls = 0
+
+    def describe_execution(executionArn):
+        stepfunctions.describe_calls += 1
+        if stepfunctions.describe_calls == stepfunctions.__dict__.get("succeed_on_describe"):
+            stepfunctions.executions[executionArn] = "SUCCEEDED"
+        return {
+            "executionArn": executionArn, "status": stepfunctions.executions[executionArn],
+            **({"output": output} if stepfunctions.executions[executionArn] == "SUCCEEDED" else {})
+        }
+
+    stepfunctions.describe_execution = describe_execution
+    return arn
+
+
+def test_result_long_poll_returns_as_soon_as_the_execution_completes(api, stepfunctions, running_execution, clock):
+    stepfunctions.succeed_on_describe = 3
+
+    response = api.lambda_handler(result_event(running_execution, wait=10), FakeContext())
+
+    body = json.loads(response["body"])
+    assert body["status"] == "SUCCEEDED"
+    assert body["output"]["Outputs"]["BedrockOutput"]["bedrock_model_result"] == "summary"
+    assert stepfunctions.describe_calls == 3
+    assert len(clock.sleeps) == 2 and clock.now < 10
+
+
+def test_result_with_matching_etag_is_not_modified(api, stepfunctions, running_execution):
+    stepfunctions.executions[running_execution] = "SUCCEEDED"
+    name = running_execution.rsplit(":", 1)[1]
+    first = api.lambda_handler(result_event(name), FakeContext())
+
+    second = api.lambda_handler(result_event(name, etag=first["headers"]["etag"]), FakeContext())
+
+    assert first["statusCode"] == 200
+    assert second["statusCode"] == 304 and second["body"] == ""
+
+
+def test_result_of_running_execution_times_out_with_running_status(api, running_execution, clock):
+    response = api.lambda_handler(result_event(running_execution, wait=5), FakeContext())
+
+    assert response["statusCode"] == 200
+    assert json.loads(response["body"])["status"] == "RUNNING"
+    assert clock.now == pytest.approx(5)
+
+
+@pytest.mark.parametrize("wait", ["nan", "inf", "-inf", "soon"])
+def test_result_rejects_waits_that_are_not_finite_numbers(api, stepfunctions, running_execution, wait):
+    describe_calls = []
+    stepfunctions.describe_execution = lambda executionArn: describe_calls.append(executionArn)
+
+    response = api.lambda_handler(result_event(running_execution, wait=wait), None)
+
+    assert response["statusCode"] == 400
+    assert json.loads(response["body"])["errors"] == [{"error": "wait must be a number of seconds"}]
+    assert describe_calls == []
+
+
+def test_result_rejects_executions_of_other_state_machines(api, stepfunctions):
+    other = "arn:aws:states:us-east-1:123456789012:execution:OtherMachine:job-1"
+
+    assert api.lambda_handler(result_event(other), FakeContext())["statusCode"] == 404
+
+
+def upload_event(resource, body):
+    return {"resource": resource, "httpMethod": "POST", "body": json.dumps(body)}
+
+
+def test_upload_presigns_one_url_per_part(api, stepfunctions):
+    response = api.lambda_handler(upload_event("/api/uploads", {
+        "file_name": "consult 1.mp3", "size": 20 * 1024 * 1024, "content_type": "audio/mpeg"}), None)
+
+    assert response["statusCode"] == 200
+    body = json.loads(response["body"])
+    assert body["key"].startswith("audio_conversations/") and body["key"].endswith("-consult-1.mp3")
+    assert body["job_name"] == body["key"][len("audio_conversations/"):-len(".mp3")]
+    assert body["part_size"] == 8 * 1024 * 1024
+    assert [part["part_number"] for part in body["parts"]] == [1, 2, 3]
+    assert f"uploadId={body['upload_id']}&partNumber=3" in body["parts"][2]["url"]
+    assert stepfunctions.uploads[body["key"]]["kwargs"] == {"ContentType": "audio/mpeg"}
+
+
+def test_upload_part_size_grows_to_stay_within_the_part_limit(api, stepfunctions, monkeypatch):
+    monkeypatch.setattr(api, "upload_part_size", 64 * 1024)
+    size = api.upload_max_bytes
+    body = json.loads(api.lambda_handler(upload_event("/api/uploads", {"file_name": "a.mp3", "size": size}), None)["body"])
+
+    assert body["part_size"] * 10000 >= size
+    assert len(body["parts"]) <= 10000
+
+
+def test_upload_rejects_files_transcribe_cannot_take(api, stepfunctions):
+    response = api.lambda_handler(upload_event("/api/uploads", {"file_name": "a.mp3", "size": 2 * 1000 ** 3 + 1}), None)
+
+    assert response["statusCode"] == 400
+    assert stepfunctions.uploads == {}
+
+
+def test_upload_rejects_invalid_size(api, stepfunctions):
+    response = api.lambda_handler(upload_event("/api/uploads", {"file_name": "a.mp3", "size": 0}), None)
+
+    assert response["statusCode"] == 400
+    assert stepfunctions.uploads == {}
+
+
+def test_completed_upload_starts_the_job(api, stepfunctions):
+    upload = json.loads(api.lambda_handler(upload_event("/api/uploads", {"file_name": "a.mp3", "size": 100}), None)["body"])
+
+    response = api.lambda_handler(upload_event("/api/uploads/complete", {
+        "key": upload["key"], "upload_id": upload["upload_id"], "language": "English",
+        "parts": [{"part_number": 2, "etag": '"b"'}, {"part_number": 1, "etag": '"a"'}]}), None)
+
+    assert response["statusCode"] == 200
+    body = json.loads(response["body"])
+    assert body["job_name"] == upload["job_name"] and body["deduplicated"] is False
+    assert stepfunctions.uploads[upload["key"]]["parts"] == [{"PartNumber": 1, "ETag": '"a"'}, {"PartNumber": 2, "ETag": '"b"'}]
+    _, execution_input, _ = stepfunctions.calls[0]
+    assert execution_input["transcribe_job_uri"] == f"s3://bucket/{upload['key']}"
+    assert execution_input["transcribe_job_output_prefix"] == "audio_transcripts"
+
+
+def test_upload_of_a_long_file_name_completes(api, stepfunctions):
+    file_name = "consult-" + "x" * 150 + ".mp3"
+    upload = json.loads(api.lambda_handler(upload_event("/api/uploads", {"file_name": file_name, "size": 100}), None)["body"])
+
+    response = api.lambda_handler(upload_event("/api/uploads/complete", {
+        "key": upload["key"], "upload_id": upload["upload_id"], "language": "English",
+        "parts": [{"part_number": 1, "etag": '"a"'}]}), None)
+
+    assert response["statusCode"] == 200
+    assert json.loads(response["body"])["job_name"] == upload["job_name"]
+
+
+def test_complete_rejects_keys_outside_the_upload_prefix(api, stepfunctions):
+    response = api.lambda_handler(upload_event("/api/uploads/complete", {
+        "key": "audio_transcripts/summaries/x.txt", "upload_id": "upload-1", "language": "English",
+        "parts": [{"part_number": 1, "etag": '"a"'}]}), None)
+
+    assert response["statusCode"] == 400
+    assert stepfunctions.calls == []
+
+
+def test_complete_of_unknown_upload_starts_nothing(api, stepfunctions):
+    response = api.lambda_handler(upload_event("/api/uploads/complete", {
+        "key": "audio_conversations/00000000-0000-0000-0000-000000000000-a.mp3", "upload_id": "upload-1", "language": "English",
+        "parts": [{"part_number": 1, "etag": '"a"'}]}), None)
+
+    assert response["statusCode"] == 400
+    assert json.loads(response["body"])["errors"][0]["code"] == "NoSuchUpload"
+    assert stepfunctions.calls == []
+
+
+def test_batch_names_the_existing_job_of_deduplicated_entries(api, stepfunctions):
+    api.lambda_handler(submit_event("job-1", "s3://bucket/visit-0000.mp3"), None)
+
+    body = json.loads(api.lambda_handler(batch_event(batch_body(2)), None)["body"])
+
+    assert body["results"][0]["job_name"] == "visit-0000"
+    assert body["results"][0]["deduplicated"] is True
+    assert body["results"][0]["execution_job_name"] == "job-1"
+    assert "execution_job_name" not in body["results"][1]
+
+
+def test_deduplicated_upload_names_the_existing_job(api, stepfunctions):
+    first = json.loads(api.lambda_handler(submit_event("job-1", "s3://bucket/a.mp3", idempotency_key="visit-42"), None)["body"])
+    upload = json.loads(api.lambda_handler(upload_event("/api/uploads", {"file_name": "a.mp3", "size": 100}), None)["body"])
+
+    body = json.loads(api.lambda_handler(upload_event("/api/uploads/complete", {
+        "key": upload["key"], "upload_id": upload["upload_id"], "language": "English", "idempotency_key": "visit-42",
+        "parts": [{"part_number": 1, "etag": '"a"'}]}), None)["body"])
+
+    assert body["deduplicated"] is True
+    assert body["sm_execution_arn"] == first["sm_execution_arn"]
+    assert body["job_name"] == "job-1"
@@ -0,0 +1,319 @@
+import hashlib
+import io
+import json
+import pathlib
+
+import botocore.session
+import pytest
+from botocore.eventstream import EventStream
+from botocore.exceptions import ClientError
+from botocore.parsers import EventStreamJSONParser
+
+FIXTURES = pathlib.Path(__file__).parent / "fixtures"
+
+# bedrock_response_stream.bin is an InvokeModelWithResponseStream body for a Claude v2
+# completion: six chunk events in the AWS event stream binary encoding
+STREAMED_COMPLETION = (" The patient presents with fever, cough and body aches for three days."
+                       "\n\nAction items: rest, fluids and a $20 flu test.")
+
+
+class RawStream:
+    """Hands out the recorded bytes in small reads, the way urllib3 streams a response."""
+
+    def __init__(self, data, read_size=97):
+        self.data = data
+        self.read_size = read_size
+
+    def stream(self):
+        for offset in range(0, len(self.data), self.read_size):
+            yield self.data[offset:offset + self.read_size]
+
+    def close(self):
+        pass
+
+
+def recorded_event_stream():
+    operation = botocore.session.get_session().get_service_model("bedrock-runtime") \
+        .operation_model("InvokeModelWithResponseStream")
+    return EventStream(
+        RawStream((FIXTURES / "bedrock_response_stream.bin").read_bytes()),
+        operation.output_shape.members["body"],
+        EventStreamJSONParser(),
+        operation.name)
+
+
+class FakeBedrock:
+    def __init__(self):
+        self.requests = []
+
+    def invoke_model_with_response_stream(self, **kwargs):
+        self.requests.append(kwargs)
+        return {"body": recorded_event_stream(), "contentType": "application/json"}
+
+    def invoke_model(self, **kwargs):
+        self.requests.append(kwargs)
+        return {"body": io.BytesIO(json.dumps({"completion": STREAMED_COMPLETION}).encode("utf-8"))}
+
+
+class FakeBody(io.BytesIO):
+    def iter_chunks(self, chunk_size):
+        while True:
+            chunk = self.read(chunk_size)
+            if not chunk:
+                return
+            yield chunk
+
+
+class FakeS3:
+    def __init__(self, objects=None):
+        self.objects = dict(objects or {})
+        self.puts = []
+        self.ranges = []
+
+    def get_object(self, Bucket, Key, Range=None, **kwargs):
+        if (Bucket, Key) not in self.objects:
+            raise ClientError({"Error": {"Code": "NoSuchKey", "Message": "Not Found"}}, "GetObject")
+        data = self.objects[(Bucket, Key)]
+        if Range is None:
+            return {"Body": FakeBody(data)}
+        self.ranges.append(Range)
+        first, _, last = Range[len("bytes="):].partition("-")
+        last = min(int(last), len(data) - 1) if last else len(data) - 1
+        return {"Body": FakeBody(data[int(first):last + 1]), "ContentRange": f"bytes {first}-{last}/{len(data)}"}
+
+    def put_object(self, Bucket, Key, Body, **kwargs):
+        if isinstance(Body, str):
+            Body = Body.encode("utf-8")
+        self.puts.append((Key, Body.decode("utf-8"), kwargs.get("Metadata")))
+        self.objects[(Bucket, Key)] = Body
+
+
+def transcript_document(transcript):
+    return json.dumps({"jobName": "visit-0001", "results": {"transcripts": [{"transcript": transcript}], "items": []}}).encode("utf-8")
+
+
+@pytest.fixture
+def bedrock(load_lambda, monkeypatch):
+    module = load_lambda("bedrock")
+    monkeypatch.setattr(module, "bedrock", FakeBedrock())
+    monkeypatch.setattr(module, "s3", FakeS3({
+        ("bucket", "audio_transcripts/medical/visit-0001.json"): transcript_document("I have had a fever since Monday.")
+    }))
+    return module
+
+
+def bedrock_event():
+    return {
+        "ExecutionInput": {
+            "transcribe_job_name": "visit-0001",
+            "transcribe_job_bucket": "bucket",
+            "transcribe_job_output_prefix": "audio_transcripts",
+            "transcribe_job_language": "English"
+        },
+        "Outputs": {"TranscriptionOutput": {"TranscriptionJobStatus": "COMPLETED"}}
+    }
+
+
+def test_streamed_completion_is_decoded_incrementally(bedrock):
+    partials = []
+
+    result = bedrock.stream_bedrock_model("Summarize", partials.append)
+
+    assert result == STREAMED_COMPLETION
+    assert partials[0] == " The patient"
+    assert len(partials) == 6 and partials[-1] == result
+
+
+def test_partial_summaries_are_written_to_s3_until_complete(bedrock):
+    bedrock.partial_summary_interval_seconds = 0
+
+    event = bedrock.lambda_handler(bedrock_event(), None)
+
+    assert event["Outputs"]["BedrockOutput"]["bedrock_model_result"] == STREAMED_COMPLETION.replace("$", "\\$")
+    keys = {key for key, _, _ in bedrock.s3.puts}
+    assert keys == {"audio_transcripts/summaries/visit-0001.txt"}
+    statuses = [metadata["summary-status"] for _, _, metadata in bedrock.s3.puts]
+    assert statuses[0] == "partial" and statuses[-1] == "complete"
+    assert bedrock.s3.puts[0][1] == " The patient"
+
+
+def test_streaming_can_be_turned_off(bedrock):
+    bedrock.summary_streaming = False
+
+    event = bedrock.lambda_handler(bedrock_event(), None)
+
+    assert event["Outputs"]["BedrockOutput"]["bedrock_model_result"] == STREAMED_COMPLETION.replace("$", "\\$")
+    assert bedrock.s3.puts == []
+
+
+def transcribe_results():
+    words = [("0.10", "spk_0", "How"), ("0.30", "spk_0", "are"), ("0.50", "spk_0", "you"), (None, None, "?"),
+             ("1.20", "spk_1", "I"), ("1.40", "spk_1", "have"), ("1.60", "spk_1", "a"), ("1.80", "spk_1", "fever"), (None, None, "."),
+             ("2.50", "spk_0", "Since"), ("2.70", "spk_0", "when"), (None, None, "?")]
+    items, segments = [], {}
+    for start_time, speaker, content in words:
+        if start_time is None:
+            items.append({"alternatives": [{"confidence": "0.0", "content": content}], "type": "punctuation"})
+            continue
+        items.append({"start_time": start_time, "alternatives": [{"confidence": "0.99", "content": content}], "type": "pronunciation"})
+        segments.setdefault(speaker, []).append({"start_time": start_time, "speaker_label": speaker})
+    return {
+        "transcripts": [{"transcript": "How are you? I have a fever. Since when?"}],
+        "speaker_labels": {"speakers": 2, "segments": [{"speaker_label": speaker, "items": segment_items}
+                                                       for speaker, segment_items in segments.items()]},
+        "items": items
+    }
+
+
+def test_speaker_turns_follow_the_speaker_labels(bedrock):
+    assert bedrock.speaker_turns(transcribe_results()) == [
+        "spk_0: How are you?", "spk_1: I have a fever.", "spk_0: Since when?"
+    ]
+
+
+def test_chunks_keep_whole_turns_within_the_limit(bedrock):
+    turns = [f"spk_{i % 2}: " + "word " * 30 for i in range(20)]
+    turns.append("spk_0: " + "long " * 100)
+
+    chunks = bedrock.chunk_turns(turns, 400)
+
+    assert all(len(chunk) <= 400 for chunk in chunks)
+    assert chunks[0].split("\n")[0] == turns[0]
+    assert "".join(chunks).count("word") == 600 and "".join(chunks).count("long") == 100
+
+
+def test_long_transcripts_are_summarized_in_chunks_then_reduced(bedrock, monkeypatch):
+    prompts = []
+
+    def call_bedrock_model(prompt_text, max_tokens_to_sample=1024):
+        prompts.append(prompt_text)
+        return f"summary {len(prompts)}"
+
+    monkeypatch.setattr(bedrock, "call_bedrock_model", call_bedrock_model)
+    bedrock.summary_chunk_chars = 30
+    results = transcribe_results()
+    bedrock.s3.objects[("bucket", "audio_transcripts/medical/visit-0001.json")] = json.dumps({"results": results}).encode("utf-8")
+
+    event = bedrock.lambda_handler(bedrock_event(), None)
+
+    assert len(prompts) == 3
+    assert prompts[1].startswith("spk_1: I have a fever.\n\nThis is part 2 of 3")
+    streamed_prompt = json.loads(bedrock.bedrock.requests[0]["body"])["prompt"]
+    assert "Summary of part 1 of the conversation:\nsummary" in streamed_prompt
+    assert "Summary of part 3 of the conversation:\nsummary" in streamed_prompt
+    assert event["Outputs"]["BedrockOutput"]["bedrock_model_result"] == STREAMED_COMPLETION.replace("$", "\\$")
+
+
+def test_transcript_is_read_from_the_first_range_only(bedrock):
+    document = json.dumps({"jobName": "visit-0001", "results": {
+        "transcripts": [{"transcript": 'She said "it hurts" \u00e9\\'}],
+        "items": [{"alternatives": [{"content": "word"}]}] * 5000}})
+    bedrock.s3.objects[("bucket", "key")] = document.encode("utf-8")
+    bedrock.transcript_range_bytes = 128
+
+    transcript = bedrock.TranscriptObject("bucket", "key")
+
+    assert transcript.transcript == 'She said "it hurts" \u00e9\\'
+    assert bedrock.s3.ranges == ["bytes=0-127"]
+
+
+def test_transcript_is_streamed_past_the_first_range(bedrock):
+    spoken = "word \u00e9 " * 2000
+    # raw UTF-8, so chunks split multi-byte characters
+    document = json.dumps({"results": {"transcripts": [{"transcript": spoken}], "items": []}}, ensure_ascii=False).encode("utf-8")
+    bedrock.s3.objects[("bucket", "key")] = document
+    bedrock.transcript_range_bytes = 100
+    bedrock.transcript_stream_chunk_bytes = 33
+
+    transcript = bedrock.TranscriptObject("bucket", "key")
+
+    assert transcript.transcript == spoken
+    assert bedrock.s3.ranges == ["bytes=0-99", "bytes=100-"]
+    assert transcript.results() == json.loads(document)["results"]
+
+
+def test_unexpected_layouts_fall_back_to_parsing_the_document(bedrock):
+    document = {"results": {"items": [], "transcripts": [{"alternatives": [], "transcript": "Hello."}]}}
+    bedrock.s3.objects[("bucket", "key")] = json.dumps(document).encode("utf-8")
+
+    assert bedrock.TranscriptObject("bucket", "key").transcript == "Hello."
+
+
+def test_repeated_requests_are_served_from_memory(bedrock, capsys):
+    bedrock.summary_streaming = False
+
+    bedrock.lambda_handler(bedrock_event(), None)
+    event = bedrock.lambda_handler(bedrock_event(), None)
+
+    assert len(bedrock.bedrock.requests) == 1
+    assert event["Outputs"]["BedrockOutput"]["bedrock_model_result"] == STREAMED_COMPLETION.replace("$", "\\$")
+    metrics = json.loads(capsys.readouterr().out.strip().splitlines()[-1])
+    assert (metrics["MemoryHits"], metrics["S3Hits"], metrics["Misses"]) == (1, 0, 0)
+
+
+def test_cache_key_covers_the_inference_parameters(bedrock):
+    assert bedrock.summary_cache_key(bedrock.bedrock_request_body("Summarize", 1024)) != \
+        bedrock.summary_cache_key(bedrock.bedrock_request_body("Summarize", 512))
+    assert bedrock.summary_cache_key(bedrock.bedrock_request_body("Summarize", 1024)) == \
+        bedrock.summary_cache_key(bedrock.bedrock_request_body("Summarize", 1024))
+
+
+def test_cached_completions_are_shared_through_s3(bedrock, load_lambda, monkeypatch):
+    bedrock.summary_cache_bucket = "bucket"
+    partials = []
+    bedrock.stream_bedrock_model("Summarize", partials.append)
+    cache_key = bedrock.summary_cache_key(bedrock.bedrock_request_body("Summarize", 1024))
+    assert ("bucket", "cache/summaries/" + cache_key + ".json") in bedrock.s3.objects
+
+    cold = load_lambda("bedrock", SUMMARY_CACHE_BUCKET="bucket")
+    monkeypatch.setattr(cold, "bedrock", FakeBedrock())
+    monkeypatch.setattr(cold, "s3", bedrock.s3)
+
+    assert cold.stream_bedrock_model("Summarize", partials.append) == STREAMED_COMPLETION
+    assert cold.bedrock.requests == [] and partials[-1] == STREAMED_COMPLETION
+    assert cold.summary_cache_stats["S3Hits"] == 1
+
+
+def test_expired_s3_entries_are_misses(bedrock):
+    bedrock.summary_cache_bucket = "bucket"
+    cache_key = bedrock.summary_cache_key(bedrock.bedrock_request_body("Summarize", 1024))
+    bedrock.s3.objects[("bucket", "cache/summaries/" + cache_key + ".json")] = \
+        json.dumps({"completion": "stale", "expires_at": 0}).encode("utf-8")
+
+    assert bedrock.call_bedrock_model("Summarize") == STREAMED_COMPLETION
+    assert len(bedrock.bedrock.requests) == 1
+
+
+def test_memory_tier_is_bounded(bedrock):
+    bedrock.summary_cache_size = 2
+
+    for prompt in ("one", "two", "three"):
+        bedrock.call_bedrock_model(prompt)
+
+    assert len(bedrock.summary_cache) == 2
+    assert bedrock.summary_cache_key(bedrock.bedrock_request_body("one", 1024)) not in bedrock.summary_cache
+
+
+def test_large_summaries_are_passed_by_reference(bedrock):
+    bedrock.claim_check_threshold_bytes = 50
+    bedrock.partial_summary_interval_seconds = 0
+
+    event = bedrock.lambda_handler(bedrock_event(), None)
+
+    output = event["Outputs"]["BedrockOutput"]
+    assert "bedrock_model_result" not in output
+    ref = output["bedrock_model_result_ref"]
+    stored = bedrock.s3.objects[("bucket", ref["key"])]
+    assert ref["key"] == "audio_transcripts/summaries/visit-0001.txt"
+    assert stored.decode("utf-8") == STREAMED_COMPLETION.replace("$", "\\$")
+    assert ref["sha256"] == hashlib.sha256(stored).hexdigest() and ref["size"] == len(stored)
+
+
+def test_large_summaries_are_stored_without_streaming(bedrock):
+    bedrock.claim_check_threshold_bytes = 50
+    bedrock.summary_streaming = False
+
+    event = bedrock.lambda_handler(bedrock_event(), None)
+
+    ref = event["Outputs"]["BedrockOutput"]["bedrock_model_result_ref"]
+    assert bedrock.s3.puts == [(ref["key"], STREAMED_COMPLETION.replace("$", "\\$"), {"summary-status": "complete"})]
@@ -1,15 +1,159 @@
+import json
+
 import aws_cdk as core
 import aws_cdk.assertions as assertions
+import pytest
 
-from cdk.cdk_stack import CdkStack
+from cdk.cdk_stack import ChartAutomationCdkStack
 
 # example tests. To run these tests, uncomment this file along with the example
 # resource in cdk/cdk_stack.py
 def test_sqs_queue_created():
     app = core.App()
-    stack = CdkStack(app, "cdk")
+    stack = ChartAutomationCdkStack(app, "cdk")
     template = assertions.Template.from_stack(stack)
 
 #     template.has_resource_properties("AWS::SQS::Queue", {
 #         "VisibilityTimeout": 300
 #     })
+
+
+@pytest.fixture(scope="module")
+def template():
+    app = core.App()
+    stack = ChartAutomationCdkStack(app, "cdk")
+    return assertions.Template.from_stack(stack)
+
+
+def test_api_exposes_batch_submission(template):
+    template.has_resource_properties("AWS::ApiGateway::Resource", {
+        "PathPart": "batch"
+    })
+    template.has_resource_properties("AWS::ApiGateway::Method", {
+        "HttpMethod": "POST",
+        "ResourceId": {"Ref": assertions.Match.string_like_regexp("ChartAutomationAPIapibatch")}
+    })
+
+
+def test_api_exposes_execution_results(template):
+    template.has_resource_properties("AWS::ApiGateway::Resource", {
+        "PathPart": "{execution}"
+    })
+    template.has_resource_properties("AWS::ApiGateway::Method", {
+        "HttpMethod": "GET",
+        "ResourceId": {"Ref": assertions.Match.string_like_regexp("ChartAutomationAPIapiexecution")}
+    })
+
+
+def test_every_api_method_requires_iam_authorization(template):
+    methods = template.find_resources("AWS::ApiGateway::Method")
+
+    assert methods
+    assert {method["Properties"]["AuthorizationType"] for method in methods.values()} == {"AWS_IAM"}
+
+
+def test_api_issues_presigned_direct_uploads(template):
+    for path_part in ("uploads", "complete", "abort"):
+        template.has_resource_properties("AWS::ApiGateway::Resource", {"PathPart": path_part})
+    template.has_resource_properties("AWS::Lambda::Function", {
+        "Environment": {"Variables": assertions.Match.object_like({
+            "UPLOAD_BUCKET": {"Ref": assertions.Match.string_like_regexp("S3Bucket")}
+        })}
+    })
+    template.has_resource_properties("AWS::S3::Bucket", {
+        "CorsConfiguration": {"CorsRules": [assertions.Match.object_like({
+            "AllowedMethods": ["PUT"], "ExposedHeaders": ["ETag"]
+        })]},
+        "LifecycleConfiguration": {"Rules": assertions.Match.array_with([assertions.Match.object_like({
+            "Prefix": "audio_conversations/", "AbortIncompleteMultipartUpload": {"DaysAfterInitiation": 1}
+        })])}
+    })
+
+
+def state_machine_definition(template):
+    state_machine = next(iter(template.find_resources("AWS::StepFunctions::StateMachine").values()))
+    parts = state_machine["Properties"]["DefinitionString"]["Fn::Join"][1]
+    # references to other resources only occur inside JSON strings of the definition
+    return json.loads("".join(part if isinstance(part, str) else "ref" for part in parts))
+
+
+def test_transcription_waits_for_callback_with_polling_fallback(template):
+    states = state_machine_definition(template)["States"]
+
+    assert states["Submit Transcribe Job"]["Next"] == "Wait For Transcript"
+    wait_for_transcript = states["Wait For Transcript"]
+    assert wait_for_transcript["Resource"].endswith(":states:::lambda:invoke.waitForTaskToken")
+    assert wait_for_transcript["Next"] == "Transcription Complete?"
+    assert wait_for_transcript["TimeoutSecondsPath"] == "$.Outputs.TranscriptionOutput.CallbackTimeoutSeconds"
+    assert wait_for_transcript["Catch"] == [{"ErrorEquals": ["States.Timeout"], "ResultPath": None, "Next": "Check Transcription Status"}]
+    template.has_resource_properties("Custom::S3BucketNotifications", {
+        "NotificationConfiguration": {"LambdaFunctionConfigurations": [assertions.Match.object_like({
+            "Filter": {"Key": {"FilterRules": assertions.Match.array_with([{"Name": "prefix", "Value": "audio_transcripts/medical/"}])}}
+        })]}
+    })
+
+
+def test_state_machine_timeout_covers_long_recordings(template):
+    assert state_machine_definition(template)["TimeoutSeconds"] == 120 * 60
+
+    app = core.App(context={"stateMachineTimeoutMinutes": 30})
+    template = assertions.Template.from_stack(ChartAutomationCdkStack(app, "cdk"))
+    assert state_machine_definition(template)["TimeoutSeconds"] == 30 * 60
+
+
+def test_polling_mode_keeps_the_wait_loop_only():
+    app = core.App(context={"transcriptionCompletionMode": "polling"})
+    template = assertions.Template.from_stack(ChartAutomationCdkStack(app, "cdk"))
+    states = state_machine_definition(template)["States"]
+
+    assert states["Submit Transcribe Job"]["Next"] == "Wait Before Status Check"
+    assert states["Wait Before Status Check"]["SecondsPath"] == "$.Outputs.TranscriptionOutput.NextWaitSeconds"
+    assert "Wait For Transcript" not in states
+    template.resource_count_is("Custom::S3BucketNotifications", 0)
+
+
+def test_claim_check_threshold_reaches_both_lambdas():
+    app = core.App(context={"claimCheckThresholdBytes": 0})
+    template = assertions.Template.from_stack(ChartAutomationCdkStack(app, "cdk"))
+
+    functions = template.find_resources("AWS::Lambda::Function", {
+        "Properties": {"Environment": {"Variables": {"CLAIM_CHECK_THRESHOLD_BYTES": "0"}}}
+    })
+    assert len(functions) == 2
+
+
+def test_entity_detection_has_time_for_long_transcripts(template):
+    functions = template.find_resources("AWS::Lambda::Function", {
+        "Properties": {"Code": {"S3Key": assertions.Match.any_value()}, "MemorySize": 512}
+    })
+
+    assert [function["Properties"]["Timeout"] for function in functions.values()] == [300]
+
+
+def test_sequential_mode_detects_entities_after_summarization(template):
+    states = state_machine_definition(template)["States"]
+
+    assert states["Perform Summarization With Bedrock"]["Next"] == "Detect Entities With Comprehend"
+    assert not any(state["Type"] == "Parallel" for state in states.values())
+
+
+def test_parallel_mode_summarizes_and_detects_entities_at_once():
+    app = core.App(context={"entityDetectionMode": "parallel", "entitySummaryPass": "true"})
+    template = assertions.Template.from_stack(ChartAutomationCdkStack(app, "cdk"))
+    states = state_machine_definition(template)["States"]
+
+    parallel = states["Summarize And Detect Entities"]
+    assert parallel["Type"] == "Parallel"
+    assert [branch["StartAt"] for branch in parallel["Branches"]] == ["Perform Summarization With Bedrock", "Use Transcript For Entities"]
+    transcript_branch = parallel["Branches"][1]["States"]
+    assert transcript_branch["Use Transcript For Entities"] == {
+        "Type": "Pass", "Result": "transcript", "ResultPath": "$.EntitySource", "Next": "Detect Entities In Transcript"}
+    assert parallel["ResultSelector"]["Outputs"] == {
+        "TranscriptionOutput.$": "$[0].Outputs.TranscriptionOutput",
+        "BedrockOutput.$": "$[0].Outputs.BedrockOutput",
+        "ComprehendMedicalOutput.$": "$[1].Outputs.ComprehendMedicalOutput"
+    }
+    assert parallel["Next"] == "Use Summary For Entities"
+    assert states["Use Summary For Entities"]["Next"] == "Detect Entities With Comprehend"
+    assert states["Detect Entities With Comprehend"]["Next"] == "Succeeded"
+    assert states["Transcription Complete?"]["Choices"][0]["Next"] == "Summarize And Detect Entities"
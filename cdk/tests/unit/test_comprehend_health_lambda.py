@@ -0,0 +1,338 @@
+import hashlib
+import io
+import json
+import re
+import threading
+import time
+
+import pytest
+
+ENTITY = {"Id": 0, "BeginOffset": 0, "EndOffset": 5, "Score": 0.99, "Text": "fever",
+          "Category": "MEDICAL_CONDITION", "Type": "DX_NAME", "Traits": [{"Name": "SYMPTOM", "Score": 0.9}]}
+
+ENTITY_COLUMNS = {"categories": ["MEDICAL_CONDITION"], "types": ["DX_NAME"], "columns": {
+    "Text": ["fever"], "Category": [0], "Type": [0], "Score": [0.99], "BeginOffset": [0], "EndOffset": [5],
+    "Traits": [["SYMPTOM"]], "Parent": [-1]}}
+
+
+class FakeBody(io.BytesIO):
+    def iter_chunks(self, chunk_size):
+        while True:
+            chunk = self.read(chunk_size)
+            if not chunk:
+                return
+            yield chunk
+
+
+class FakeS3:
+    def __init__(self):
+        self.objects = {}
+        self.ranges = []
+
+    def get_object(self, Bucket, Key, Range=None, **kwargs):
+        data = self.objects[(Bucket, Key)]
+        if Range is None:
+            return {"Body": FakeBody(data)}
+        self.ranges.append(Range)
+        first, _, last = Range[len("bytes="):].partition("-")
+        last = min(int(last), len(data) - 1) if last else len(data) - 1
+        return {"Body": FakeBody(data[int(first):last + 1]), "ContentRange": f"bytes {first}-{last}/{len(data)}"}
+
+    def put_object(self, Bucket, Key, Body, **kwargs):
+        self.objects[(Bucket, Key)] = Body
+
+
+@pytest.fixture
+def comprehend(load_lambda, monkeypatch):
+    module = load_lambda("comprehend-health")
+    monkeypatch.setattr(module, "s3", FakeS3())
+    return module
+
+
+def comprehend_event(bedrock_output):
+    return {
+        "ExecutionInput": {
+            "transcribe_job_name": "visit-0001",
+            "transcribe_job_bucket": "bucket",
+            "transcribe_job_output_prefix": "audio_transcripts",
+            "transcribe_job_language": "English"
+        },
+        "Outputs": {"BedrockOutput": bedrock_output}
+    }
+
+
+def test_small_outputs_stay_in_the_state(comprehend, monkeypatch):
+    monkeypatch.setattr(comprehend, "detect_entities", lambda document: [ENTITY])
+
+    event = comprehend.lambda_handler(comprehend_event({"bedrock_model_result": "Patient has a fever."}), None)
+
+    assert event["Outputs"]["ComprehendMedicalOutput"] == {"entity_columns": ENTITY_COLUMNS}
+    assert comprehend.s3.objects == {}
+
+
+def test_large_outputs_are_passed_by_reference(comprehend, monkeypatch):
+    documents = []
+    monkeypatch.setattr(comprehend, "detect_entities", lambda document: documents.append(document) or [ENTITY] * 3)
+    comprehend.claim_check_threshold_bytes = 100
+    summary = "Patient has a fever. $20 co-pay.".encode("utf-8")
+    comprehend.s3.objects[("bucket", "audio_transcripts/summaries/visit-0001.txt")] = summary
+    ref = {"bucket": "bucket", "key": "audio_transcripts/summaries/visit-0001.txt",
+           "size": len(summary), "sha256": hashlib.sha256(summary).hexdigest()}
+
+    event = comprehend.lambda_handler(comprehend_event({"bedrock_model_result_ref": ref}), None)
+
+    assert documents == [summary.decode("utf-8")]
+    entities_ref = event["Outputs"]["ComprehendMedicalOutput"]["entity_columns_ref"]
+    assert entities_ref["key"] == "audio_transcripts/entities/visit-0001.json"
+    stored = comprehend.s3.objects[("bucket", entities_ref["key"])]
+    assert json.loads(stored)["columns"]["Text"] == ["fever"] * 3
+    assert entities_ref["sha256"] == hashlib.sha256(stored).hexdigest() and entities_ref["size"] == len(stored)
+
+
+def test_tampered_artifacts_are_rejected(comprehend):
+    comprehend.s3.objects[("bucket", "summary.txt")] = b"changed"
+    ref = {"bucket": "bucket", "key": "summary.txt", "size": 8, "sha256": hashlib.sha256(b"original").hexdigest()}
+
+    with pytest.raises(ValueError):
+        comprehend.lambda_handler(comprehend_event({"bedrock_model_result_ref": ref}), None)
+
+
+def test_parallel_branch_detects_entities_in_the_transcript(comprehend, monkeypatch):
+    documents = []
+    monkeypatch.setattr(comprehend, "detect_entities", lambda document: documents.append(document) or [ENTITY])
+    comprehend.s3.objects[("bucket", "audio_transcripts/medical/visit-0001.json")] = json.dumps(
+        {"results": {"transcripts": [{"transcript": "I have had a fever since Monday."}], "items": []}}).encode("utf-8")
+    event = comprehend_event({})
+    del event["Outputs"]["BedrockOutput"]
+    event["EntitySource"] = "transcript"
+
+    event = comprehend.lambda_handler(event, None)
+
+    assert documents == ["I have had a fever since Monday."]
+    assert event["Outputs"]["ComprehendMedicalOutput"] == {"entity_columns": ENTITY_COLUMNS}
+    assert "EntitySource" not in event
+
+
+def test_transcript_is_read_without_its_items(comprehend, monkeypatch):
+    documents = []
+    monkeypatch.setattr(comprehend, "detect_entities", lambda document: documents.append(document) or [])
+    monkeypatch.setattr(comprehend, "transcript_range_bytes", 64)
+    transcript = 'She said "it hurts" since Monday. ' * 8
+    items = [{"start_time": "0.0", "alternatives": [{"content": "word"}]}] * 5000
+    comprehend.s3.objects[("bucket", "audio_transcripts/medical/visit-0001.json")] = json.dumps(
+        {"jobName": "visit-0001", "results": {"transcripts": [{"transcript": transcript}], "items": items}}).encode("utf-8")
+    event = comprehend_event({})
+    event["EntitySource"] = "transcript"
+
+    comprehend.lambda_handler(event, None)
+
+    assert documents == [transcript]
+    # the first range did not hold the whole transcript, so the rest was streamed until it ended
+    assert comprehend.s3.ranges == ["bytes=0-63", "bytes=64-"]
+
+
+def test_summary_pass_keeps_the_transcript_entities(comprehend, monkeypatch):
+    monkeypatch.setattr(comprehend, "detect_entities", lambda document: [dict(ENTITY, Text=document)])
+    event = comprehend_event({"bedrock_model_result": "Fever."})
+    event["Outputs"]["ComprehendMedicalOutput"] = {"entity_columns": ENTITY_COLUMNS}
+    event["EntitySource"] = "summary"
+
+    event = comprehend.lambda_handler(event, None)
+
+    assert event["Outputs"]["ComprehendMedicalOutput"] == {"entity_columns": ENTITY_COLUMNS}
+    assert event["Outputs"]["ComprehendMedicalSummaryOutput"]["entity_columns"]["columns"]["Text"] == ["Fever."]
+
+
+class FakeComprehend:
+    """Finds each occurrence of a few known terms, like detect_entities_v2 with offsets into the text it got."""
+
+    TERMS = {"fever": ("MEDICAL_CONDITION", "DX_NAME"), "ibuprofen": ("MEDICATION", "GENERIC_NAME")}
+
+    def __init__(self, max_chars):
+        self.max_chars = max_chars
+        self.texts = []
+        self.in_flight = self.max_in_flight = 0
+        self.lock = threading.Lock()
+
+    def detect_entities_v2(self, Text):
+        assert len(Text) <= self.max_chars
+        with self.lock:
+            self.texts.append(Text)
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        time.sleep(0.01)
+        entities = []
+        for term, (category, entity_type) in self.TERMS.items():
+            for match in re.finditer(term, Text):
+                entities.append({"Id": len(entities), "BeginOffset": match.start(), "EndOffset": match.end(), "Score": 0.9,
+                                 "Text": term, "Category": category, "Type": entity_type, "Traits": []})
+                dose = Text.find("200 mg", match.end(), match.end() + 10)
+                if term == "ibuprofen" and dose >= 0:
+                    attribute = {"Id": len(entities), "BeginOffset": dose, "EndOffset": dose + 6, "Score": 0.8,
+                                 "Text": "200 mg", "Category": category, "Type": "DOSAGE", "Traits": []}
+                    entities[-1]["Attributes"] = [dict(attribute, RelationshipScore=0.9)]
+                    entities.append(attribute)
+        with self.lock:
+            self.in_flight -= 1
+        return {"Entities": entities}
+
+
+@pytest.fixture
+def fake_comprehend(comprehend, monkeypatch):
+    client = FakeComprehend(200)
+    monkeypatch.setattr(comprehend, "comprehend_client", client)
+    comprehend.entity_chunk_chars = 200
+    comprehend.entity_chunk_overlap_chars = 60
+    comprehend.entity_max_workers = 3
+    return client
+
+
+def test_sentence_chunks_overlap_and_respect_the_limit(comprehend):
+    text = " ".join(f"Sentence number {index} is here." for index in range(40))
+
+    chunks = comprehend.sentence_chunks(text, 200, 60)
+
+    assert chunks[0][0] == 0 and chunks[-1][1] == len(text)
+    for (start, end), (next_start, _) in zip(chunks, chunks[1:]):
+        assert end - start <= 200
+        assert text[end - 2:end] == ". " and text[next_start - 2:next_start] == ". "
+        assert end - 60 <= next_start < end
+
+
+def test_sentence_chunks_cut_long_sentences_on_whitespace(comprehend):
+    text = "word " * 100
+
+    chunks = comprehend.sentence_chunks(text, 120, 20)
+
+    assert all(end - start <= 120 and text[end - 1] == " " for start, end in chunks[:-1])
+    assert chunks[-1][1] == len(text)
+
+
+def test_long_documents_are_analyzed_in_concurrent_chunks(comprehend, fake_comprehend):
+    text = " ".join(f"Day {day}: fever again, took ibuprofen 200 mg at noon." for day in range(30))
+
+    entities = comprehend.detect_entities(text)
+
+    assert len(fake_comprehend.texts) > 3 and 1 < fake_comprehend.max_in_flight <= 3
+    assert [text[entity["BeginOffset"]:entity["EndOffset"]] for entity in entities] == \
+        [entity["Text"] for entity in entities]
+    spans = [(entity["BeginOffset"], entity["Type"]) for entity in entities]
+    assert len(spans) == len(set(spans))
+    assert sum(entity["Text"] == "fever" for entity in entities) == 30
+    assert sum(entity["Type"] == "DOSAGE" for entity in entities) == 30
+    ids = [entity["Id"] for entity in entities]
+    assert len(ids) == len(set(ids))
+    for entity in entities:
+        for attribute in entity.get("Attributes", []):
+            assert text[attribute["BeginOffset"]:attribute["EndOffset"]] == "200 mg"
+            assert attribute["Id"] in ids
+
+
+def test_short_documents_take_one_call(comprehend, fake_comprehend):
+    entities = comprehend.detect_entities("Patient has a fever.")
+
+    assert fake_comprehend.texts == ["Patient has a fever."]
+    assert entities[0]["BeginOffset"] == 14
+
+
+def test_client_is_built_once_with_a_pool_for_the_chunk_calls(comprehend, monkeypatch):
+    built = []
+    monkeypatch.setattr(comprehend.boto3, "client", lambda **kwargs: built.append(kwargs) or FakeComprehend(20000))
+
+    comprehend.detect_entities("Patient has a fever.")
+    comprehend.detect_entities("No fever today.")
+
+    assert len(built) == 1 and built[0]["service_name"] == "comprehendmedical"
+    assert built[0]["config"].max_pool_connections >= comprehend.entity_max_workers
+    assert built[0]["config"].tcp_keepalive is True
+
+
+def test_edited_documents_only_analyze_the_changed_sentences(comprehend, fake_comprehend):
+    draft = "Patient has a fever. Took ibuprofen 200 mg.\nFollow up in a week. No fever at night."
+    edited = "Patient has had a high fever. Took ibuprofen 200 mg.\nFollow up in a week. No fever at night, cough."
+
+    comprehend.detect_entities(draft)
+    fake_comprehend.texts.clear()
+    entities = comprehend.detect_entities(edited)
+
+    assert fake_comprehend.texts == ["Patient has had a high fever.", "No fever at night, cough."]
+    assert [(entity["Text"], edited[entity["BeginOffset"]:entity["EndOffset"]]) for entity in entities] == [
+        ("fever", "fever"), ("ibuprofen", "ibuprofen"), ("200 mg", "200 mg"), ("fever", "fever")]
+    dosage = entities[1]["Attributes"][0]
+    assert edited[dosage["BeginOffset"]:dosage["EndOffset"]] == "200 mg"
+    ids = [entity["Id"] for entity in entities]
+    assert len(ids) == len(set(ids))
+
+
+def test_unchanged_documents_make_no_calls(comprehend, fake_comprehend):
+    document = "Patient has a fever. Took ibuprofen 200 mg."
+    first = comprehend.detect_entities(document)
+    fake_comprehend.texts.clear()
+
+    assert comprehend.detect_entities(document) == first
+    assert fake_comprehend.texts == []
+
+
+def test_sentences_with_entities_crossing_into_the_next_are_not_cached(comprehend, fake_comprehend):
+    document = "Took ibuprofen. 200 mg."
+    comprehend.detect_entities(document)
+    fake_comprehend.texts.clear()
+
+    entities = comprehend.detect_entities(document)
+
+    assert fake_comprehend.texts == ["Took ibuprofen."]
+    assert [entity["Text"] for entity in entities] == ["ibuprofen", "200 mg"]
+
+
+def test_entity_cache_can_be_turned_off(comprehend, fake_comprehend):
+    comprehend.entity_cache_size = 0
+    comprehend.detect_entities("Patient has a fever.")
+    comprehend.detect_entities("Patient has a fever.")
+
+    assert fake_comprehend.texts == ["Patient has a fever.", "Patient has a fever."]
+
+
+def test_entities_format_keeps_the_comprehend_entities(comprehend, monkeypatch):
+    monkeypatch.setattr(comprehend, "detect_entities", lambda document: [ENTITY])
+    comprehend.entity_output_format = "entities"
+
+    event = comprehend.lambda_handler(comprehend_event({"bedrock_model_result": "Patient has a fever."}), None)
+
+    assert event["Outputs"]["ComprehendMedicalOutput"] == {"entities": [ENTITY]}
+
+
+def test_entity_columns_encode_categories_and_attributes(comprehend):
+    medication = {"Id": 1, "BeginOffset": 10, "EndOffset": 19, "Score": 0.987654, "Text": "ibuprofen",
+                  "Category": "MEDICATION", "Type": "GENERIC_NAME", "Traits": [],
+                  "Attributes": [{"Id": 2, "BeginOffset": 20, "EndOffset": 26, "Score": 0.9, "RelationshipScore": 0.8,
+                                  "Text": "200 mg", "Category": "MEDICATION", "Type": "DOSAGE", "Traits": []}]}
+
+    table = comprehend.entity_columns([ENTITY, medication, ENTITY])
+
+    assert table["categories"] == ["MEDICAL_CONDITION", "MEDICATION"]
+    assert table["types"] == ["DX_NAME", "GENERIC_NAME", "DOSAGE"]
+    columns = table["columns"]
+    assert columns["Text"] == ["fever", "ibuprofen", "200 mg", "fever"]
+    assert columns["Category"] == [0, 1, 1, 0] and columns["Type"] == [0, 1, 2, 0]
+    assert columns["Parent"] == [-1, -1, 1, -1]
+    assert columns["Score"][1] == 0.9877
+    assert len(json.dumps(table)) < len(json.dumps([ENTITY, medication, ENTITY]))
+
+
+def test_responses_are_logged_as_sampled_counts(comprehend, fake_comprehend, caplog):
+    comprehend.entity_log_sample_rate = 1
+    with caplog.at_level("INFO"):
+        comprehend.detect_entities("Patient has a fever.")
+
+    logged = [json.loads(record.getMessage()) for record in caplog.records
+              if record.getMessage().startswith('{"message": "DetectEntitiesV2')]
+    assert logged == [{"message": "DetectEntitiesV2 response", "request_id": None, "model_version": None,
+                       "chars": 20, "entities": 1, "unmapped_attributes": 0, "categories": {"MEDICAL_CONDITION": 1}}]
+    assert "fever" not in caplog.text
+
+    caplog.clear()
+    comprehend.entity_log_sample_rate = 0
+    comprehend.entity_cache_size = 0
+    with caplog.at_level("INFO"):
+        comprehend.detect_entities("Patient has no fever.")
+    assert "DetectEntitiesV2" not in caplog.text
@@ -0,0 +1,148 @@
+import io
+import json
+
+import pytest
+from botocore.exceptions import ClientError
+
+
+class FakeS3:
+    def __init__(self):
+        self.objects = {}
+
+    def put_object(self, Bucket, Key, Body, **kwargs):
+        self.objects[(Bucket, Key)] = Body.encode("utf-8") if isinstance(Body, str) else Body
+
+    def get_object(self, Bucket, Key, **kwargs):
+        if (Bucket, Key) not in self.objects:
+            raise ClientError({"Error": {"Code": "NoSuchKey", "Message": "Not found"}}, "GetObject")
+        return {"Body": io.BytesIO(self.objects[(Bucket, Key)])}
+
+    def delete_object(self, Bucket, Key):
+        self.objects.pop((Bucket, Key), None)
+
+
+class FakeStepFunctions:
+    def __init__(self):
+        self.resumed = []
+
+    def send_task_success(self, taskToken, output):
+        if taskToken in [token for token, _ in self.resumed]:
+            raise ClientError({"Error": {"Code": "TaskTimedOut", "Message": "Task already closed"}}, "SendTaskSuccess")
+        self.resumed.append((taskToken, json.loads(output)))
+
+
+class FakeTranscribe:
+    def __init__(self, status="IN_PROGRESS"):
+        self.status = status
+
+    def get_medical_transcription_job(self, MedicalTranscriptionJobName):
+        return {"MedicalTranscriptionJob": {"TranscriptionJobStatus": self.status}}
+
+    def start_medical_transcription_job(self, MedicalTranscriptionJobName, LanguageCode, Media, **kwargs):
+        return {"MedicalTranscriptionJob": {
+            "MedicalTranscriptionJobName": MedicalTranscriptionJobName, "TranscriptionJobStatus": self.status,
+            "LanguageCode": LanguageCode, "Media": Media}}
+
+
+@pytest.fixture
+def transcribe(load_lambda, monkeypatch):
+    module = load_lambda("transcribe")
+    monkeypatch.setattr(module, "s3", FakeS3())
+    monkeypatch.setattr(module, "sfn", FakeStepFunctions())
+    monkeypatch.setattr(module, "client", FakeTranscribe())
+    return module
+
+
+def waiting_state(job_name="visit-0001"):
+    return {
+        "ExecutionInput": {
+            "transcribe_job_name": job_name,
+            "transcribe_job_bucket": "bucket",
+            "transcribe_job_output_prefix": "audio_transcripts"
+        },
+        "Outputs": {"TranscriptionOutput": {"TranscriptionJobStatus": "IN_PROGRESS"}}
+    }
+
+
+def transcript_event(key):
+    return {"Records": [{"s3": {"bucket": {"name": "bucket"}, "object": {"key": key}}}]}
+
+
+def test_transcript_in_s3_resumes_the_waiting_execution(transcribe):
+    transcribe.lambda_handler({"TaskToken": "token-1", "State": waiting_state()}, None)
+    assert transcribe.sfn.resumed == []
+
+    transcribe.lambda_handler(transcript_event("audio_transcripts/medical/visit-0001.json"), None)
+
+    token, state = transcribe.sfn.resumed[0]
+    assert token == "token-1"
+    assert state["Outputs"]["TranscriptionOutput"]["TranscriptionJobStatus"] == "COMPLETED"
+    assert transcribe.s3.objects == {}
+
+
+def test_transcript_written_before_the_token_is_registered(transcribe):
+    transcribe.lambda_handler(transcript_event("audio_transcripts/medical/visit-0001.json"), None)
+    transcribe.client.status = "COMPLETED"
+
+    transcribe.lambda_handler({"TaskToken": "token-1", "State": waiting_state()}, None)
+
+    assert [token for token, _ in transcribe.sfn.resumed] == ["token-1"]
+
+
+def test_late_transcript_after_fallback_to_polling_is_ignored(transcribe):
+    transcribe.lambda_handler({"TaskToken": "token-1", "State": waiting_state()}, None)
+    transcribe.sfn.resumed.append(("token-1", {}))
+
+    transcribe.lambda_handler(transcript_event("audio_transcripts/medical/visit-0001.json"), None)
+
+    assert len(transcribe.sfn.resumed) == 1
+    assert transcribe.s3.objects == {}
+
+
+def test_callback_of_a_long_recording_waits_past_the_minimum_timeout(transcribe):
+    # an hour long 128 kbps mp3 takes about 20 minutes to transcribe
+    transcribe.s3.head_object = lambda Bucket, Key: {"ContentLength": 3600 * 16000}
+
+    transc_out = transcribe.lambda_handler({
+        "transcribe_job_name": "visit-0001",
+        "transcribe_job_uri": "s3://bucket/audio_conversations/visit.mp3",
+        "transcribe_job_bucket": "bucket",
+        "transcribe_job_output_prefix": "audio_transcripts",
+        "transcribe_job_language": "English"
+    }, None)["Outputs"]["TranscriptionOutput"]
+
+    assert transc_out["ExpectedSeconds"] > transcribe.callback_min_timeout_seconds
+    assert transc_out["CallbackTimeoutSeconds"] > transc_out["ExpectedSeconds"] * 1.2
+    # short recordings keep the minimum
+    assert transcribe.callback_timeout_seconds(20) == transcribe.callback_min_timeout_seconds
+
+
+def test_first_check_comes_before_the_expected_transcription_time(transcribe):
+    # a 3 minute 128 kbps mp3
+    transcribe.s3.head_object = lambda Bucket, Key: {"ContentLength": 180 * 16000}
+
+    expected = transcribe.expected_transcription_seconds("s3://bucket/audio_conversations/visit.mp3")
+
+    assert expected == int(180 * transcribe.transcribe_realtime_factor + transcribe.transcribe_overhead_seconds)
+    # the first check comes before the job is expected to finish, in case the estimate is high
+    assert transcribe.next_wait_seconds(expected, 0, 0) == int(expected * transcribe.poll_first_check_ratio)
+    # and is not cut short for an hour long recording
+    assert transcribe.next_wait_seconds(1000, 0, 0) == 700
+
+
+def test_status_checks_back_off_exponentially_up_to_the_cap(transcribe):
+    waits = [transcribe.next_wait_seconds(600, 650, poll_count) for poll_count in range(1, 8)]
+
+    assert waits == [5, 10, 15, 15, 15, 15, 15]
+    # the backoff of a short job stops growing at a quarter of its expected time
+    assert [transcribe.next_wait_seconds(40, 50, poll_count) for poll_count in range(1, 5)] == [5, 10, 10, 10]
+
+
+def test_status_check_returns_the_next_wait(transcribe):
+    state = waiting_state()
+    state["Outputs"]["TranscriptionOutput"].update({"ExpectedSeconds": 30, "SubmittedAt": 0, "PollCount": 2})
+
+    transc_out = transcribe.lambda_handler(state, None)["Outputs"]["TranscriptionOutput"]
+
+    assert transc_out["PollCount"] == 3
+    assert transc_out["NextWaitSeconds"] == 7
@@ -1,62 +1,124 @@
 import streamlit as st
 from streamlit.logger import get_logger
 import boto3
+import hashlib
 import json
 import requests as req
+from requests_aws4auth import AWS4Auth
 import os
 import uuid
 import time
 import pandas as pd
-from langchain.agents import load_tools, initialize_agent, AgentType
-from langchain.llms import Bedrock
+from urllib.parse import quote
+from concurrent.futures import ThreadPoolExecutor
+from education import build_llm, build_education_agent, condition_education
+from education_cache import EducationCache, distinct_conditions, education_sections
+from job_tracker import JobTracker
+from audio_assets import AudioAssetCache
+from audio_catalog import AudioCatalog
+from uploads import UploadError, audio_transfer_config, start_audio_upload, upload_and_start_job
+from botocore.config import Config
+from s3transfer.manager import TransferManager
 
 logger = get_logger(__name__)
 
 sample_audio_dir_path = "./sample-audio"
 
 s3 = boto3.client('s3')
-sm_client = boto3.client('stepfunctions')
 bucket = os.environ['BucketName']
 api_endpoint = os.environ['LLMAppAPIEndpoint']
 bedrock_region = os.environ['BedrockRegion']
+# the API only accepts requests signed with the task role, refreshed as the role's credentials rotate
+boto_session = boto3.session.Session()
+api_auth = AWS4Auth(region=boto_session.region_name or bedrock_region, service='execute-api',
+                    refreshable_credentials=boto_session.get_credentials())
+# presigned: audio goes straight to S3 in parallel parts through URLs from the API, s3: upload_file from this task
+upload_mode = os.environ.get('UPLOAD_MODE', 's3').lower()
 
+#the llm and agent are built once per server process and shared by all sessions and reruns
+@st.cache_resource
 def get_llm():
-    anthropic_model_kwargs = { #set parameters for an Anthropic model
-        "max_tokens_to_sample": 1024, #maximum generated tokens
-        "temperature": 0.2, #randomness of response, between 0 and 1
-        "top_p": 0.9, #distribution of options
-        "stop_sequences": ["\n\n Human:","\n\n Question:", "\nInstruction:"] #text that will stop the model from generating more text
-    }
-
-    llm = Bedrock(  #create a Bedrock llm client
-        model_id="anthropic.claude-v1", #Bedrock will pass the request to Anthropic Claude
-        model_kwargs=anthropic_model_kwargs,
-        region_name=bedrock_region
+    return build_llm(bedrock_region)
+
+@st.cache_resource
+def get_education_agent():
+    return build_education_agent(get_llm())
+
+#education text by condition, shared by all sessions and, with EDUCATION_CACHE_S3=true, by all tasks
+@st.cache_resource
+def get_education_cache():
+    persist = os.environ.get('EDUCATION_CACHE_S3', 'false').lower() == 'true'
+    return EducationCache(
+        max_entries=int(os.environ.get('EDUCATION_CACHE_SIZE', '512')),
+        ttl_seconds=int(os.environ.get('EDUCATION_CACHE_TTL_SECONDS', str(7 * 24 * 3600))),
+        s3=s3 if persist else None,
+        bucket=bucket if persist else None
     )
 
-    return llm
-
-def find_audio_files(directory):
-    audio_files = []
-    audio_absolute_path = []
-    
-    for root, dirs, files in os.walk(directory):
-        for file in files:
-            audio_files.append(file)
-            audio_absolute_path.append(os.path.join(root, file))
-    
-    logger.info(f"Found {len(audio_files)} audio files:")
-    for audio_file in audio_files:
-        logger.info(audio_file)
-    logger.info(f"Absolute paths of audio files {audio_absolute_path}")
-    return audio_files, audio_absolute_path
+#a bounded pool shared by all sessions, so education runs for several conditions at once
+#without flooding bedrock
+@st.cache_resource
+def get_education_executor():
+    return ThreadPoolExecutor(max_workers=int(os.environ.get('EDUCATION_MAX_WORKERS', '4')), thread_name_prefix='education')
+
+#one transfer manager per server process, its client pooling a connection for every concurrent part
+@st.cache_resource
+def get_transfer_manager():
+    max_concurrency = int(os.environ.get('UPLOAD_MAX_CONCURRENCY', '16'))
+    client = boto3.client('s3', config=Config(max_pool_connections=max_concurrency, tcp_keepalive=True))
+    return TransferManager(client, audio_transfer_config(
+        part_size_mb=int(os.environ.get('UPLOAD_PART_SIZE_MB', '8')), max_concurrency=max_concurrency))
+
+#sample audio bytes shared by all sessions, so a rerun neither reopens nor rereads the file
+@st.cache_resource
+def get_audio_assets():
+    return AudioAssetCache(max_bytes=int(os.environ.get('AUDIO_CACHE_MB', '128')) * 1024 * 1024)
+
+#catalog of the sample audio shared by all sessions, refreshed only where the library changed
+@st.cache_resource
+def get_audio_catalog():
+    return AudioCatalog(sample_audio_dir_path)
+
+#show the education on each condition, filling in each section as soon as it is generated
+def show_patient_education(job_name, med_condition):
+    education = st.session_state.setdefault('education', {}).setdefault(job_name, {})
+    conditions = distinct_conditions(med_condition)
+    st.subheader("Patient Education")
+    sections = {condition: st.empty() for condition in conditions}
+    for condition in conditions:
+        if condition in education:
+            sections[condition].write(f"{condition.upper()}:\n{education[condition]}")
+        else:
+            sections[condition].info(f"Preparing education on {condition}...")
+
+    pending = [condition for condition in conditions if condition not in education]
+    for condition, response, error in education_sections(
+            pending, lambda condition: condition_education(get_education_agent(), condition),
+            get_education_cache(), get_education_executor()):
+        if error is not None:
+            logger.error(error)
+            sections[condition].error(f"Couldn't prepare education on {condition}")
+            continue
+        education[condition] = response
+        sections[condition].write(f"{condition.upper()}:\n{response}")
+
+#show how much of an upload is done and its throughput so far
+def show_upload_progress(progress_bar, progress):
+    progress_bar.progress(progress.fraction, text=f"Uploading audio, {progress.throughput / 1024 ** 2:.1f} MiB/s")
 
 #upload audio file to S3 bucket
 def upload_audio_start_summarization(audio_file, bucket, s3_file):
 
     logger.info(f"Uploading {audio_file} to {bucket}/{s3_file}")
-    s3.upload_file(audio_file, bucket, s3_file)
-    logger.info('Audio uploaded')
+    future, progress = start_audio_upload(get_transfer_manager(), audio_file, bucket, s3_file)
+    progress_bar = st.progress(0.0, text='Uploading audio')
+    while not future.done():
+        show_upload_progress(progress_bar, progress)
+        time.sleep(0.2)
+    future.result()
+    progress_bar.empty()
+    logger.info(f"Audio uploaded: {progress.bytes_transferred} bytes in {progress.seconds:.2f} s, "
+                f"{progress.throughput / 1024 ** 2:.1f} MiB/s")
     ext = s3_file.split('.')[1]
     job_name = s3_file.split('/')[1].rstrip(f'.{ext}')
     job_name_list.append(job_name)
@@ -69,7 +131,7 @@ def submit_api_request(job_name, job_uri, bucket, language):
     output_prefix = 'audio_transcripts'
     data = {"job_name": job_name, "job_uri": job_uri, "output_location": bucket, "output_prefix": output_prefix, "language": language}
     headers = {"accept": "application/json", "Content-Type": "application/json"}
-    resp = req.post(f"{api_endpoint}api", headers=headers, json=data)
+    resp = req.post(f"{api_endpoint}api", headers=headers, json=data, auth=api_auth)
     if resp.status_code == 200:
         output = resp.text
     else:
@@ -77,35 +139,124 @@ def submit_api_request(job_name, job_uri, bucket, language):
         output = resp.text
     return output
 
+#long poll the result API once for the analysis result. The call waits up to wait_seconds for
+#the execution to finish, and with the etag of the last response it waits for a change.
+#Returns the result, or None when nothing changed, and the etag for the next call
+def poll_api_result(sm_exec_arn, etag=None, wait_seconds=25):
+    headers = {"accept": "application/json"}
+    if etag:
+        headers['If-None-Match'] = etag
+    url = f"{api_endpoint}api/{quote(sm_exec_arn, safe='')}"
+    resp = req.get(url, headers=headers, params={"wait": wait_seconds}, timeout=wait_seconds + 10, auth=api_auth)
+    if resp.status_code == 304:
+        return None, etag
+    resp.raise_for_status()
+    return resp.json(), resp.headers.get('ETag', '')
+
+#read the summary the bedrock lambda writes to S3 while it is generated
+def read_partial_summary(job_name, output_prefix='audio_transcripts'):
+    try:
+        s3_object = s3.get_object(Bucket=bucket, Key=f"{output_prefix}/summaries/{job_name}.txt")
+    except s3.exceptions.NoSuchKey:
+        return None
+    return s3_object['Body'].read().decode('utf-8')
+
+#read an output that the workflow passed by reference, as <name>_ref, when it was too large for the state
+def load_artifact(output, name):
+    if name in output:
+        return output[name]
+    ref = output[f"{name}_ref"]
+    data = s3.get_object(Bucket=ref['bucket'], Key=ref['key'])['Body'].read()
+    if hashlib.sha256(data).hexdigest() != ref['sha256']:
+        raise Exception(f"s3://{ref['bucket']}/{ref['key']} does not match its digest")
+    return json.loads(data) if ref['key'].endswith('.json') else data.decode('utf-8')
+
+#build the table of detected entities, from the entity_columns arrays or from an entities list
+def entity_dataframe(output):
+    if 'entities' in output or 'entities_ref' in output:
+        entities = load_artifact(output, 'entities')
+        return pd.DataFrame.from_records(entities, columns=['Text', 'Category', 'Type'])
+    table = load_artifact(output, 'entity_columns')
+    columns = table['columns']
+    df = pd.DataFrame({
+        'Text': columns['Text'],
+        'Category': pd.Categorical.from_codes(columns['Category'], categories=table['categories']),
+        'Type': pd.Categorical.from_codes(columns['Type'], categories=table['types'])
+    })
+    # attribute rows, such as dosages, belong to the entity in their Parent row
+    return df[pd.Series(columns['Parent']) == -1].reset_index(drop=True)
+
+#one job tracker per server process, shared by all sessions. Its threads poll for results
+#so the script thread of a session never does
+@st.cache_resource
+def get_job_tracker():
+    return JobTracker(
+        poll_api_result,
+        read_partial_summary,
+        max_workers=int(os.environ.get('JOB_TRACKER_MAX_WORKERS', '32'))
+    )
+
+#show the progress of a running job, rerunning the page once it is done
+@st.fragment(run_every=2)
+def show_job_progress(session_id, job_name):
+    job = get_job_tracker().get(session_id, job_name)
+    if job is None or job.done:
+        st.rerun()
+    st.info(f"Analyzing conversation... {int(time.time() - job.started_at)}s")
+    # the summary is read from S3 on the fragment's timer, the result itself is long polled
+    partial_summary = get_job_tracker().refresh_partial_summary(job)
+    if partial_summary:
+        st.write("# Patient Chart Summary (generating...):\n" + partial_summary)
+
+#show the result of a finished job
+def show_job_result(job):
+    if job.status == 'ERROR':
+        logger.error(job.error)
+        st.error('Error submitting conversation for analysis')
+        return
+    if job.status != 'SUCCEEDED':
+        logger.error(f"Step function failed with status: {job.status}")
+        st.error('Error submitting conversation for analysis')
+        return
+    response = job.result['output']['Outputs']
+    st.success('Conversation analysis completed and Patient Chart Creation Completed')
+    bedrock_output = load_artifact(response['BedrockOutput'], 'bedrock_model_result')
+    st.write("# Patient Chart Summary:\n", bedrock_output)
+    df = entity_dataframe(response['ComprehendMedicalOutput'])
+    st.write("# Key Health Entities:", df)
+    # with the entity summary pass, the entities that made it into the chart summary are listed too
+    if 'ComprehendMedicalSummaryOutput' in response:
+        st.write("# Health Entities In The Summary:", entity_dataframe(response['ComprehendMedicalSummaryOutput']))
+    med_condition = df['Text'][df['Category'] == 'MEDICAL_CONDITION'].tolist()
+    _med_condition = '\n'.join(med_condition)
+
+    if med_condition:
+        logger.info(f"All Medical condition detected from conversation:\n{_med_condition}")
+        show_patient_education(job.job_name, med_condition)
+    else:
+        logger.info("No medical condition detected from conversation")
+
 languages = ['English']
 
 st.set_page_config(page_title="Patient Chart Automation")
 st.markdown("# Patient Chart Automation for Medical Providers")
 
-audio_list, audio_list_path = find_audio_files(sample_audio_dir_path)
+if 'session_id' not in st.session_state:
+    st.session_state.session_id = str(uuid.uuid4())
 
-audio_mapping = {}
-formatted_audio_name_list = []
-for audio in audio_list:
-    base_name = os.path.splitext(audio)[0]
-    parts = base_name.split("_")
-    capitalized_parts = [part.capitalize() for part in parts]
-    formatted_audio_name = " ".join(capitalized_parts)
-    formatted_audio_name_list.append(formatted_audio_name)
-    audio_mapping[formatted_audio_name] = audio
-
-formatted_audio_name_list.insert(0, "Select")
+audio_catalog = get_audio_catalog()
+audio_catalog.refresh()
 
 with st.sidebar:
     st.header("Patient Provider Conversations")
-    audio_select = st.selectbox("**Sample Audio**", formatted_audio_name_list)
+    audio_select = st.selectbox("**Sample Audio**", ["Select", *audio_catalog.names()])
 
 if audio_select != "Select":
-    audio = audio_mapping[audio_select]
-    if audio in audio_list:
+    audio_entry = audio_catalog.get(audio_select)
+    if audio_entry is not None:
+        audio, audio_path = audio_entry.name, audio_entry.path
         st.subheader("Play Audio")
-        audio_file = open(audio_list_path[audio_list.index(audio)], 'rb')
-        st.audio(audio_file, format='audio/wav')
+        st.audio(get_audio_assets().get(audio_path), format='audio/wav')
 
         default_lang_ix = languages.index('English')
         st.subheader("Select an output language")
@@ -117,72 +268,52 @@ if audio_select != "Select":
         if audio is not None:
             if 'wav' in audio or 'mp4' in audio or 'mp3' in audio:        
                 st.success(audio_select + ' ready for analysis')
-                if st.button('Start'):
+                start = st.button('Start')
+                if start and upload_mode == 'presigned':
+                    with st.spinner('Uploading conversation and starting analysis job...'):
+                        progress_bar = st.progress(0.0, text='Uploading audio')
+                        try:
+                            response = upload_and_start_job(
+                                audio_path, api_endpoint, language, auth=api_auth,
+                                max_workers=int(os.environ.get('UPLOAD_MAX_CONCURRENCY', '16')),
+                                on_progress=lambda progress: show_upload_progress(progress_bar, progress))
+                        except UploadError as e:
+                            logger.error(e)
+                            st.error('Error uploading audio file for analysis')
+                            st.stop()
+                        progress_bar.empty()
+                    st.session_state.sm_exec_arn = response['sm_execution_arn']
+                    st.session_state.job_name = response['job_name']
+                    get_job_tracker().track(st.session_state.session_id, response['job_name'], response['sm_execution_arn'])
+                elif start:
                     with st.spinner('Starting Patient Chart Creation...'):
-                        job_name_list, job_uri, output_location = upload_audio_start_summarization(audio_list_path[audio_list.index(audio)], bucket, f'audio_conversations/{str(uuid.uuid4())}-{audio}')
+                        job_name_list, job_uri, output_location = upload_audio_start_summarization(audio_path, bucket, f'audio_conversations/{str(uuid.uuid4())}-{audio}')
                     if job_name_list:
                         with st.spinner('Starting conversation analysis job..This should take a couple of seconds or minutes'):
                             response = json.loads(submit_api_request(job_name_list[0], job_uri, output_location, language))
-                            try:
-                                st.session_state.sm_exec_arn = response['sm_execution_arn']
-                                response = sm_client.describe_execution(executionArn=st.session_state.sm_exec_arn)
-                                status = response['status']
-                                while status == 'RUNNING':
-                                    logger.info("Still running, checking again...")
-                                    time.sleep(5)
-                                    response = sm_client.describe_execution(executionArn=st.session_state.sm_exec_arn)
-                                    status = response['status']
-                                if status == 'SUCCEEDED':
-                                    response = json.loads(response['output'])['Outputs']
-                                else:
-                                    raise Exception(f"Step function failed with status: {response['status']}")
-                                st.success('Conversation analysis completed and Patient Chart Creation Completed')
-                                bedrock_output = response['BedrockOutput']['bedrock_model_result']
-                                st.write("# Patient Chart Summary:\n", bedrock_output)
-                                text, category, type, med_condition, = [], [], [], []
-                                for entity in response['ComprehendMedicalOutput']['entities']:
-                                    text.append(entity['Text'])
-                                    category.append(entity['Category'])
-                                    type.append(entity['Type'])
-                                    if entity['Category'] == 'MEDICAL_CONDITION':
-                                        med_condition.append(entity['Text'])
-                                        _med_condition = '\n'.join(med_condition)
-                                df = pd.DataFrame({'Text': text, 'Category': category, 'Type': type})
-                                st.write("# Key Health Entities:", df)
-
-                                if med_condition:
-                                    logger.info(f"All Medical condition detected from conversation:\n{_med_condition}")
-                                    llm = get_llm()
-                                    tools = load_tools(['wikipedia'], llm=llm)
-
-                                    agent = initialize_agent(
-                                        tools,
-                                        agent=AgentType.ZERO_SHOT_REACT_DESCRIPTION,
-                                        verbose=True,
-                                        llm=llm,
-                                        handle_parsing_errors=True
-                                    )
-                                    # answer = ""
-                                    # for condition in med_condition:
-                                    #     response = agent.run(f"Provide a brief description of {condition}")
-                                    #     condition_up = condition.upper()
-                                    #     answer += f"{condition_up}:\n{response}\n\n"
-                                    response = agent.run(f"""Based on this summary: \n {bedrock_output} \n Identify the key health condition the patient 
-                                                         is diagnozed with and provide detailed description of the condition to educate the patient""")
-                                    st.subheader("Patient Education")
-                                    # st.write(answer)
-                                    st.write(response)
-
-                                else:
-                                    logger.info("No medical condition detected from conversation")
-
-                            except Exception as e:
-                                logger.error(e)
-                                st.error('Error submitting conversation for analysis')
-                                st.stop()
+                        if 'sm_execution_arn' not in response:
+                            logger.error(response)
+                            st.error('Error submitting conversation for analysis')
+                            st.stop()
+                        # a deduplicated submission runs under the job name of the existing execution
+                        job_name = response.get('job_name', job_name_list[0])
+                        st.session_state.sm_exec_arn = response['sm_execution_arn']
+                        st.session_state.job_name = job_name
+                        get_job_tracker().track(st.session_state.session_id, job_name, response['sm_execution_arn'])
                     else:
                         st.error('Error uploading audio file for analysis')
                         st.stop()
+
+                if 'job_name' in st.session_state:
+                    job = get_job_tracker().get(st.session_state.session_id, st.session_state.job_name)
+                    if job is not None and job.done:
+                        try:
+                            show_job_result(job)
+                        except Exception as e:
+                            logger.error(e)
+                            st.error('Error submitting conversation for analysis')
+                    elif job is not None:
+                        show_job_progress(st.session_state.session_id, job.job_name)
         else:
             st.failure('Incorrect file type provided. Please select a speech wav file or a mp3 or a mp4 file to proceed')
 
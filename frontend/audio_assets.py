@@ -0,0 +1,53 @@
+import os
+import threading
+from collections import OrderedDict
+
+
+class AudioAssetCache:
+    '''
+    Bytes of the sample audio files, read once and kept in memory with LRU eviction under
+    max_bytes in total. Entries are keyed by path, modification time and size, so a replaced
+    file is read again. Files larger than max_file_bytes are read on every request and not kept
+    '''
+
+    def __init__(self, max_bytes=64 * 1024 * 1024, max_file_bytes=None):
+        self.max_bytes = max_bytes
+        self.max_file_bytes = max_bytes if max_file_bytes is None else min(max_file_bytes, max_bytes)
+        self.entries = OrderedDict()
+        self.keys = {}
+        self.size = 0
+        self.lock = threading.Lock()
+        self.stats = {'hits': 0, 'misses': 0, 'evictions': 0}
+
+    def get(self, path):
+        stat = os.stat(path)
+        key = (path, stat.st_mtime_ns, stat.st_size)
+        with self.lock:
+            data = self.entries.get(key)
+            if data is not None:
+                self.entries.move_to_end(key)
+                self.stats['hits'] += 1
+                return data
+            self.stats['misses'] += 1
+
+        with open(path, 'rb') as audio_file:
+            data = audio_file.read()
+        if len(data) > self.max_file_bytes or len(data) != stat.st_size:
+            # too large to keep, or written to while it was read
+            return data
+
+        with self.lock:
+            # drop the entry of an older version of the file
+            stale_key = self.keys.get(path)
+            if stale_key is not None and stale_key != key and stale_key in self.entries:
+                self.size -= len(self.entries.pop(stale_key))
+            if key not in self.entries:
+                self.entries[key] = data
+                self.size += len(data)
+            self.keys[path] = key
+            while self.size > self.max_bytes:
+                (evicted_path, _, _), evicted = self.entries.popitem(last=False)
+                self.size -= len(evicted)
+                self.keys.pop(evicted_path, None)
+                self.stats['evictions'] += 1
+            return self.entries.get(key, data)
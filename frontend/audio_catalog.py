@@ -0,0 +1,86 @@
+import logging
+import os
+import threading
+import time
+from collections import namedtuple
+
+logger = logging.getLogger(__name__)
+
+AudioFile = namedtuple('AudioFile', ['display_name', 'name', 'path', 'size', 'mtime_ns'])
+
+#the name shown for an audio file, "sample_audio_flu.mp3" as "Sample Audio Flu"
+def display_name(file_name):
+    return " ".join(part.capitalize() for part in os.path.splitext(file_name)[0].split("_"))
+
+
+class AudioCatalog:
+    '''
+    Audio files under a directory by display name. A refresh stats every directory and only
+    lists again the ones whose mtime changed, since adding, removing or renaming a file changes
+    the mtime of its directory. Refreshes within min_refresh_seconds of the last one do nothing
+    '''
+
+    def __init__(self, root, min_refresh_seconds=2.0):
+        self.root = root
+        self.min_refresh_seconds = min_refresh_seconds
+        # directory path -> (mtime_ns, files of the directory, subdirectory paths)
+        self.directories = {}
+        self.files = {}
+        self.display_names = []
+        self.refreshed_at = None
+        self.lock = threading.Lock()
+        self.stats = {'refreshes': 0, 'directories_listed': 0}
+
+    def refresh(self, force=False):
+        with self.lock:
+            now = time.monotonic()
+            if not force and self.refreshed_at is not None and now - self.refreshed_at < self.min_refresh_seconds:
+                return False
+            self.refreshed_at = now
+            self.stats['refreshes'] += 1
+
+            directories, changed, pending = {}, False, [self.root]
+            while pending:
+                directory = pending.pop()
+                try:
+                    mtime_ns = os.stat(directory).st_mtime_ns
+                except FileNotFoundError:
+                    changed = True
+                    continue
+                entry = self.directories.get(directory)
+                if entry is None or entry[0] != mtime_ns:
+                    entry = self.list_directory(directory, mtime_ns)
+                    changed = True
+                directories[directory] = entry
+                pending.extend(reversed(entry[2]))
+            changed = changed or directories.keys() != self.directories.keys()
+            self.directories = directories
+
+            if changed:
+                files = {}
+                for _, directory_files, _ in directories.values():
+                    for audio_file in directory_files:
+                        # the first file found under a display name wins
+                        files.setdefault(audio_file.display_name, audio_file)
+                self.files = files
+                self.display_names = sorted(files)
+                logger.info(f"Found {len(files)} audio files under {self.root}")
+            return changed
+
+    def list_directory(self, directory, mtime_ns):
+        self.stats['directories_listed'] += 1
+        files, subdirectories = [], []
+        with os.scandir(directory) as entries:
+            for entry in sorted(entries, key=lambda entry: entry.name):
+                if entry.is_dir():
+                    subdirectories.append(entry.path)
+                elif entry.is_file():
+                    stat = entry.stat()
+                    files.append(AudioFile(display_name(entry.name), entry.name, entry.path, stat.st_size, stat.st_mtime_ns))
+        return mtime_ns, files, subdirectories
+
+    def get(self, display_name):
+        return self.files.get(display_name)
+
+    def names(self):
+        return self.display_names
@@ -0,0 +1,134 @@
+"""Upload time and throughput of hour-long consult recordings with the default settings of
+s3.upload_file, against the transfer settings of audio_transfer_config. Uploads go to a
+local S3 stand-in that limits every connection to --connection-mbps and answers each request
+after --latency seconds, like a distant region would; no AWS account is used.
+
+    $ pip install -r ../requirements.txt
+    $ python bench_audio_upload.py --connection-mbps 40 --latency 0.03
+"""
+import argparse
+import http.server
+import os
+import pathlib
+import socket
+import sys
+import tempfile
+import threading
+import time
+import uuid
+
+import boto3
+from boto3.s3.transfer import TransferConfig as DefaultTransferConfig
+from botocore.config import Config
+from s3transfer.manager import TransferConfig, TransferManager
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parents[1]))
+from uploads import audio_transfer_config, start_audio_upload  # noqa: E402
+
+# an hour of consult audio in the formats the sample library holds
+RECORDINGS = (("mp3 128 kbps", 57_600_000), ("wav 16 kHz mono", 115_200_000))
+
+
+class StandInS3:
+    """PutObject and multipart upload endpoints that throttle each connection and discard the data."""
+
+    def __init__(self, connection_mbps, latency):
+        self.bytes_per_second = connection_mbps * 1024 * 1024 / 8
+        self.latency = latency
+        self.requests = 0
+        self.lock = threading.Lock()
+
+    def __enter__(self):
+        endpoint = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def setup(self):
+                super().setup()
+                self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+            def read_body(self):
+                remaining = int(self.headers.get("Content-Length", 0))
+                while remaining:
+                    piece = self.rfile.read(min(remaining, 65536))
+                    remaining -= len(piece)
+                    time.sleep(len(piece) / endpoint.bytes_per_second)
+
+            def answer(self, body=b"", etag=None):
+                with endpoint.lock:
+                    endpoint.requests += 1
+                time.sleep(endpoint.latency)
+                self.send_response(200)
+                if etag:
+                    self.send_header("ETag", etag)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_PUT(self):
+                self.read_body()
+                self.answer(etag=f'"{uuid.uuid4().hex}"')
+
+            def do_POST(self):
+                self.read_body()
+                if self.path.endswith("?uploads"):
+                    self.answer(b"<InitiateMultipartUploadResult><UploadId>" + uuid.uuid4().hex.encode()
+                                + b"</UploadId></InitiateMultipartUploadResult>")
+                else:
+                    self.answer(b'<CompleteMultipartUploadResult><ETag>"done"</ETag></CompleteMultipartUploadResult>')
+
+            def log_message(self, *args):
+                pass
+
+        self.server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def upload(endpoint, path, config, max_pool_connections):
+    client = boto3.client("s3", endpoint_url=endpoint.url, region_name="us-east-1",
+                          aws_access_key_id="testing", aws_secret_access_key="testing",
+                          config=Config(s3={"addressing_style": "path"}, max_pool_connections=max_pool_connections))
+    requests_before = endpoint.requests
+    with TransferManager(client, config) as manager:
+        future, progress = start_audio_upload(manager, path, "bucket", "audio_conversations/bench.audio")
+        future.result()
+    return progress, endpoint.requests - requests_before
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--connection-mbps", type=float, default=40)
+    parser.add_argument("--latency", type=float, default=0.03)
+    args = parser.parse_args()
+
+    # the settings s3.upload_file uses when it is given no config
+    default = DefaultTransferConfig()
+    settings = [
+        ("upload_file defaults (8 MiB, 10)", TransferConfig(
+            multipart_threshold=default.multipart_threshold, multipart_chunksize=default.multipart_chunksize,
+            max_request_concurrency=default.max_request_concurrency), 10),
+    ] + [
+        (f"audio_transfer_config({part_mb} MiB, {concurrency})", audio_transfer_config(part_mb, concurrency), concurrency)
+        for part_mb, concurrency in ((8, 16), (5, 24), (16, 16), (32, 16))
+    ]
+
+    print(f"{'recording':<16} {'settings':<34} {'seconds':>8} {'MiB/s':>7} {'requests':>8}")
+    with StandInS3(args.connection_mbps, args.latency) as endpoint, tempfile.TemporaryDirectory() as directory:
+        for label, size in RECORDINGS:
+            path = os.path.join(directory, "recording.audio")
+            with open(path, "wb") as recording:
+                recording.truncate(size)
+            for name, config, concurrency in settings:
+                progress, requests = upload(endpoint, path, config, concurrency)
+                print(f"{label:<16} {name:<34} {progress.seconds:>8.2f} {progress.throughput / 1024 ** 2:>7.1f} {requests:>8}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,60 @@
+"""Cost of building the Bedrock llm and the wikipedia agent for every finished chart,
+against building them once per process, the way get_education_agent does with
+st.cache_resource. Nothing is sent to Bedrock or wikipedia: only construction is timed.
+
+    $ pip install -r ../requirements.txt
+    $ python bench_education_agent.py --charts 50
+"""
+import argparse
+import functools
+import os
+import pathlib
+import statistics
+import sys
+import time
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parents[1]))
+os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+os.environ.setdefault("AWS_ACCESS_KEY_ID", "testing")
+os.environ.setdefault("AWS_SECRET_ACCESS_KEY", "testing")
+
+started = time.perf_counter()
+from education import build_education_agent, build_llm  # noqa: E402
+import_ms = (time.perf_counter() - started) * 1000
+
+
+def measure(fn, runs):
+    samples = []
+    for _ in range(runs):
+        started = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - started) * 1000)
+    samples.sort()
+    return statistics.median(samples), samples[min(len(samples) - 1, int(len(samples) * 0.9))]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--charts", type=int, default=50)
+    parser.add_argument("--region", default="us-east-1")
+    args = parser.parse_args()
+
+    def per_chart():
+        return build_education_agent(build_llm(args.region))
+
+    # stands in for st.cache_resource, which needs a running streamlit server
+    @functools.lru_cache(maxsize=None)
+    def cached():
+        return build_education_agent(build_llm(args.region))
+
+    print(f"import langchain and education.py: {import_ms:.1f} ms (once per process)")
+    started = time.perf_counter()
+    cached()
+    print(f"first build: {(time.perf_counter() - started) * 1000:.1f} ms")
+    for label, fn in (("built per chart", per_chart), ("cached per process", cached)):
+        median, p90 = measure(fn, args.charts)
+        print(f"{label}: p50 {median:.2f} ms  p90 {p90:.2f} ms  total {median * args.charts / 1000:.2f} s for {args.charts} charts")
+
+
+if __name__ == "__main__":
+    main()
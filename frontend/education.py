@@ -0,0 +1,36 @@
+from langchain.agents import load_tools, initialize_agent, AgentType
+from langchain.llms import Bedrock
+
+def build_llm(region_name):
+    anthropic_model_kwargs = { #set parameters for an Anthropic model
+        "max_tokens_to_sample": 1024, #maximum generated tokens
+        "temperature": 0.2, #randomness of response, between 0 and 1
+        "top_p": 0.9, #distribution of options
+        "stop_sequences": ["\n\n Human:","\n\n Question:", "\nInstruction:"] #text that will stop the model from generating more text
+    }
+
+    llm = Bedrock(  #create a Bedrock llm client
+        model_id="anthropic.claude-v1", #Bedrock will pass the request to Anthropic Claude
+        model_kwargs=anthropic_model_kwargs,
+        region_name=region_name
+    )
+
+    return llm
+
+#build the agent that looks conditions up on wikipedia. It keeps no memory between runs,
+#so one agent can serve every session
+def build_education_agent(llm):
+    tools = load_tools(['wikipedia'], llm=llm)
+
+    agent = initialize_agent(
+        tools,
+        agent=AgentType.ZERO_SHOT_REACT_DESCRIPTION,
+        verbose=True,
+        llm=llm,
+        handle_parsing_errors=True
+    )
+    return agent
+
+#educate the patient about one medical condition
+def condition_education(agent, condition):
+    return agent.run(f"Provide a brief description of {condition} to educate the patient")
@@ -0,0 +1,135 @@
+import hashlib
+import json
+import logging
+import re
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from concurrent.futures import as_completed
+
+from botocore.exceptions import ClientError
+
+logger = logging.getLogger(__name__)
+
+#normalize the text of a medical condition, so "Pneumonia", " pneumonia." and "PNEUMONIA" share an entry
+def normalize_condition(condition):
+    condition = unicodedata.normalize('NFKC', condition).casefold()
+    condition = re.sub(r'\s+', ' ', condition)
+    return condition.strip(' .,;:!?-\'"()')
+
+#cache key of a condition, its ICD-10-CM code when one is known
+def education_cache_key(condition, icd10_code=None):
+    if icd10_code:
+        return f"icd10:{icd10_code.upper()}"
+    return f"condition:{normalize_condition(condition)}"
+
+#the distinct conditions of a list, in order, each as first written
+def distinct_conditions(conditions):
+    distinct = {}
+    for condition in conditions:
+        distinct.setdefault(normalize_condition(condition), condition)
+    return list(distinct.values())
+
+#generate the education of each condition as a task on executor, through the cache, and yield
+#(condition, education, error) as each one finishes
+def education_sections(conditions, educate, cache, executor):
+    futures = {
+        executor.submit(cache.get_or_create, education_cache_key(condition), lambda condition=condition: educate(condition)): condition
+        for condition in distinct_conditions(conditions)
+    }
+    for future in as_completed(futures):
+        try:
+            yield futures[future], future.result(), None
+        except Exception as err:
+            yield futures[future], None, err
+
+
+class EducationCache:
+    '''
+    Patient education text by condition, kept in memory with LRU eviction and a TTL and,
+    when a bucket is given, in S3 so every task of the service shares it. Only one thread
+    generates the text of a key at a time, the others wait for it
+    '''
+
+    def __init__(self, max_entries=512, ttl_seconds=7 * 24 * 3600, s3=None, bucket=None, prefix='cache/education/'):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.s3 = s3
+        self.bucket = bucket
+        self.prefix = prefix
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.key_locks = {}
+        self.stats = {'memory_hits': 0, 's3_hits': 0, 'misses': 0}
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                if entry[1] > time.time():
+                    self.entries.move_to_end(key)
+                    self.stats['memory_hits'] += 1
+                    return entry[0]
+                del self.entries[key]
+
+        entry = self.read_s3(key)
+        if entry is None:
+            return None
+        with self.lock:
+            self.stats['s3_hits'] += 1
+        self.remember(key, entry['education'], entry['expires_at'])
+        return entry['education']
+
+    def get_or_create(self, key, create):
+        education = self.get(key)
+        if education is not None:
+            return education
+        with self.lock:
+            key_lock = self.key_locks.setdefault(key, threading.Lock())
+        with key_lock:
+            # another thread may have generated it while this one waited
+            education = self.get(key)
+            if education is None:
+                with self.lock:
+                    self.stats['misses'] += 1
+                education = create()
+                self.put(key, education)
+        with self.lock:
+            self.key_locks.pop(key, None)
+        return education
+
+    def put(self, key, education):
+        expires_at = time.time() + self.ttl_seconds
+        self.remember(key, education, expires_at)
+        if self.bucket:
+            try:
+                self.s3.put_object(
+                    Bucket=self.bucket,
+                    Key=self.s3_key(key),
+                    Body=json.dumps({"key": key, "education": education, "expires_at": expires_at}).encode('utf-8'),
+                    ContentType='application/json'
+                )
+            except ClientError as err:
+                logger.warning(f"Couldn't write education cache entry {key}: {err}")
+
+    def remember(self, key, education, expires_at):
+        with self.lock:
+            self.entries[key] = (education, expires_at)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def read_s3(self, key):
+        if not self.bucket:
+            return None
+        try:
+            entry = json.loads(self.s3.get_object(Bucket=self.bucket, Key=self.s3_key(key))['Body'].read())
+        except ClientError as err:
+            if err.response['Error']['Code'] != 'NoSuchKey':
+                logger.warning(f"Couldn't read education cache entry {key}: {err}")
+            return None
+        return entry if entry['expires_at'] > time.time() else None
+
+    def s3_key(self, key):
+        return self.prefix + hashlib.sha256(key.encode('utf-8')).hexdigest() + '.json'
@@ -0,0 +1,100 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+
+class TrackedJob:
+    '''
+    State of one analysis job, updated by a tracker thread and read by the Streamlit
+    script on every rerun. status is RUNNING until the execution result arrives
+    '''
+
+    def __init__(self, job_name, sm_exec_arn):
+        self.job_name = job_name
+        self.sm_exec_arn = sm_exec_arn
+        self.status = 'RUNNING'
+        self.result = None
+        self.error = None
+        self.partial_summary = None
+        self.partial_summary_read_at = None
+        self.etag = None
+        self.started_at = time.time()
+        self.finished_at = None
+
+    @property
+    def done(self):
+        return self.status != 'RUNNING'
+
+
+class JobTracker:
+    '''
+    Polls for the results of analysis jobs on a shared pool of background threads, so the
+    Streamlit script thread of a session never blocks on one. Each task makes one poll_result
+    call, a long poll, and submits the job again while it is running, so jobs take turns on
+    the pool however many are in flight. poll_result(sm_exec_arn, etag) returns the result,
+    or None when the execution has not changed, and the etag to send with the next call.
+    Jobs are kept per session id until forgotten or until they have been finished for longer
+    than keep_seconds. Partial summaries are read on their own timer, apart from the polls
+    '''
+
+    def __init__(self, poll_result, read_partial_summary=None, max_workers=32, keep_seconds=3600,
+                 partial_summary_interval_seconds=2):
+        self.poll_result = poll_result
+        self.read_partial_summary = read_partial_summary
+        self.keep_seconds = keep_seconds
+        self.partial_summary_interval_seconds = partial_summary_interval_seconds
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='job-tracker')
+        self.jobs = {}
+        self.lock = threading.Lock()
+
+    def track(self, session_id, job_name, sm_exec_arn):
+        with self.lock:
+            self.expire()
+            job = self.jobs.get((session_id, job_name))
+            if job is not None and job.sm_exec_arn == sm_exec_arn:
+                return job
+            job = self.jobs[(session_id, job_name)] = TrackedJob(job_name, sm_exec_arn)
+        self.executor.submit(self.run, job)
+        return job
+
+    def get(self, session_id, job_name):
+        with self.lock:
+            return self.jobs.get((session_id, job_name))
+
+    def forget(self, session_id, job_name):
+        with self.lock:
+            self.jobs.pop((session_id, job_name), None)
+
+    def run(self, job):
+        # status changes last, so a job that is done has all its other fields set
+        try:
+            result, job.etag = self.poll_result(job.sm_exec_arn, job.etag)
+        except Exception as err:
+            job.error = err
+            job.finished_at = time.time()
+            job.status = 'ERROR'
+            return
+        if result is None or result['status'] == 'RUNNING':
+            self.executor.submit(self.run, job)
+            return
+        job.result = result
+        job.finished_at = time.time()
+        job.status = result['status']
+
+    def refresh_partial_summary(self, job):
+        if self.read_partial_summary is None or job.done:
+            return job.partial_summary
+        now = time.monotonic()
+        with self.lock:
+            # at most one read per interval, however many reruns ask for it
+            if job.partial_summary_read_at is not None and now - job.partial_summary_read_at < self.partial_summary_interval_seconds:
+                return job.partial_summary
+            job.partial_summary_read_at = now
+        job.partial_summary = self.read_partial_summary(job.job_name) or job.partial_summary
+        return job.partial_summary
+
+    def expire(self):
+        now = time.time()
+        for key, job in list(self.jobs.items()):
+            if job.done and now - job.finished_at > self.keep_seconds:
+                del self.jobs[key]
@@ -0,0 +1,5 @@
+import pathlib
+import sys
+
+# frontend modules are copied flat into the container, so import them the same way
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parents[1]))
@@ -0,0 +1,70 @@
+import os
+
+from audio_assets import AudioAssetCache
+
+
+def write(tmp_path, name, size, fill=b"a"):
+    path = tmp_path / name
+    path.write_bytes(fill * size)
+    return str(path)
+
+
+def open_descriptors():
+    return len(os.listdir("/proc/self/fd"))
+
+
+def test_file_is_read_once_and_shared(tmp_path):
+    cache = AudioAssetCache(max_bytes=1000)
+    path = write(tmp_path, "a.mp3", 100)
+
+    first = cache.get(path)
+    second = cache.get(path)
+
+    assert first is second
+    assert cache.stats == {"hits": 1, "misses": 1, "evictions": 0}
+
+
+def test_changed_file_is_read_again_and_replaces_the_old_entry(tmp_path):
+    cache = AudioAssetCache(max_bytes=1000)
+    path = write(tmp_path, "a.mp3", 100)
+    cache.get(path)
+
+    write(tmp_path, "a.mp3", 200, fill=b"b")
+    os.utime(path, ns=(1, 1))
+
+    assert cache.get(path) == b"b" * 200
+    assert len(cache.entries) == 1 and cache.size == 200
+
+
+def test_memory_stays_within_the_budget(tmp_path):
+    cache = AudioAssetCache(max_bytes=250)
+    paths = [write(tmp_path, f"{index}.mp3", 100) for index in range(3)]
+
+    for path in paths:
+        cache.get(path)
+    cache.get(paths[1])
+    cache.get(write(tmp_path, "3.mp3", 100))
+
+    assert cache.size <= 250
+    assert [key[0] for key in cache.entries] == [paths[1], str(tmp_path / "3.mp3")]
+    assert cache.stats["evictions"] == 2
+
+
+def test_large_file_is_served_without_being_kept(tmp_path):
+    cache = AudioAssetCache(max_bytes=1000, max_file_bytes=100)
+    path = write(tmp_path, "long.wav", 500)
+
+    assert len(cache.get(path)) == 500
+    assert cache.size == 0 and not cache.entries
+
+
+def test_no_file_descriptor_is_left_open(tmp_path):
+    cache = AudioAssetCache(max_bytes=100, max_file_bytes=50)
+    paths = [write(tmp_path, f"{index}.mp3", size) for index, size in enumerate((40, 60, 40))]
+    before = open_descriptors()
+
+    for _ in range(20):
+        for path in paths:
+            cache.get(path)
+
+    assert open_descriptors() == before
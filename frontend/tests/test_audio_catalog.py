@@ -0,0 +1,77 @@
+import os
+
+from audio_catalog import AudioCatalog, display_name
+
+
+def touch(path, data=b"audio"):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_bytes(data)
+    return path
+
+
+def bump_mtime(path):
+    stat = os.stat(path)
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000_000))
+
+
+def test_display_name():
+    assert display_name("sample_audio_flu.mp3") == "Sample Audio Flu"
+
+
+def test_files_are_found_in_nested_directories(tmp_path):
+    touch(tmp_path / "sample_audio_flu.mp3")
+    touch(tmp_path / "cardiology" / "chest_pain.wav")
+    catalog = AudioCatalog(str(tmp_path))
+
+    assert catalog.refresh() is True
+
+    assert catalog.names() == ["Chest Pain", "Sample Audio Flu"]
+    entry = catalog.get("Chest Pain")
+    assert entry.name == "chest_pain.wav"
+    assert entry.path == str(tmp_path / "cardiology" / "chest_pain.wav")
+    assert catalog.get("Missing") is None
+
+
+def test_refresh_lists_only_changed_directories(tmp_path):
+    for index in range(3):
+        touch(tmp_path / f"ward_{index}" / f"visit_{index}.mp3")
+    catalog = AudioCatalog(str(tmp_path), min_refresh_seconds=0)
+    catalog.refresh()
+    assert catalog.stats["directories_listed"] == 4
+
+    assert catalog.refresh() is False
+    assert catalog.stats["directories_listed"] == 4
+
+    touch(tmp_path / "ward_1" / "visit_new.mp3")
+    bump_mtime(tmp_path / "ward_1")
+    assert catalog.refresh() is True
+    assert catalog.stats["directories_listed"] == 5
+    assert "Visit New" in catalog.names()
+
+
+def test_removed_files_and_directories_leave_the_catalog(tmp_path):
+    touch(tmp_path / "ward" / "visit.mp3")
+    touch(tmp_path / "other.mp3")
+    catalog = AudioCatalog(str(tmp_path), min_refresh_seconds=0)
+    catalog.refresh()
+
+    (tmp_path / "ward" / "visit.mp3").unlink()
+    (tmp_path / "ward").rmdir()
+    bump_mtime(tmp_path)
+
+    assert catalog.refresh() is True
+    assert catalog.names() == ["Other"]
+
+
+def test_refreshes_are_throttled(tmp_path):
+    touch(tmp_path / "a.mp3")
+    catalog = AudioCatalog(str(tmp_path), min_refresh_seconds=60)
+    catalog.refresh()
+
+    touch(tmp_path / "b.mp3")
+    bump_mtime(tmp_path)
+
+    assert catalog.refresh() is False
+    assert catalog.names() == ["A"]
+    assert catalog.refresh(force=True) is True
+    assert catalog.names() == ["A", "B"]
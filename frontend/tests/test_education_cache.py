@@ -0,0 +1,153 @@
+import io
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from botocore.exceptions import ClientError
+
+from education_cache import EducationCache, education_cache_key, education_sections, normalize_condition
+
+
+class FakeS3:
+    def __init__(self):
+        self.objects = {}
+
+    def get_object(self, Bucket, Key, **kwargs):
+        if (Bucket, Key) not in self.objects:
+            raise ClientError({"Error": {"Code": "NoSuchKey", "Message": "Not Found"}}, "GetObject")
+        return {"Body": io.BytesIO(self.objects[(Bucket, Key)])}
+
+    def put_object(self, Bucket, Key, Body, **kwargs):
+        self.objects[(Bucket, Key)] = Body
+
+
+def test_conditions_are_normalized():
+    assert normalize_condition(" Pneumonia.") == normalize_condition("PNEUMONIA") == "pneumonia"
+    assert normalize_condition("Acute\n appendicitis") == "acute appendicitis"
+    assert education_cache_key("Flu") == "condition:flu"
+    assert education_cache_key("Flu", icd10_code="j11.1") == "icd10:J11.1"
+
+
+def test_hits_skip_the_agent():
+    cache = EducationCache()
+    runs = []
+
+    first = cache.get_or_create("condition:flu", lambda: runs.append(1) or "Flu is a viral infection.")
+    second = cache.get_or_create("condition:flu", lambda: runs.append(1) or "again")
+
+    assert first == second == "Flu is a viral infection."
+    assert runs == [1] and cache.stats == {"memory_hits": 1, "s3_hits": 0, "misses": 1}
+
+
+def test_least_recently_used_entries_are_evicted():
+    cache = EducationCache(max_entries=2)
+    cache.put("a", "A")
+    cache.put("b", "B")
+    cache.get("a")
+    cache.put("c", "C")
+
+    assert cache.get("b") is None and cache.get("a") == "A" and cache.get("c") == "C"
+
+
+def test_entries_expire():
+    cache = EducationCache(ttl_seconds=0.05)
+    cache.put("condition:flu", "Flu.")
+    time.sleep(0.06)
+
+    assert cache.get("condition:flu") is None
+
+
+def test_entries_are_shared_through_s3():
+    s3 = FakeS3()
+    EducationCache(s3=s3, bucket="bucket").put("condition:flu", "Flu.")
+    other_task = EducationCache(s3=s3, bucket="bucket")
+
+    assert other_task.get_or_create("condition:flu", lambda: "generated") == "Flu."
+    assert other_task.stats["s3_hits"] == 1
+    (_, key), body = next(iter(s3.objects.items()))
+    assert key.startswith("cache/education/") and json.loads(body)["key"] == "condition:flu"
+
+
+def test_expired_s3_entries_are_regenerated():
+    s3 = FakeS3()
+    cache = EducationCache(s3=s3, bucket="bucket")
+    s3.objects[("bucket", cache.s3_key("condition:flu"))] = json.dumps(
+        {"key": "condition:flu", "education": "stale", "expires_at": 0}).encode("utf-8")
+
+    assert cache.get_or_create("condition:flu", lambda: "fresh") == "fresh"
+
+
+def test_concurrent_misses_generate_once():
+    cache = EducationCache()
+    runs = []
+
+    def create():
+        runs.append(1)
+        time.sleep(0.05)
+        return "Pneumonia is an infection of the lungs."
+
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(cache.get_or_create("condition:pneumonia", create)))
+               for _ in range(5)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert runs == [1] and len(set(results)) == 1 and len(results) == 5
+
+
+def test_sections_are_generated_concurrently_and_yielded_as_they_finish():
+    delays = {"Flu": 0.2, "pneumonia": 0.05, "Appendicitis": 0.1}
+    in_flight, peak, lock = [0], [0], threading.Lock()
+
+    def educate(condition):
+        with lock:
+            in_flight[0] += 1
+            peak[0] = max(peak[0], in_flight[0])
+        time.sleep(delays[condition])
+        with lock:
+            in_flight[0] -= 1
+        return f"About {condition}."
+
+    with ThreadPoolExecutor(max_workers=3) as executor:
+        started = time.perf_counter()
+        sections = list(education_sections(["Flu", "pneumonia", "Pneumonia.", "Appendicitis"], educate, EducationCache(), executor))
+        elapsed = time.perf_counter() - started
+
+    assert [condition for condition, _, _ in sections] == ["pneumonia", "Appendicitis", "Flu"]
+    assert sections[0] == ("pneumonia", "About pneumonia.", None)
+    assert peak[0] == 3 and elapsed < 0.3
+
+
+def test_concurrency_is_bounded_by_the_executor():
+    in_flight, peak, lock = [0], [0], threading.Lock()
+
+    def educate(condition):
+        with lock:
+            in_flight[0] += 1
+            peak[0] = max(peak[0], in_flight[0])
+        time.sleep(0.02)
+        with lock:
+            in_flight[0] -= 1
+        return condition
+
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        sections = list(education_sections([f"condition {index}" for index in range(6)], educate, EducationCache(), executor))
+
+    assert len(sections) == 6 and peak[0] == 2
+
+
+def test_failed_sections_do_not_stop_the_others():
+    def educate(condition):
+        if condition == "flu":
+            raise RuntimeError("throttled")
+        return "ok"
+
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        sections = {condition: (education, error) for condition, education, error in
+                    education_sections(["flu", "asthma"], educate, EducationCache(), executor)}
+
+    assert sections["asthma"] == ("ok", None)
+    assert isinstance(sections["flu"][1], RuntimeError)
@@ -0,0 +1,152 @@
+import threading
+
+from job_tracker import JobTracker
+
+
+class FakeResultApi:
+    """
+    Blocks each poll until release() is called for the execution, or for at most wait_seconds,
+    like a long poll, and answers an unchanged execution with None.
+    """
+
+    def __init__(self, wait_seconds=None):
+        self.wait_seconds = wait_seconds
+        self.released = {}
+        self.calls = []
+        self.in_flight = self.max_in_flight = 0
+        self.lock = threading.Lock()
+
+    def release(self, sm_exec_arn, result):
+        self.released.setdefault(sm_exec_arn, threading.Event())
+        self.result = result
+        self.released[sm_exec_arn].set()
+
+    def poll_result(self, sm_exec_arn, etag):
+        with self.lock:
+            self.calls.append((sm_exec_arn, etag))
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            event = self.released.setdefault(sm_exec_arn, threading.Event())
+            if not event.wait(self.wait_seconds):
+                return None, f"etag-{len(self.calls)}"
+            if isinstance(self.result, Exception):
+                raise self.result
+            return self.result, "etag-done"
+        finally:
+            with self.lock:
+                self.in_flight -= 1
+
+
+def wait_until_done(job):
+    for _ in range(500):
+        if job.done:
+            return
+        threading.Event().wait(0.01)
+    raise AssertionError("job did not finish")
+
+
+def test_jobs_finish_in_the_background():
+    api = FakeResultApi()
+    tracker = JobTracker(api.poll_result)
+
+    job = tracker.track("session-1", "visit-0001", "arn:1")
+
+    assert not job.done
+    api.release("arn:1", {"status": "SUCCEEDED", "output": {"Outputs": {}}})
+    wait_until_done(job)
+    assert job.status == "SUCCEEDED" and job.result["output"] == {"Outputs": {}}
+    assert tracker.get("session-1", "visit-0001") is job
+
+
+def test_tracking_the_same_execution_again_does_not_wait_twice():
+    api = FakeResultApi()
+    tracker = JobTracker(api.poll_result)
+
+    job = tracker.track("session-1", "visit-0001", "arn:1")
+    assert tracker.track("session-1", "visit-0001", "arn:1") is job
+    assert tracker.get("session-2", "visit-0001") is None
+
+    api.release("arn:1", {"status": "FAILED"})
+    wait_until_done(job)
+    assert api.calls == [("arn:1", None)] and job.status == "FAILED"
+
+
+def test_errors_are_kept_on_the_job():
+    api = FakeResultApi()
+    tracker = JobTracker(api.poll_result)
+    job = tracker.track("session-1", "visit-0001", "arn:1")
+
+    api.release("arn:1", ConnectionError("api unreachable"))
+    wait_until_done(job)
+
+    assert job.status == "ERROR" and isinstance(job.error, ConnectionError)
+
+
+def test_finished_jobs_expire():
+    api = FakeResultApi()
+    tracker = JobTracker(api.poll_result, keep_seconds=0)
+    api.release("arn:1", {"status": "SUCCEEDED"})
+    job = tracker.track("session-1", "visit-0001", "arn:1")
+    wait_until_done(job)
+    job.finished_at -= 1
+
+    tracker.track("session-1", "visit-0002", "arn:2")
+    api.release("arn:2", {"status": "SUCCEEDED"})
+
+    assert tracker.get("session-1", "visit-0001") is None
+
+
+def test_partial_summary_is_read_on_its_own_timer():
+    api = FakeResultApi()
+    reads = []
+
+    def read_partial_summary(job_name):
+        reads.append(job_name)
+        return f"partial summary {len(reads)} of {job_name}"
+
+    tracker = JobTracker(api.poll_result, read_partial_summary, partial_summary_interval_seconds=60)
+    job = tracker.track("session-1", "visit-0001", "arn:1")
+
+    assert tracker.refresh_partial_summary(job) == "partial summary 1 of visit-0001"
+    assert tracker.refresh_partial_summary(job) == "partial summary 1 of visit-0001"
+    job.partial_summary_read_at -= 60
+    assert tracker.refresh_partial_summary(job) == "partial summary 2 of visit-0001"
+    # the result is polled for once, however often the summary is read
+    assert api.calls == [("arn:1", None)]
+
+    api.release("arn:1", {"status": "SUCCEEDED"})
+    wait_until_done(job)
+    tracker.refresh_partial_summary(job)
+    assert len(reads) == 2
+
+
+def test_jobs_take_turns_polling_on_the_pool():
+    api = FakeResultApi(wait_seconds=0.01)
+    tracker = JobTracker(api.poll_result, max_workers=2)
+
+    jobs = [tracker.track("session-1", f"visit-{index}", f"arn:{index}") for index in range(6)]
+    # the last job is polled while the first ones are still running
+    api.release("arn:5", {"status": "SUCCEEDED"})
+    wait_until_done(jobs[5])
+
+    assert not any(job.done for job in jobs[:5])
+    assert api.max_in_flight <= 2
+    for index in range(5):
+        api.release(f"arn:{index}", {"status": "SUCCEEDED"})
+    for job in jobs:
+        wait_until_done(job)
+
+
+def test_polls_send_the_etag_of_the_last_response():
+    api = FakeResultApi(wait_seconds=0.01)
+    tracker = JobTracker(api.poll_result)
+    job = tracker.track("session-1", "visit-0001", "arn:1")
+    while len(api.calls) < 3:
+        threading.Event().wait(0.01)
+
+    api.release("arn:1", {"status": "SUCCEEDED"})
+    wait_until_done(job)
+
+    assert api.calls[0] == ("arn:1", None)
+    assert [etag for _, etag in api.calls[1:3]] == ["etag-1", "etag-2"]
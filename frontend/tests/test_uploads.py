@@ -0,0 +1,136 @@
+import threading
+
+import boto3
+import pytest
+from botocore.stub import Stubber
+from s3transfer.manager import TransferManager
+
+from uploads import TransferProgress, UploadError, audio_transfer_config, start_audio_upload, upload_and_start_job
+
+API = "https://api.example.com/prod/"
+
+
+class FakeResponse:
+    def __init__(self, status_code=200, body=None, headers=None):
+        self.status_code = status_code
+        self.body = body
+        self.headers = headers or {}
+        self.text = str(body)
+
+    def json(self):
+        return self.body
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise OSError(f"HTTP {self.status_code}")
+
+
+class FakeUploadApi:
+    """The upload routes of the API plus the presigned part URLs of S3, as a requests session."""
+
+    def __init__(self, part_size, fail_part=None):
+        self.part_size = part_size
+        self.fail_part = fail_part
+        self.stored_parts = {}
+        self.posts = []
+        self.auths = set()
+        self.lock = threading.Lock()
+
+    def post(self, url, json, **kwargs):
+        self.posts.append((url[len(API):], json))
+        self.auths.add(("api", kwargs.get("auth")))
+        if url.endswith("api/uploads"):
+            count = -(-json["size"] // self.part_size)
+            return FakeResponse(body={
+                "bucket": "bucket", "key": "audio_conversations/1-a.mp3", "upload_id": "upload-1",
+                "job_name": "1-a", "part_size": self.part_size,
+                "parts": [{"part_number": n, "url": f"https://s3/part/{n}"} for n in range(1, count + 1)]
+            })
+        if url.endswith("api/uploads/complete"):
+            return FakeResponse(body={"job_name": "1-a", "sm_execution_arn": "arn:1", "deduplicated": False})
+        return FakeResponse(body={"aborted": True})
+
+    def put(self, url, data, **kwargs):
+        with self.lock:
+            self.auths.add(("part", kwargs.get("auth")))
+        part_number = int(url.rsplit("/", 1)[1])
+        if part_number == self.fail_part:
+            return FakeResponse(status_code=403)
+        with self.lock:
+            self.stored_parts[part_number] = data
+        return FakeResponse(headers={"ETag": f'"etag-{part_number}"'})
+
+
+@pytest.fixture
+def audio_file(tmp_path):
+    path = tmp_path / "a.mp3"
+    path.write_bytes(bytes(range(256)) * 40)
+    return path
+
+
+def test_parts_are_uploaded_then_completed(audio_file):
+    api = FakeUploadApi(part_size=3000)
+
+    reports = []
+
+    result = upload_and_start_job(str(audio_file), API, "English", session=api,
+                                  on_progress=lambda progress: reports.append((progress.bytes_transferred, progress.fraction)))
+
+    assert result["sm_execution_arn"] == "arn:1"
+    assert b"".join(api.stored_parts[n] for n in sorted(api.stored_parts)) == audio_file.read_bytes()
+    assert api.posts[0] == ("api/uploads", {"file_name": "a.mp3", "size": 10240, "content_type": "audio/mpeg"})
+    route, completion = api.posts[-1]
+    assert route == "api/uploads/complete"
+    assert completion["parts"] == [{"part_number": n, "etag": f'"etag-{n}"'} for n in range(1, 5)]
+    assert completion["language"] == "English"
+    assert len(reports) == 4
+    assert sorted(done for done, _ in reports) == [done for done, _ in reports]
+    assert reports[-1] == (10240, 1.0)
+
+
+def test_only_api_calls_are_signed(audio_file):
+    api = FakeUploadApi(part_size=3000)
+    auth = object()
+
+    upload_and_start_job(str(audio_file), API, "English", session=api, auth=auth)
+
+    # the presigned part URLs are already signed for S3
+    assert api.auths == {("api", auth), ("part", None)}
+
+
+def test_failed_part_aborts_the_upload(audio_file):
+    api = FakeUploadApi(part_size=3000, fail_part=2)
+
+    with pytest.raises(UploadError):
+        upload_and_start_job(str(audio_file), API, "English", session=api)
+
+    assert [route for route, _ in api.posts] == ["api/uploads", "api/uploads/abort"]
+
+
+def test_transfer_progress_counts_retried_bytes_once():
+    progress = TransferProgress(size=1000)
+
+    progress.on_progress(None, 600)
+    progress.on_progress(None, -200)
+    progress.on_progress(None, 600)
+
+    assert progress.bytes_transferred == 1000
+    assert progress.fraction == 1.0
+
+
+def test_audio_upload_sends_the_content_type_and_size(audio_file):
+    client = boto3.client("s3", region_name="us-east-1", aws_access_key_id="testing", aws_secret_access_key="testing")
+    sent = []
+    client.meta.events.register("before-parameter-build.s3.PutObject", lambda params, **kwargs: sent.append(dict(params)))
+    stubber = Stubber(client)
+    stubber.add_response("put_object", {"ETag": '"etag"'})
+
+    with stubber, TransferManager(client, audio_transfer_config(part_size_mb=1)) as manager:
+        future, progress = start_audio_upload(manager, str(audio_file), "bucket", "audio_conversations/a.mp3")
+        future.result()
+
+    stubber.assert_no_pending_responses()
+    assert [(params["Key"], params["ContentType"]) for params in sent] == [("audio_conversations/a.mp3", "audio/mpeg")]
+    # the stub never reads the body, so only the size and timing of the transfer are known
+    assert future.meta.size == progress.size == audio_file.stat().st_size
+    assert progress.finished_at is not None and progress.seconds > 0
@@ -0,0 +1,138 @@
+import logging
+import mimetypes
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import requests
+from s3transfer.manager import TransferConfig
+from s3transfer.subscribers import BaseSubscriber
+
+logger = logging.getLogger(__name__)
+
+
+class UploadError(Exception):
+    pass
+
+
+#transfer settings for consult recordings. An hour of audio is roughly 60 MB as MP3 and 115 MB
+#as WAV, so with the defaults every part of an hour long recording is in flight at once
+def audio_transfer_config(part_size_mb=8, max_concurrency=16):
+    part_size = part_size_mb * 1024 * 1024
+    return TransferConfig(
+        multipart_threshold=part_size,
+        multipart_chunksize=part_size,
+        max_request_concurrency=max_concurrency,
+        # keep enough parts read ahead to feed every connection
+        max_in_memory_upload_chunks=max_concurrency * 2,
+        io_chunksize=256 * 1024
+    )
+
+#upload a local audio file with the transfer manager, and return its future and the progress
+#subscriber. The manager calls the subscriber from its own threads, so the caller polls it
+def start_audio_upload(manager, path, bucket, key):
+    progress = TransferProgress(os.path.getsize(path))
+    future = manager.upload(path, bucket, key, subscribers=[progress], extra_args={
+        'ContentType': mimetypes.guess_type(path)[0] or 'application/octet-stream'
+    })
+    return future, progress
+
+
+class TransferProgress(BaseSubscriber):
+    '''
+    Bytes sent by one transfer and its throughput, updated by the threads of the transfer
+    manager and safe to read from any thread
+    '''
+
+    def __init__(self, size):
+        self.size = size
+        self.bytes_transferred = 0
+        self.started_at = None
+        self.finished_at = None
+        self.lock = threading.Lock()
+
+    def on_queued(self, future, **kwargs):
+        future.meta.provide_transfer_size(self.size)
+        self.started_at = time.monotonic()
+
+    def on_progress(self, future, bytes_transferred, **kwargs):
+        # a retried part reports its bytes again after rewinding them with a negative amount
+        with self.lock:
+            self.bytes_transferred += bytes_transferred
+
+    def on_done(self, future, **kwargs):
+        self.finished_at = time.monotonic()
+
+    @property
+    def fraction(self):
+        return min(self.bytes_transferred / self.size, 1.0) if self.size else 1.0
+
+    @property
+    def seconds(self):
+        if self.started_at is None:
+            return 0.0
+        return (self.finished_at or time.monotonic()) - self.started_at
+
+    #bytes per second since the transfer was queued
+    @property
+    def throughput(self):
+        return self.bytes_transferred / self.seconds if self.seconds else 0.0
+
+
+#upload a local audio file straight to S3 through the presigned multipart upload of the API,
+#max_workers parts at a time, then complete the upload, which starts the analysis job. on_progress
+#is called with the TransferProgress of the upload on the calling thread as each part finishes.
+#auth signs the calls to the API, the presigned part URLs carry their own signature.
+#Returns the response of the completion, with the job_name and sm_execution_arn of the job
+def upload_and_start_job(path, api_endpoint, language, output_prefix='audio_transcripts', max_workers=16,
+                         session=None, timeout=60, on_progress=None, auth=None):
+    session = session or requests.Session()
+    headers = {"accept": "application/json", "Content-Type": "application/json"}
+    resp = session.post(f"{api_endpoint}api/uploads", headers=headers, timeout=timeout, auth=auth, json={
+        "file_name": os.path.basename(path),
+        "size": os.path.getsize(path),
+        "content_type": mimetypes.guess_type(path)[0] or 'application/octet-stream'
+    })
+    if resp.status_code != 200:
+        raise UploadError(f"Couldn't start the upload of {path}: {resp.text}")
+    upload = resp.json()
+
+    def upload_part(part):
+        offset = (part['part_number'] - 1) * upload['part_size']
+        with open(path, 'rb') as audio_file:
+            audio_file.seek(offset)
+            data = audio_file.read(upload['part_size'])
+        part_resp = session.put(part['url'], data=data, timeout=timeout)
+        part_resp.raise_for_status()
+        return {"part_number": part['part_number'], "etag": part_resp.headers['ETag']}, len(data)
+
+    progress = TransferProgress(os.path.getsize(path))
+    progress.started_at = time.monotonic()
+    try:
+        with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(upload['parts'])))) as executor:
+            futures = [executor.submit(upload_part, part) for part in upload['parts']]
+            for future in as_completed(futures):
+                progress.on_progress(None, future.result()[1])
+                if on_progress is not None:
+                    on_progress(progress)
+        parts = [future.result()[0] for future in futures]
+        progress.finished_at = time.monotonic()
+    except Exception as err:
+        # parts already stored are billed until the upload is aborted
+        session.post(f"{api_endpoint}api/uploads/abort", headers=headers, timeout=timeout, auth=auth,
+                     json={"key": upload['key'], "upload_id": upload['upload_id']})
+        raise UploadError(f"Couldn't upload {path}: {err}") from err
+
+    logger.info(f"Uploaded {path} to {upload['bucket']}/{upload['key']} in {len(parts)} parts: "
+                f"{progress.bytes_transferred} bytes in {progress.seconds:.2f} s, {progress.throughput / 1024 ** 2:.1f} MiB/s")
+    resp = session.post(f"{api_endpoint}api/uploads/complete", headers=headers, timeout=timeout, auth=auth, json={
+        "key": upload['key'],
+        "upload_id": upload['upload_id'],
+        "parts": parts,
+        "output_prefix": output_prefix,
+        "language": language
+    })
+    if resp.status_code != 200:
+        raise UploadError(f"Couldn't complete the upload of {path}: {resp.text}")
+    return resp.json()